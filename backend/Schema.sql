@@ -330,48 +330,23 @@ BEGIN
     UPDATE training_company SET updated_at = datetime('now') WHERE company_id = NEW.company_id;
 END;
 
--- Auto-decrement certificates_remaining when a certificate is issued
-CREATE TRIGGER IF NOT EXISTS decrement_certificate_count
-AFTER UPDATE ON certificates
-WHEN NEW.status = 'ISSUED' AND OLD.status = 'AVAILABLE'
-BEGIN
-    UPDATE certificate_batches 
-    SET certificates_remaining = certificates_remaining - 1,
-        current_certificate_number = NEW.certificate_number
-    WHERE batch_id = NEW.batch_id;
-    
-    -- Mark batch as exhausted if no certificates remaining
-    UPDATE certificate_batches
-    SET status = 'EXHAUSTED'
-    WHERE batch_id = NEW.batch_id AND certificates_remaining = 0;
-END;
+-- certificates_remaining / current_certificate_number are maintained by
+-- cert_allocator.py in one statement per batch, not by a per-row trigger
 
-CREATE TABLE IF NOT EXISTS student_photos (
-    photo_id SERIAL PRIMARY KEY,
-    session_id INTEGER NOT NULL REFERENCES training_sessions(session_id),
-    driver_number VARCHAR(16) NOT NULL,
-    
-    -- Photo storage (BYTEA for binary data)
-    student_photo BYTEA NOT NULL,
-    license_photo BYTEA NOT NULL,
-    
-    -- OCR extracted data
-    surname VARCHAR(100),
-    forename VARCHAR(100),
-    date_of_birth VARCHAR(20),
-    address TEXT,
-    postcode VARCHAR(10),
-    
-    -- Verification results
-    match_score DECIMAL(5,2),
-    face_distance DECIMAL(5,3),
-    
-    -- Metadata
-    capture_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    
-    -- Index for lookups
-    CONSTRAINT unique_driver_session_photo UNIQUE (driver_number, session_id)
-);
+-- ============================================================================
+-- SCHEMA OWNED BY THE API MODULES
+-- ============================================================================
 
-CREATE INDEX idx_student_photos_session ON student_photos(session_id);
-CREATE INDEX idx_student_photos_driver ON student_photos(driver_number);
\ No newline at end of file
+-- The tables, columns and indexes listed here are created (and migrated on
+-- older databases) by the API at start-up, from DDL kept next to the code
+-- that uses it. They are not repeated in this file; a fresh database is
+-- complete once the API has started against it.
+--
+--   main.py (SCHEMA_UPGRADES)   config_versions, listing/pagination indexes,
+--                               idx_certificates_available, idx_certificates_verification
+--   main.py                     student_photos
+--   change_feed.py              change_seq columns, change_sequence
+--   stats_rollup.py             company_stats, company_daily_stats and their triggers
+--   cert_jobs.py                certificate_jobs
+--   face_store.py               face_encodings
+--   face_index.py               face_index_entries
@@ -0,0 +1,303 @@
+"""
+Asynchronous audit trail.
+
+Audited endpoints call audit.record() after their change has committed,
+passing the old and new values. A record is encoded as compact JSON,
+appended to an in-memory buffer, and appended with one unbuffered write to
+this process's spill file, which is all the request path pays. A
+background thread group-commits the buffer to audit_log at least every
+AUDIT_FLUSH_INTERVAL seconds (sooner when AUDIT_BATCH_SIZE records are
+waiting).
+
+Crash safety comes from the spill file. Each flush first rotates the file
+under the buffer lock, so the rotated file holds exactly the batch being
+written, and deletes it only after the batch has committed. Spill files
+are locked by the process that owns them (flock on Unix, msvcrt.locking
+on Windows). On start-up any unlocked file belongs to a dead process and
+is replayed into audit_log. A crash between the commit and the delete can
+replay a batch twice.
+
+AuditContextMiddleware puts the client address of the current request in
+a context variable, so hooks do not need the Request object.
+"""
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from db import pool
+from serialization import dumps
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+AUDIT_SPILL_DIR = os.getenv('AUDIT_SPILL_DIR', 'audit_spill')
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '0.5'))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', '10000'))
+
+INSERT_SQL = """INSERT INTO audit_log
+                (user_id, action, table_name, record_id, old_values, new_values,
+                 ip_address, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+_client_ip = contextvars.ContextVar('audit_client_ip', default=None)
+
+
+class AuditContextMiddleware:
+    """ASGI middleware exposing the client address to audit hooks"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        client = scope.get('client')
+        token = _client_ip.set(client[0] if client else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _client_ip.reset(token)
+
+
+def changed_values(old, new):
+    """(old, new) restricted to the keys of `new` whose value actually changed"""
+    old = dict(old or {})
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    return {k: old.get(k) for k in changed}, changed
+
+
+def _lock_file(f):
+    """Exclusive, non-blocking lock on an open spill file.
+
+    Raises OSError if another process holds it.
+    """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        # msvcrt locks a byte range from the current position; spill files
+        # are always locked on their first byte
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def _close_file(f):
+    """Unlock (Windows needs it explicitly) and close a spill file"""
+    try:
+        if fcntl is None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    except OSError:
+        pass
+    f.close()
+
+
+def _encode(values):
+    return None if values is None else dumps(values).decode()
+
+
+class AuditLog:
+    """In-memory buffer + spill file, group-committed to audit_log by one thread"""
+
+    def __init__(self, spill_dir=AUDIT_SPILL_DIR, flush_interval=AUDIT_FLUSH_INTERVAL,
+                 batch_size=AUDIT_BATCH_SIZE, buffer_size=AUDIT_BUFFER_SIZE):
+        self.spill_dir = spill_dir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self._buffer = deque()
+        self._overflowed = False
+        self._spill = None
+        self._spill_path = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._recorded = 0
+        self._flushed = 0
+        self._batches = 0
+        self._failures = 0
+        self._replayed = 0
+        self._last_flush_ms = 0.0
+
+    # ------------------------------------------------------------------
+    # Request path
+    # ------------------------------------------------------------------
+
+    def record(self, action, table_name, record_id=None, old=None, new=None, user_id=None):
+        """Queue one audit entry; never raises into the caller"""
+        try:
+            entry = (user_id, action, table_name, record_id, _encode(old), _encode(new),
+                     _client_ip.get(),
+                     datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+            line = dumps(entry) + b'\n'
+            with self._lock:
+                if self._spill is None:
+                    self._open_spill()
+                self._spill.write(line)
+                # Past the cap the spill file alone carries the entries
+                if len(self._buffer) < self.buffer_size:
+                    self._buffer.append(entry)
+                else:
+                    self._overflowed = True
+                self._recorded += 1
+                waiting = len(self._buffer)
+            if waiting >= self.batch_size:
+                self._wake.set()
+        except Exception as e:
+            print(f"❌ Audit record failed ({action} {table_name}): {e}")
+
+    # ------------------------------------------------------------------
+    # Spill files
+    # ------------------------------------------------------------------
+
+    def _open_spill(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._spill_path = os.path.join(
+            self.spill_dir, f"audit-{os.getpid()}-{time.time_ns()}.jsonl")
+        self._spill = open(self._spill_path, 'ab', buffering=0)
+        _lock_file(self._spill)
+
+    def _rotate(self):
+        """Swap in a fresh buffer and spill file; returns (entries, overflowed, file, path)"""
+        with self._lock:
+            if self._spill is None or not self._recorded_since_rotation():
+                return None
+            batch, overflowed = self._buffer, self._overflowed
+            spill, path = self._spill, self._spill_path
+            self._buffer, self._overflowed = deque(), False
+            self._spill = self._spill_path = None
+        return batch, overflowed, spill, path
+
+    def _recorded_since_rotation(self):
+        return self._overflowed or bool(self._buffer)
+
+    @staticmethod
+    def _read_spill(path):
+        with open(path, 'rb') as f:
+            return [tuple(json.loads(line)) for line in f if line.strip()]
+
+    def replay_orphans(self):
+        """Write spill files left behind by dead processes; returns entries written"""
+        written = 0
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, 'audit-*.jsonl'))):
+            if path == self._spill_path:
+                continue
+            try:
+                f = open(path, 'rb')
+                try:
+                    _lock_file(f)
+                except OSError:
+                    f.close()
+                    continue    # still owned by a live process
+                try:
+                    entries = [tuple(json.loads(line)) for line in f if line.strip()]
+                    if entries:
+                        self._write(entries)
+                finally:
+                    _close_file(f)
+                # Windows cannot delete a file that is still open
+                os.unlink(path)
+                written += len(entries)
+            except FileNotFoundError:
+                continue    # replayed by another process meanwhile
+            except Exception as e:
+                print(f"❌ Audit spill replay failed for {path}: {e}")
+        self._replayed += written
+        return written
+
+    # ------------------------------------------------------------------
+    # Flusher
+    # ------------------------------------------------------------------
+
+    def _write(self, entries):
+        with pool.connection() as conn:
+            try:
+                conn.executemany(INSERT_SQL, entries)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def flush(self):
+        """Group-commit everything recorded so far; returns entries written"""
+        rotated = self._rotate()
+        if rotated is None:
+            return 0
+        batch, overflowed, spill, path = rotated
+        started = time.perf_counter()
+        try:
+            entries = self._read_spill(path) if overflowed else list(batch)
+            self._write(entries)
+        except Exception as e:
+            # The rotated file keeps the entries; release it so the next
+            # replay (or the next start-up) writes them
+            self._failures += 1
+            _close_file(spill)
+            print(f"❌ Audit flush failed, {path} kept for replay: {e}")
+            return 0
+        _close_file(spill)
+        os.unlink(path)
+        self._flushed += len(entries)
+        self._batches += 1
+        self._last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(entries)
+
+    def start(self):
+        self.replay_orphans()
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="audit-flusher",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._spill is not None and not self._recorded_since_rotation():
+                _close_file(self._spill)
+                os.unlink(self._spill_path)
+                self._spill = self._spill_path = None
+
+    def _run(self):
+        polls = 0
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            polls += 1
+            try:
+                self.flush()
+                # Pick up batches that an earlier failed flush left behind
+                if self._failures and polls % 20 == 0:
+                    self.replay_orphans()
+            except Exception as e:
+                print(f"❌ Audit flusher error: {e}")
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._buffer)
+        return {
+            "buffered": buffered,
+            "recorded_total": self._recorded,
+            "flushed_total": self._flushed,
+            "batches_total": self._batches,
+            "failures_total": self._failures,
+            "replayed_total": self._replayed,
+            "last_flush_ms": round(self._last_flush_ms, 3),
+        }
+
+
+audit = AuditLog()
@@ -0,0 +1,172 @@
+"""
+Certificate number allocator.
+
+Certificates for a session are issued as one block of the next N
+AVAILABLE numbers inside a BEGIN IMMEDIATE transaction. Two instructors
+closing sessions at the same time therefore serialise on the write lock
+instead of racing for the same number. Lookups use a partial covering
+index over AVAILABLE certificates only.
+"""
+from datetime import datetime
+
+from cert_verify import assign_verification_codes
+
+# (session_type, certificate_number) for AVAILABLE rows only; batch_id is
+# included so the join to certificate_batches needs no table lookup
+AVAILABLE_INDEX = """CREATE INDEX IF NOT EXISTS idx_certificates_available
+    ON certificates(session_type, certificate_number, batch_id)
+    WHERE status = 'AVAILABLE'"""
+
+
+def begin_immediate(conn):
+    """Start a write transaction now, so the write lock is held from the first read"""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+
+def next_available(conn, company_id, session_type):
+    """Next AVAILABLE certificate for a company and session type, or None"""
+    return conn.execute("""SELECT c.*, cb.certificates_remaining
+                           FROM certificates c
+                           JOIN certificate_batches cb ON c.batch_id = cb.batch_id
+                           WHERE c.session_type = ? AND c.status = 'AVAILABLE'
+                           AND cb.company_id = ? AND cb.status = 'ACTIVE'
+                           ORDER BY c.certificate_number
+                           LIMIT 1""", (session_type, company_id)).fetchone()
+
+
+def issue_to_passing_students(conn, company_id, session_type, session_id, instructor_id,
+                              issue_date=None):
+    """Issue the next AVAILABLE certificates to a session's PASS students.
+
+    Passing students (by student_id) are paired with the lowest available
+    certificate numbers through a ROW_NUMBER() join, all in one UPDATE, and
+    each issued certificate gets its verification code. Students who already
+    hold an ISSUED certificate are skipped, so a repeated or concurrent
+    close never issues a second one. Must run inside a
+    write transaction (see begin_immediate). Returns the issued rows
+    (certificate_id, certificate_number, batch_id, student_id).
+    """
+    issue_date = issue_date or datetime.now().isoformat()
+    issued = conn.execute("""
+        WITH passing AS (
+            SELECT s.student_id, ROW_NUMBER() OVER (ORDER BY s.student_id) AS rn
+            FROM students s
+            WHERE s.session_id = ? AND s.training_outcome = 'PASS'
+            AND NOT EXISTS (SELECT 1 FROM certificates c
+                            WHERE c.student_id = s.student_id AND c.status = 'ISSUED')
+        ),
+        available AS (
+            SELECT c.certificate_id, ROW_NUMBER() OVER (ORDER BY c.certificate_number) AS rn
+            FROM certificates c
+            JOIN certificate_batches cb ON c.batch_id = cb.batch_id
+            WHERE c.session_type = ? AND c.status = 'AVAILABLE'
+            AND cb.company_id = ? AND cb.status = 'ACTIVE'
+            ORDER BY c.certificate_number
+            LIMIT (SELECT COUNT(*) FROM passing)
+        )
+        UPDATE certificates
+        SET student_id = p.student_id, session_id = ?, instructor_id = ?,
+            issue_date = ?, status = 'ISSUED'
+        FROM passing p JOIN available a ON a.rn = p.rn
+        WHERE certificates.certificate_id = a.certificate_id
+        RETURNING certificates.certificate_id, certificates.certificate_number,
+                  certificates.batch_id, certificates.student_id""",
+        (session_id, session_type, company_id, session_id, instructor_id,
+         issue_date)).fetchall()
+
+    if issued:
+        update_batch_counters(conn, issued)
+        assign_verification_codes(conn, [cert['certificate_id'] for cert in issued])
+    return issued
+
+
+def update_batch_counters(conn, issued):
+    """Apply the inventory change for a set of newly issued certificates"""
+    per_batch = {}
+    for cert in issued:
+        count, highest = per_batch.get(cert['batch_id'], (0, 0))
+        per_batch[cert['batch_id']] = (count + 1, max(highest, cert['certificate_number']))
+    conn.executemany("""UPDATE certificate_batches
+                        SET certificates_remaining = certificates_remaining - ?,
+                            current_certificate_number = MAX(current_certificate_number, ?),
+                            status = CASE WHEN certificates_remaining - ? <= 0
+                                          THEN 'EXHAUSTED' ELSE status END
+                        WHERE batch_id = ?""",
+                     [(count, highest, count, batch_id)
+                      for batch_id, (count, highest) in per_batch.items()])
+
+
+class RangeOverlap(Exception):
+    """Requested certificate numbers clash with each other or with existing ones"""
+
+    def __init__(self, conflicts):
+        super().__init__(f"{len(conflicts)} certificate range(s) overlap")
+        self.conflicts = conflicts
+
+
+def find_overlaps(conn, ranges):
+    """Check (start, end) ranges against each other and against existing numbers.
+
+    Returns a list of conflict dicts; empty when every range is free. Each
+    range against the table is one index range scan on certificate_number.
+    """
+    conflicts = []
+    previous = None
+    for start, end in sorted(ranges):
+        if previous is not None and start <= previous[1]:
+            conflicts.append({"start": start, "end": end,
+                              "overlaps_request_range": list(previous)})
+        if previous is None or end > previous[1]:
+            previous = (start, end)
+
+    for start, end in ranges:
+        row = conn.execute("""SELECT MIN(certificate_number), MAX(certificate_number), COUNT(*)
+                              FROM certificates
+                              WHERE certificate_number BETWEEN ? AND ?""",
+                           (start, end)).fetchone()
+        if row[2]:
+            conflicts.append({"start": start, "end": end,
+                              "existing_from": row[0], "existing_to": row[1],
+                              "existing_count": row[2]})
+    return conflicts
+
+
+def create_batches(conn, company_id, batches, received_by, received_date=None):
+    """Create certificate batches and their AVAILABLE certificates.
+
+    batches is a list of (session_type, start_number, batch_size). All ranges
+    are checked up front (RangeOverlap) and each batch's certificates are
+    generated by one recursive-CTE INSERT. Must run inside a write
+    transaction (see begin_immediate). Returns one dict per created batch.
+    """
+    ranges = [(start, start + size - 1) for _, start, size in batches]
+    conflicts = find_overlaps(conn, ranges)
+    if conflicts:
+        raise RangeOverlap(conflicts)
+
+    received_date = received_date or datetime.now().isoformat()
+    created = []
+    for (session_type, start, size), (_, end) in zip(batches, ranges):
+        batch_id = conn.execute("""INSERT INTO certificate_batches
+                                   (company_id, session_type, start_certificate_number,
+                                    end_certificate_number, batch_size,
+                                    current_certificate_number, certificates_remaining,
+                                    status, received_by, received_date)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, 'ACTIVE', ?, ?)""",
+                                (company_id, session_type, start, end, size, start, size,
+                                 received_by, received_date)).lastrowid
+        conn.execute("""WITH RECURSIVE numbers(n) AS (
+                            SELECT ? UNION ALL SELECT n + 1 FROM numbers WHERE n < ?
+                        )
+                        INSERT INTO certificates (batch_id, certificate_number, session_type, status)
+                        SELECT ?, n, ?, 'AVAILABLE' FROM numbers""",
+                     (start, end, batch_id, session_type))
+        created.append({
+            "batch_id": batch_id,
+            "session_type": session_type,
+            "start_number": start,
+            "end_number": end,
+            "total_certificates": size,
+        })
+    return created
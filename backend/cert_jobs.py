@@ -0,0 +1,334 @@
+"""
+Durable certificate job queue.
+
+Closing a session only records work: one render job (PDF and QR code) and,
+when the student has an email address, one email job per issued
+certificate, under a parent job for the session. The rows live in
+training.db and are inserted in the session-close transaction, so no work
+is lost and the close costs the same whatever the group size.
+
+A small pool of worker threads claims jobs with a lease, one at a time or,
+for kinds registered with a batch size (email), several of the same kind.
+No pooled connection is held while a handler runs: the claim commits on a
+short-lived connection, handlers borrow their own for reads and writes, and
+the outcome is recorded on another, only while the lease is still ours.
+Failures are retried with exponential backoff. A lease that expires
+(worker crash, restart) makes the job claimable again. Jobs are unique per
+(kind, certificate_id), and every handler is safe to run twice for the same
+certificate.
+"""
+import json
+import os
+import threading
+import time
+
+from cert_allocator import begin_immediate
+from db import pool
+
+CERT_JOB_WORKERS = int(os.getenv('CERT_JOB_WORKERS', '4'))
+CERT_JOB_POLL_INTERVAL = float(os.getenv('CERT_JOB_POLL_INTERVAL', '1.0'))
+CERT_JOB_LEASE_SECONDS = float(os.getenv('CERT_JOB_LEASE_SECONDS', '120'))
+CERT_JOB_MAX_ATTEMPTS = int(os.getenv('CERT_JOB_MAX_ATTEMPTS', '5'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificate_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    parent_id INTEGER,
+    kind TEXT NOT NULL,
+    company_id INTEGER NOT NULL,
+    session_id INTEGER,
+    certificate_id INTEGER,
+    depends_on INTEGER,
+    status TEXT NOT NULL DEFAULT 'PENDING' CHECK(status IN ('PENDING', 'RUNNING', 'DONE', 'DEAD')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    locked_until REAL,
+    last_error TEXT,
+    result TEXT,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    finished_at TEXT,
+    FOREIGN KEY (parent_id) REFERENCES certificate_jobs(job_id),
+    FOREIGN KEY (certificate_id) REFERENCES certificates(certificate_id)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_certificate_jobs_certificate
+    ON certificate_jobs(kind, certificate_id);
+CREATE INDEX IF NOT EXISTS idx_certificate_jobs_claim
+    ON certificate_jobs(status, next_attempt_at, job_id);
+CREATE INDEX IF NOT EXISTS idx_certificate_jobs_parent ON certificate_jobs(parent_id, status);
+"""
+
+# Parent rows only group their children; workers never claim them
+GROUP_KIND = 'session'
+
+# Jobs a worker may claim now: pending and due, or with an expired lease,
+# and not waiting on an unfinished job
+CLAIMABLE = """
+    ((j.status = 'PENDING' AND j.next_attempt_at <= :now)
+     OR (j.status = 'RUNNING' AND j.locked_until < :now))
+    AND (j.depends_on IS NULL
+         OR (SELECT d.status FROM certificate_jobs d WHERE d.job_id = j.depends_on) = 'DONE')"""
+
+
+class JobDeferred(Exception):
+    """Outcome for a job a batch handler did not get to in time.
+
+    The job goes straight back to PENDING without using up an attempt.
+    """
+
+
+def ensure_schema(conn):
+    conn.executescript(SCHEMA)
+
+
+def enqueue_session(conn, company_id, session_id, kinds=('render', 'email')):
+    """Queue jobs for every issued certificate of a session.
+
+    Runs inside the caller's transaction. Email jobs wait for the render
+    job of the same certificate. A certificate that already has a job of a
+    kind keeps it, unless that job finished or died, in which case it is
+    re-armed under the new parent. Returns (parent job_id, jobs queued).
+    """
+    parent_id = conn.execute("""INSERT INTO certificate_jobs
+                                (kind, company_id, session_id, status)
+                                VALUES (?, ?, ?, 'DONE') RETURNING job_id""",
+                             (GROUP_KIND, company_id, session_id)).fetchone()[0]
+    queued = 0
+    for kind in kinds:
+        queued += len(conn.execute("""
+            INSERT INTO certificate_jobs (parent_id, kind, company_id, session_id,
+                                          certificate_id, depends_on)
+            SELECT ?, ?, ?, c.session_id, c.certificate_id,
+                   CASE WHEN ? = 'email' THEN
+                        (SELECT job_id FROM certificate_jobs r
+                         WHERE r.kind = 'render' AND r.certificate_id = c.certificate_id)
+                   END
+            FROM certificates c
+            JOIN students s ON c.student_id = s.student_id
+            WHERE c.session_id = ? AND c.status = 'ISSUED'
+              AND (? != 'email' OR COALESCE(s.email, '') != '')
+            ON CONFLICT(kind, certificate_id) DO UPDATE SET
+                parent_id = excluded.parent_id, status = 'PENDING', attempts = 0,
+                next_attempt_at = 0, locked_until = NULL, last_error = NULL,
+                finished_at = NULL
+            WHERE certificate_jobs.status IN ('DONE', 'DEAD')
+            RETURNING job_id""",
+            (parent_id, kind, company_id, kind, session_id, kind)).fetchall())
+    return parent_id, queued
+
+
+def job_status(conn, job_id, company_id):
+    """A job with its children's progress, or None"""
+    job = conn.execute("""SELECT job_id, parent_id, kind, session_id, certificate_id, status,
+                                 attempts, last_error, result, created_at, finished_at
+                          FROM certificate_jobs WHERE job_id = ? AND company_id = ?""",
+                       (job_id, company_id)).fetchone()
+    if job is None:
+        return None
+    job = dict(job)
+    job['result'] = json.loads(job['result']) if job['result'] else None
+
+    counts = conn.execute("""SELECT kind, status, COUNT(*) AS jobs FROM certificate_jobs
+                             WHERE parent_id = ? GROUP BY kind, status""",
+                          (job_id,)).fetchall()
+    if job['kind'] == GROUP_KIND:
+        progress = {}
+        for row in counts:
+            progress.setdefault(row['kind'], {})[row['status']] = row['jobs']
+        total = sum(row['jobs'] for row in counts)
+        done = sum(row['jobs'] for row in counts if row['status'] == 'DONE')
+        dead = sum(row['jobs'] for row in counts if row['status'] == 'DEAD')
+        job['status'] = ('DONE' if done == total else
+                         'FAILED' if done + dead == total else 'RUNNING')
+        job['progress'] = {"total": total, "done": done, "failed": dead, "by_kind": progress}
+        failures = conn.execute("""SELECT job_id, kind, certificate_id, attempts, last_error
+                                   FROM certificate_jobs
+                                   WHERE parent_id = ? AND status = 'DEAD'
+                                   ORDER BY job_id LIMIT 20""", (job_id,)).fetchall()
+        job['failures'] = [dict(row) for row in failures]
+    return job
+
+
+class CertificateJobRunner:
+    """Worker threads that claim and run certificate jobs"""
+
+    def __init__(self, workers=CERT_JOB_WORKERS, poll_interval=CERT_JOB_POLL_INTERVAL,
+                 lease_seconds=CERT_JOB_LEASE_SECONDS, max_attempts=CERT_JOB_MAX_ATTEMPTS):
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._handlers = {}
+        self._threads = []
+        self._wake = threading.Condition()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._retried = 0
+        self._dead = 0
+
+    def register(self, kind, handler, batch_size=1):
+        """handler(job) does the work for one job and returns a JSON-able result.
+
+        With batch_size > 1, up to that many jobs of the kind are claimed
+        together and handler(jobs) returns {job_id: result or exception}.
+        Handlers take pooled connections only for as long as they need them
+        and must finish before job['locked_until'] (time.time()).
+        """
+        self._handlers[kind] = (handler, batch_size)
+
+    def wake(self):
+        """Tell idle workers there is new work (after the enqueue has committed)"""
+        with self._wake:
+            self._wake.notify_all()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"cert-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self.wake()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                print(f"❌ Certificate job worker error: {e}")
+            with self._wake:
+                self._wake.wait(self.poll_interval)
+
+    def _head(self, conn, now):
+        """Kind of the oldest claimable job, or None"""
+        return conn.execute(f"""SELECT j.kind FROM certificate_jobs j
+                                WHERE j.kind IN (SELECT value FROM json_each(:kinds))
+                                  AND {CLAIMABLE}
+                                ORDER BY j.job_id LIMIT 1""",
+                            {"kinds": json.dumps(list(self._handlers)), "now": now}).fetchone()
+
+    def _claim(self, conn):
+        now = time.time()
+        # Idle polls only read; the write lock is taken once there is work,
+        # and the head is re-checked under it in case another worker got there
+        if self._head(conn, now) is None:
+            return []
+        begin_immediate(conn)
+        try:
+            head = self._head(conn, now)
+            if head is None:
+                conn.rollback()
+                return []
+            batch_size = self._handlers[head['kind']][1]
+            jobs = conn.execute(f"""UPDATE certificate_jobs
+                                    SET status = 'RUNNING', attempts = attempts + 1,
+                                        locked_until = :lease
+                                    WHERE job_id IN (
+                                        SELECT j.job_id FROM certificate_jobs j
+                                        WHERE j.kind = :kind AND {CLAIMABLE}
+                                        ORDER BY j.job_id LIMIT :limit)
+                                    RETURNING *""",
+                                {"kind": head['kind'], "now": now, "limit": batch_size,
+                                 "lease": now + self.lease_seconds}).fetchall()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return sorted((dict(job) for job in jobs), key=lambda job: job['job_id'])
+
+    def run_once(self):
+        """Claim and run one job or batch; returns False when there was nothing to do"""
+        with pool.connection() as conn:
+            jobs = self._claim(conn)
+        if not jobs:
+            return False
+
+        handler, batch_size = self._handlers[jobs[0]['kind']]
+        try:
+            if batch_size > 1:
+                outcomes = handler(jobs)
+            else:
+                outcomes = {jobs[0]['job_id']: handler(jobs[0])}
+        except Exception as e:
+            outcomes = {job['job_id']: e for job in jobs}
+
+        # Every update checks locked_until: if the lease ran out and another
+        # worker reclaimed the job, that worker records the outcome
+        with pool.connection() as conn:
+            for job in jobs:
+                outcome = outcomes.get(job['job_id'], RuntimeError("Handler returned no result"))
+                if isinstance(outcome, JobDeferred):
+                    conn.execute("""UPDATE certificate_jobs
+                                    SET status = 'PENDING', attempts = attempts - 1,
+                                        locked_until = NULL, next_attempt_at = 0
+                                    WHERE job_id = ? AND locked_until = ?""",
+                                 (job['job_id'], job['locked_until']))
+                elif isinstance(outcome, Exception):
+                    self._fail(conn, job, str(outcome))
+                else:
+                    conn.execute("""UPDATE certificate_jobs
+                                    SET status = 'DONE', result = ?, last_error = NULL,
+                                        locked_until = NULL, finished_at = datetime('now')
+                                    WHERE job_id = ? AND locked_until = ?""",
+                                 (json.dumps(outcome, default=str) if outcome is not None
+                                  else None, job['job_id'], job['locked_until']))
+                    with self._lock:
+                        self._completed += 1
+            conn.commit()
+        # Finishing a job may have unblocked its dependents
+        self.wake()
+        return True
+
+    def _fail(self, conn, job, error):
+        attempts = job['attempts']
+        if attempts >= self.max_attempts:
+            if conn.execute("""UPDATE certificate_jobs
+                               SET status = 'DEAD', last_error = ?, locked_until = NULL,
+                                   finished_at = datetime('now')
+                               WHERE job_id = ? AND locked_until = ?""",
+                            (error, job['job_id'], job['locked_until'])).rowcount == 0:
+                return
+            # Nothing that waits on this job can run now
+            conn.execute("""UPDATE certificate_jobs
+                            SET status = 'DEAD', last_error = ?, finished_at = datetime('now')
+                            WHERE depends_on = ? AND status = 'PENDING'""",
+                         (f"{job['kind']} job {job['job_id']} failed", job['job_id']))
+            with self._lock:
+                self._dead += 1
+        else:
+            if conn.execute("""UPDATE certificate_jobs
+                               SET status = 'PENDING', last_error = ?, locked_until = NULL,
+                                   next_attempt_at = ?
+                               WHERE job_id = ? AND locked_until = ?""",
+                            (error, time.time() + min(300, 2 ** attempts), job['job_id'],
+                             job['locked_until'])).rowcount == 0:
+                return
+            with self._lock:
+                self._retried += 1
+        print(f"❌ Certificate {job['kind']} job #{job['job_id']} failed "
+              f"(attempt {attempts}): {error}")
+
+    def stats(self):
+        with pool.connection() as conn:
+            rows = conn.execute("""SELECT status, COUNT(*) AS jobs FROM certificate_jobs
+                                   WHERE kind != ? GROUP BY status""", (GROUP_KIND,)).fetchall()
+        with self._lock:
+            return {
+                "workers": len(self._threads),
+                "jobs": {row['status']: row['jobs'] for row in rows},
+                "completed_total": self._completed,
+                "retried_total": self._retried,
+                "dead_total": self._dead,
+            }
+
+
+job_runner = CertificateJobRunner()
@@ -0,0 +1,296 @@
+"""
+Certificate email delivery.
+
+Email jobs are claimed in batches (EMAIL_BATCH_SIZE) from the certificate
+job queue and handed to email_batch_job. Each job worker thread keeps one
+SMTP connection open and reuses it across batches, reconnecting when the
+server drops it. Sends across all workers share one token-bucket rate
+limit. Transient failures (dropped connections, 4xx replies) are retried
+with exponential backoff; a permanent 5xx rejection is recorded as FAILED
+without retrying. Each outcome is written to certificate_emails as soon as
+the server has answered, so a job that is run again never re-sends a
+message that went out. A batch stops sending at EMAIL_BATCH_SECONDS (and
+always well inside the job lease); the jobs it did not reach are handed
+back to the queue.
+
+For local testing point SMTP_HOST/SMTP_PORT at a debugging server, e.g.
+    python -m aiosmtpd -n -l localhost:1025
+"""
+import json
+import os
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+from cert_jobs import JobDeferred
+from db import pool
+
+SMTP_HOST = os.getenv('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '25'))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'false').lower() == 'true'
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+SMTP_FROM = os.getenv('SMTP_FROM')
+
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '50'))
+EMAIL_RATE_PER_SECOND = float(os.getenv('EMAIL_RATE_PER_SECOND', '20'))   # 0 = unlimited
+EMAIL_SEND_ATTEMPTS = int(os.getenv('EMAIL_SEND_ATTEMPTS', '4'))
+EMAIL_BACKOFF_BASE = float(os.getenv('EMAIL_BACKOFF_BASE', '0.5'))
+EMAIL_BACKOFF_MAX = float(os.getenv('EMAIL_BACKOFF_MAX', '30'))
+EMAIL_BATCH_SECONDS = float(os.getenv('EMAIL_BATCH_SECONDS', '60'))
+
+CERTIFICATE_EMAIL_SQL = """
+    SELECT c.certificate_id, c.certificate_number, c.pdf_file_path, c.session_type,
+           s.name AS student_name, s.email AS student_email,
+           tc.company_name, tc.email AS company_email, tc.phone AS company_phone
+    FROM certificates c
+    JOIN students s ON c.student_id = s.student_id
+    JOIN training_sessions ts ON c.session_id = ts.session_id
+    JOIN training_company tc ON ts.company_id = tc.company_id
+    WHERE c.certificate_id IN (SELECT value FROM json_each(?)) AND c.status = 'ISSUED'"""
+
+
+class PermanentFailure(Exception):
+    """The server rejected the message for good (5xx); do not retry"""
+
+
+def build_message(cert):
+    """The certificate email for one row of CERTIFICATE_EMAIL_SQL"""
+    message = EmailMessage()
+    message['From'] = SMTP_FROM or cert['company_email'] or 'noreply@localhost'
+    message['To'] = cert['student_email']
+    message['Subject'] = (f"Your {cert['session_type']} certificate "
+                          f"({cert['certificate_number']})")
+    message.set_content(
+        f"Dear {cert['student_name']},\n\n"
+        f"Congratulations on completing your {cert['session_type']} training. "
+        f"Your certificate of completion (number {cert['certificate_number']}) is attached.\n\n"
+        f"{cert['company_name']}\n{cert['company_phone'] or ''}\n")
+    with open(cert['pdf_file_path'], 'rb') as f:
+        message.add_attachment(f.read(), maintype='application', subtype='pdf',
+                               filename=f"certificate_{cert['certificate_number']}.pdf")
+    return message
+
+
+class RateLimiter:
+    """Token bucket shared by every sending thread"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a send is allowed; returns the seconds waited"""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class CertificateMailer:
+    """SMTP sender with a persistent connection per thread"""
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, rate=EMAIL_RATE_PER_SECOND,
+                 attempts=EMAIL_SEND_ATTEMPTS, backoff_base=EMAIL_BACKOFF_BASE,
+                 backoff_max=EMAIL_BACKOFF_MAX):
+        self.host = host
+        self.port = port
+        self.attempts = max(1, attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = RateLimiter(rate)
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._connects = 0
+        self._throttled_seconds = 0.0
+
+    # ------------------------------------------------------------------
+    # Connections
+    # ------------------------------------------------------------------
+
+    def _connection(self):
+        smtp = getattr(self._local, 'smtp', None)
+        if smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_USERNAME:
+                smtp.login(SMTP_USERNAME, SMTP_PASSWORD or '')
+            self._local.smtp = smtp
+            with self._lock:
+                self._connections.add(smtp)
+                self._connects += 1
+        return smtp
+
+    def _drop_connection(self):
+        smtp = getattr(self._local, 'smtp', None)
+        self._local.smtp = None
+        if smtp is not None:
+            with self._lock:
+                self._connections.discard(smtp)
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """Close every open connection (shutdown)"""
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for smtp in connections:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+    # ------------------------------------------------------------------
+    # Sending
+    # ------------------------------------------------------------------
+
+    def _send_one(self, message, deadline=None):
+        for attempt in range(self.attempts):
+            throttled = self.limiter.acquire()
+            try:
+                refused = self._connection().send_message(message)
+                if refused:
+                    raise PermanentFailure(f"Recipient refused: {refused}")
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError) as e:
+                code = getattr(e, 'smtp_code', None)
+                if code is None and isinstance(e, smtplib.SMTPRecipientsRefused):
+                    code = min(c for c, _ in e.recipients.values())
+                if code is not None and code >= 500:
+                    raise PermanentFailure(str(e))
+                error = e
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                    smtplib.SMTPResponseException, OSError) as e:
+                self._drop_connection()
+                error = e
+            finally:
+                with self._lock:
+                    self._throttled_seconds += throttled
+            if attempt + 1 < self.attempts:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                if deadline is not None and time.time() + delay >= deadline:
+                    break
+                with self._lock:
+                    self._retries += 1
+                time.sleep(delay)
+        raise error
+
+    def send_message(self, message, deadline=None):
+        """Send one message over this thread's connection; None if sent, else the exception.
+
+        No retry is started that would sleep past deadline (time.time()).
+        """
+        try:
+            self._send_one(message, deadline)
+        except Exception as e:
+            with self._lock:
+                self._failed += 1
+            return e
+        with self._lock:
+            self._sent += 1
+        return None
+
+    def send_messages(self, messages):
+        """Send messages in order; one entry per message, None if sent, else the exception"""
+        return [self.send_message(message) for message in messages]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open_connections": len(self._connections),
+                "connects_total": self._connects,
+                "sent_total": self._sent,
+                "failed_total": self._failed,
+                "retries_total": self._retries,
+                "throttled_seconds_total": round(self._throttled_seconds, 3),
+                "rate_per_second": self.limiter.rate,
+            }
+
+
+def _record_email(cert, status, error=None):
+    with pool.connection() as conn:
+        conn.execute("""INSERT INTO certificate_emails
+                        (certificate_id, student_email, delivery_status, error_message)
+                        VALUES (?, ?, ?, ?)""",
+                     (cert['certificate_id'], cert['student_email'], status, error))
+        conn.commit()
+
+
+def email_batch_job(jobs):
+    """Certificate job handler for a batch of email jobs.
+
+    Certificates that already have a SENT row are skipped, so a retried job
+    never mails a student twice. Sent and permanently rejected messages are
+    recorded in certificate_emails one by one, straight after the send;
+    transient failures are returned as exceptions so the job queue retries
+    them, and messages not reached before the deadline as JobDeferred.
+    """
+    # Stop with a full SMTP timeout of the lease to spare
+    deadline = min(time.time() + EMAIL_BATCH_SECONDS,
+                   min(job['locked_until'] for job in jobs) - SMTP_TIMEOUT)
+    ids = [job['certificate_id'] for job in jobs]
+    with pool.connection() as conn:
+        certs = {row['certificate_id']: dict(row) for row in
+                 conn.execute(CERTIFICATE_EMAIL_SQL, (json.dumps(ids),))}
+        already_sent = {row[0] for row in conn.execute(
+            """SELECT certificate_id FROM certificate_emails
+               WHERE certificate_id IN (SELECT value FROM json_each(?))
+                 AND delivery_status = 'SENT'""", (json.dumps(ids),))}
+
+    outcomes = {}
+    pending = []
+    for job in jobs:
+        cert = certs.get(job['certificate_id'])
+        if cert is None or not cert['student_email']:
+            outcomes[job['job_id']] = {"skipped": "no issued certificate or student email"}
+        elif cert['certificate_id'] in already_sent:
+            outcomes[job['job_id']] = {"skipped": "already sent"}
+        elif not cert['pdf_file_path'] or not os.path.exists(cert['pdf_file_path']):
+            outcomes[job['job_id']] = RuntimeError("Certificate PDF has not been rendered")
+        else:
+            try:
+                pending.append((job, cert, build_message(cert)))
+            except OSError as e:
+                outcomes[job['job_id']] = e
+
+    for i, (job, cert, message) in enumerate(pending):
+        # The first message always goes, so a batch cannot be deferred forever
+        if i and time.time() >= deadline:
+            outcomes[job['job_id']] = JobDeferred("Batch time limit reached")
+            continue
+        error = mailer.send_message(message, deadline)
+        if error is None:
+            _record_email(cert, 'SENT')
+            outcomes[job['job_id']] = {"to": cert['student_email']}
+        elif isinstance(error, PermanentFailure):
+            _record_email(cert, 'FAILED', str(error))
+            outcomes[job['job_id']] = {"to": cert['student_email'], "failed": str(error)}
+        else:
+            outcomes[job['job_id']] = error
+    return outcomes
+
+
+mailer = CertificateMailer()
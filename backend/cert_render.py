@@ -0,0 +1,311 @@
+"""
+DL196 certificate rendering.
+
+The static part of a certificate (border, headings, field labels and the
+training body's company block and stamp) is laid out once per company in
+each render worker and kept as a ready-made PDF content stream. A Form
+XObject can only live inside a single PDF, so each certificate's PDF wraps
+the cached stream in a form and places it with doForm. Only the per-student
+fields and the QR code are drawn per certificate. Capturing the stream reads
+canvas internals (reportlab is pinned in requirements.txt); if they are not
+there, the cached layer is drawn through the public API instead, which is
+slower but identical.
+
+Rendering is driven by the certificate job queue (cert_jobs.py) through
+render_job, one certificate per job. RenderPool runs each render in a small
+process pool, so the job worker threads render in parallel and each pool
+process keeps its own template cache. There is no longer a mode that hands
+a whole session to one pool process, so each job thread has at most one
+render in flight. The number of concurrent renders is therefore
+min(CERT_JOB_WORKERS, CERT_RENDER_WORKERS), and pool processes beyond the
+job thread count sit idle. Raise both settings together.
+"""
+import importlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from db import pool
+
+CERT_OUTPUT_DIR = os.getenv('CERT_OUTPUT_DIR', 'certificates')
+CERT_RENDER_WORKERS = int(os.getenv('CERT_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+CERT_VERIFY_URL = os.getenv('CERT_VERIFY_URL', 'http://localhost:8000/verify')
+
+FORM_NAME = 'dl196_static'
+QR_MASK_PATTERN = 2
+QR_BOX_SIZE = 4
+
+# Per-worker cache of company templates: (company_id, updated_at) -> template
+_templates = OrderedDict()
+_TEMPLATE_CACHE_SIZE = 32
+
+# (label, y position in points) for the per-student fields
+FIELDS = [
+    ("Certificate number", 'certificate_number', 640),
+    ("Name", 'student_name', 600),
+    ("Date of birth", 'date_of_birth', 575),
+    ("Driving licence number", 'license_number', 550),
+    ("Course", 'session_type_description', 525),
+    ("Motorcycle", 'bike_type', 500),
+    ("Date of completion", 'completion_date', 475),
+    ("Site code", 'site_code', 450),
+    ("Instructor", 'instructor_name', 425),
+    ("Instructor certificate number", 'instructor_certificate_number', 400),
+]
+VALUE_X = 250
+
+
+def _init_worker():
+    """Import reportlab/qrcode once per worker and switch off ASCII85 streams"""
+    from reportlab import rl_config
+    importlib.import_module('qrcode')
+    # Without the C accelerator ASCII85 encoding is pure Python and costs
+    # more than drawing the page; compressed binary streams are also smaller
+    rl_config.useA85 = 0
+
+
+def _company_template(company):
+    """The static page layer for a company, built once per worker.
+
+    Returns (drawing, operators, fonts, stamp): the layer as a reportlab
+    Drawing, its content stream drawn into a scratch form and the fonts it
+    uses in registration order (both None if the stream could not be
+    captured), and the decoded stamp image (or None).
+    """
+    import io
+    from reportlab.graphics import renderPDF
+    from reportlab.graphics.shapes import Drawing, Line, Rect, String
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    key = (company['company_id'], company.get('updated_at'))
+    template = _templates.get(key)
+    if template is not None:
+        _templates.move_to_end(key)
+        return template
+
+    width, height = A4
+    d = Drawing(width, height)
+    d.add(Rect(25, 25, width - 50, height - 50, strokeWidth=2, fillColor=None))
+    d.add(Rect(32, 32, width - 64, height - 64, strokeWidth=0.5, fillColor=None))
+    d.add(String(width / 2, height - 80, "DL196", fontName='Helvetica-Bold',
+                 fontSize=26, textAnchor='middle'))
+    d.add(String(width / 2, height - 105, "Certificate of Completion of Training",
+                 fontName='Helvetica-Bold', fontSize=15, textAnchor='middle'))
+    d.add(Line(60, height - 120, width - 60, height - 120, strokeWidth=1))
+
+    for label, _, y in FIELDS:
+        d.add(String(60, y, label, fontName='Helvetica-Bold', fontSize=10.5))
+        d.add(Line(VALUE_X - 5, y - 4, width - 60, y - 4, strokeWidth=0.3))
+
+    # Company block
+    block_top = 330
+    d.add(String(60, block_top, "Approved Training Body", fontName='Helvetica-Bold',
+                 fontSize=11))
+    lines = [
+        company.get('company_name'),
+        f"ATB reference: {company.get('training_body_reference')}",
+        company.get('address_line_1'),
+        company.get('address_line_2'),
+        ", ".join(p for p in (company.get('city'), company.get('county'),
+                               company.get('postcode')) if p),
+        company.get('phone'),
+        company.get('email'),
+    ]
+    y = block_top - 18
+    for line in lines:
+        if line:
+            d.add(String(60, y, str(line), fontName='Helvetica', fontSize=10))
+            y -= 14
+
+    d.add(String(60, 60, "This certificate can be verified by scanning the QR code.",
+                 fontName='Helvetica-Oblique', fontSize=8))
+
+    # Draw once into a scratch document and keep the operators
+    try:
+        scratch = canvas.Canvas(io.BytesIO(), pagesize=A4)
+        scratch.beginForm(FORM_NAME)
+        mark = len(scratch._code)
+        renderPDF.draw(d, scratch, 0, 0)
+        operators = '\n'.join(scratch._code[mark:])
+        scratch.endForm()
+        fonts = list(scratch._doc.fontMapping)
+    except (AttributeError, TypeError):
+        operators = fonts = None
+
+    stamp = company.get('official_stamp_image_path')
+    stamp = ImageReader(stamp) if stamp and os.path.exists(stamp) else None
+
+    template = (d, operators, fonts, stamp)
+    _templates[key] = template
+    while len(_templates) > _TEMPLATE_CACHE_SIZE:
+        _templates.popitem(last=False)
+    return template
+
+
+def _qr_image(cert, path):
+    """Write the verification QR code PNG; returns it as a PIL image"""
+    import numpy as np
+    import qrcode
+    from PIL import Image
+
+    verify_key = cert.get('verification_code') or cert['certificate_number']
+    # A fixed mask pattern skips qrcode's trial of all eight, which is most
+    # of the cost of a certificate
+    qr = qrcode.QRCode(border=1, mask_pattern=QR_MASK_PATTERN,
+                       error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(f"{CERT_VERIFY_URL}/{verify_key}")
+    qr.make(fit=True)
+    # Scale the module matrix up directly rather than drawing each module
+    modules = np.array(qr.get_matrix(), dtype=np.uint8)
+    pixels = np.kron(1 - modules, np.ones((QR_BOX_SIZE, QR_BOX_SIZE), dtype=np.uint8)) * 255
+    image = Image.fromarray(pixels, mode='L')
+    image.save(path, optimize=False)
+    return image
+
+
+def render_certificate(company, cert, output_dir=CERT_OUTPUT_DIR):
+    """Render one certificate PDF and its QR PNG; returns (certificate_id, pdf, qr)"""
+    from reportlab.graphics import renderPDF
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    directory = os.path.join(output_dir, str(company['company_id']))
+    os.makedirs(directory, exist_ok=True)
+    number = cert['certificate_number']
+    pdf_path = os.path.join(directory, f"{number}.pdf")
+    qr_path = os.path.join(directory, f"{number}_qr.png")
+    qr_image = _qr_image(cert, qr_path)
+
+    c = canvas.Canvas(pdf_path, pagesize=A4, pageCompression=1)
+    c.setTitle(f"DL196 {number}")
+    drawing, operators, fonts, stamp = _company_template(company)
+    c.beginForm(FORM_NAME)
+    if operators is None:
+        renderPDF.draw(drawing, c, 0, 0)
+    else:
+        # Font resource names follow registration order, so registering the
+        # template's fonts in the same order makes the cached operators valid
+        for font in fonts:
+            c.setFont(font, 10)
+        c.addLiteral(operators)
+    if stamp is not None:
+        c.drawImage(stamp, A4[0] - 200, 170, 120, 120, preserveAspectRatio=True)
+    c.endForm()
+    c.doForm(FORM_NAME)
+
+    values = dict(cert)
+    values['completion_date'] = cert.get('completion_date') or (cert.get('issue_date') or '')[:10]
+    c.setFont('Helvetica', 11)
+    for _, field, y in FIELDS:
+        value = values.get(field)
+        if value is not None:
+            c.drawString(VALUE_X, y, str(value))
+
+    c.drawImage(ImageReader(qr_image), A4[0] - 170, 60, 110, 110)
+    c.showPage()
+    c.save()
+    return cert['certificate_id'], pdf_path, qr_path
+
+
+class RenderPool:
+    """Process pool for certificate rendering"""
+
+    def __init__(self, workers=CERT_RENDER_WORKERS, output_dir=CERT_OUTPUT_DIR):
+        self.workers = max(1, workers)
+        self.output_dir = output_dir
+        self._executor = None
+        self._lock = threading.Lock()
+        self._rendered = 0
+        self._failures = 0
+        self._last_render_ms = 0.0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_init_worker)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def render(self, company, cert):
+        """Render one certificate in a pool process; returns (certificate_id, pdf, qr)"""
+        self.start()
+        started = time.perf_counter()
+        try:
+            rendered = self._executor.submit(render_certificate, company, cert,
+                                             self.output_dir).result()
+        except Exception:
+            with self._lock:
+                self._failures += 1
+            raise
+        with self._lock:
+            self._rendered += 1
+            self._last_render_ms = (time.perf_counter() - started) * 1000
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "rendered_total": self._rendered,
+                "failures_total": self._failures,
+                "last_render_ms": round(self._last_render_ms, 1),
+            }
+
+
+# Everything a certificate needs
+CERTIFICATE_SQL = """
+    SELECT c.certificate_id, c.certificate_number, c.issue_date, c.completion_date,
+           c.session_type, c.verification_code, s.name AS student_name, s.license_number,
+           s.date_of_birth, s.bike_type, ts.site_code, ts.session_date,
+           u.name AS instructor_name, u.instructor_certificate_number,
+           st.description AS session_type_description
+    FROM certificates c
+    JOIN students s ON c.student_id = s.student_id
+    JOIN training_sessions ts ON c.session_id = ts.session_id
+    JOIN users u ON c.instructor_id = u.user_id
+    JOIN session_types st ON c.session_type = st.session_type"""
+
+
+def _company(conn, company_id):
+    row = conn.execute("SELECT * FROM training_company WHERE company_id = ?",
+                       (company_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def record_rendered(conn, rendered):
+    """Store pdf_file_path / qr_code_image_path for rendered certificates"""
+    conn.executemany("""UPDATE certificates SET pdf_file_path = ?, qr_code_image_path = ?
+                        WHERE certificate_id = ?""",
+                     [(pdf, qr, certificate_id) for certificate_id, pdf, qr in rendered])
+    conn.commit()
+
+
+def render_job(job):
+    """Certificate job handler: (re)render one certificate's PDF and QR code.
+
+    Output paths depend only on the certificate, so running it twice just
+    rewrites the same files. No connection is held while rendering.
+    """
+    with pool.connection() as conn:
+        cert = conn.execute(CERTIFICATE_SQL +
+                            " WHERE c.certificate_id = ? AND c.status = 'ISSUED'",
+                            (job['certificate_id'],)).fetchone()
+        company = _company(conn, job['company_id'])
+    if cert is None:
+        return {"skipped": "certificate is not issued"}
+    rendered = render_pool.render(company, dict(cert))
+    with pool.connection() as conn:
+        record_rendered(conn, [rendered])
+    _, pdf, qr = rendered
+    return {"pdf_file_path": pdf, "qr_code_image_path": qr}
+
+
+render_pool = RenderPool()
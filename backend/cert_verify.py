@@ -0,0 +1,163 @@
+"""
+Public certificate verification.
+
+Every certificate gets a random verification code when it is issued; the
+QR code on the PDF points at GET /verify/{code}. Lookups go through a
+covering index on certificates(verification_code, ...) and are cached per
+process as ready-to-send JSON bytes with a strong ETag. Unknown codes are
+cached too (negative caching) with a shorter TTL, and malformed codes are
+rejected without touching the cache or the database.
+"""
+import base64
+import hashlib
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from db import pool
+from serialization import dumps
+
+VERIFY_CACHE_TTL = float(os.getenv('VERIFY_CACHE_TTL', '300'))
+VERIFY_NEGATIVE_TTL = float(os.getenv('VERIFY_NEGATIVE_TTL', '60'))
+VERIFY_CACHE_SIZE = int(os.getenv('VERIFY_CACHE_SIZE', '10000'))
+
+# 64 random bits as unpadded base32: 13 characters of A-Z and 2-7
+CODE_BYTES = 8
+CODE_PATTERN = re.compile(r'^[A-Z2-7]{13}$')
+
+VERIFY_INDEX = """CREATE INDEX IF NOT EXISTS idx_certificates_verification
+       ON certificates(verification_code, status, certificate_number, session_type,
+                       issue_date, completion_date, voided_at, student_id, session_id)"""
+
+# The UNIQUE constraint's own index would win on cost but is not covering
+VERIFY_SQL = """
+    SELECT c.certificate_number, c.status, c.session_type, c.issue_date,
+           c.completion_date, c.voided_at, s.name AS student_name,
+           st.description AS session_type_description,
+           tc.company_name, tc.training_body_reference
+    FROM certificates c INDEXED BY idx_certificates_verification
+    JOIN students s ON s.student_id = c.student_id
+    JOIN training_sessions ts ON ts.session_id = c.session_id
+    JOIN training_company tc ON tc.company_id = ts.company_id
+    JOIN session_types st ON st.session_type = c.session_type
+    WHERE c.verification_code = ?"""
+
+
+def new_verification_code():
+    return base64.b32encode(secrets.token_bytes(CODE_BYTES)).decode().rstrip('=')
+
+
+def normalise_code(code):
+    """Upper-cased code, or None if it cannot be a verification code"""
+    code = code.strip().upper()
+    return code if CODE_PATTERN.match(code) else None
+
+
+def assign_verification_codes(conn, certificate_ids):
+    """Give certificates a code in the caller's transaction; returns {certificate_id: code}"""
+    codes = {certificate_id: new_verification_code() for certificate_id in certificate_ids}
+    conn.executemany("UPDATE certificates SET verification_code = ? WHERE certificate_id = ?",
+                     [(code, certificate_id) for certificate_id, code in codes.items()])
+    return codes
+
+
+def backfill_verification_codes(conn):
+    """Codes for certificates issued before codes existed"""
+    rows = conn.execute("""SELECT certificate_id FROM certificates
+                           WHERE status != 'AVAILABLE' AND verification_code IS NULL""").fetchall()
+    if rows:
+        assign_verification_codes(conn, [row[0] for row in rows])
+        conn.commit()
+    return len(rows)
+
+
+def verification_body(row):
+    """The public JSON for one VERIFY_SQL row (None = unknown code)"""
+    if row is None:
+        return dumps({"valid": False, "detail": "Unknown verification code"})
+    return dumps({
+        "valid": row['status'] == 'ISSUED',
+        "status": row['status'],
+        "certificate_number": row['certificate_number'],
+        "session_type": row['session_type'],
+        "course": row['session_type_description'],
+        "holder": row['student_name'],
+        "issue_date": row['issue_date'],
+        "completion_date": row['completion_date'] or (row['issue_date'] or '')[:10] or None,
+        "voided_at": row['voided_at'],
+        "training_body": row['company_name'],
+        "training_body_reference": row['training_body_reference'],
+    })
+
+
+class VerificationCache:
+    """TTL + LRU map of code -> (found, body bytes, strong ETag)"""
+
+    def __init__(self, ttl=VERIFY_CACHE_TTL, negative_ttl=VERIFY_NEGATIVE_TTL,
+                 capacity=VERIFY_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, code):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(code)
+                    if value[0]:
+                        self._hits += 1
+                    else:
+                        self._negative_hits += 1
+                    return value
+                del self._entries[code]
+            self._misses += 1
+            return None
+
+    def load(self, code):
+        """Read a code from the database and cache it (blocks on the pool)"""
+        with pool.connection() as conn:
+            row = conn.execute(VERIFY_SQL, (code,)).fetchone()
+        body = verification_body(row)
+        value = (row is not None, body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+        with self._lock:
+            self._entries[code] = (time.monotonic() +
+                                   (self.ttl if row is not None else self.negative_ttl), value)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return value
+
+    def invalidate(self, code=None):
+        """Drop one code (or everything) after a certificate's status changes"""
+        with self._lock:
+            if code is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(code, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached": len(self._entries),
+                "capacity": self.capacity,
+                "hits_total": self._hits,
+                "negative_hits_total": self._negative_hits,
+                "misses_total": self._misses,
+                "evictions_total": self._evictions,
+            }
+
+
+verifications = VerificationCache()
@@ -0,0 +1,96 @@
+"""
+Incremental change feed for training sessions.
+
+training_sessions, students and student_tasks carry a change_seq column.
+Write paths call next_seq() once per transaction and stamp every row they
+touch with the result. Writers are serialised by SQLite, so sequence numbers
+grow in commit order. A client that remembers the highest change_seq it has
+seen can ask for only the rows that changed after it.
+"""
+
+from serialization import select_columns, table_columns, fetch_dicts
+
+SEQUENCE_NAME = 'session_changes'
+
+TRACKED_TABLES = ('training_sessions', 'students', 'student_tasks')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS change_sequence (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO change_sequence (name, value) VALUES ('session_changes', 0);
+
+CREATE INDEX IF NOT EXISTS idx_students_session_change ON students(session_id, change_seq);
+CREATE INDEX IF NOT EXISTS idx_student_tasks_student_change ON student_tasks(student_id, change_seq);
+"""
+
+# Columns a task delta carries unless the client asks for others
+DEFAULT_TASK_FIELDS = ['student_task_id', 'student_id', 'task_id', 'completed',
+                       'completed_at', 'notes', 'change_seq']
+
+
+def ensure_schema(conn):
+    """Add change_seq to the tracked tables and create the sequence row"""
+    for table in TRACKED_TABLES:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if 'change_seq' not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+    conn.commit()
+    conn.executescript(SCHEMA)
+
+
+def next_seq(conn):
+    """Claim the change_seq for the caller's (write) transaction"""
+    return conn.execute("""UPDATE change_sequence SET value = value + 1
+                           WHERE name = ? RETURNING value""", (SEQUENCE_NAME,)).fetchone()[0]
+
+
+def changes_since(conn, session_id, since=0, fields=None, task_fields=None):
+    """Session, student and task rows changed after `since` (0 = everything).
+
+    fields / task_fields are comma-separated column lists; student_id and
+    change_seq (plus task_id for tasks) are always included. Raises
+    ValueError for unknown columns. All reads share one snapshot, so
+    next_since is safe to pass back as the following `since`.
+    """
+    student_cols = select_columns(fields, table_columns(conn, 'students'),
+                                  ['student_id', 'change_seq'])
+    task_cols = select_columns(task_fields, table_columns(conn, 'student_tasks'),
+                               ['student_id', 'task_id', 'change_seq'], DEFAULT_TASK_FIELDS)
+
+    # Rows that predate the feed carry change_seq 0
+    floor = since if since > 0 else -1
+
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+    try:
+        next_since = conn.execute("SELECT value FROM change_sequence WHERE name = ?",
+                                  (SEQUENCE_NAME,)).fetchone()[0]
+
+        sessions = fetch_dicts(conn, """SELECT * FROM training_sessions
+                                        WHERE session_id = ? AND change_seq > ?""",
+                               (session_id, floor))
+
+        students = fetch_dicts(conn, f"""SELECT {', '.join(student_cols)} FROM students
+                                         WHERE session_id = ? AND change_seq > ?
+                                         ORDER BY change_seq, student_id""",
+                               (session_id, floor))
+
+        tasks = fetch_dicts(conn, f"""SELECT {', '.join('st.' + c for c in task_cols)}
+                                      FROM students s
+                                      JOIN student_tasks st ON st.student_id = s.student_id
+                                      WHERE s.session_id = ? AND st.change_seq > ?
+                                      ORDER BY st.change_seq, st.student_id, st.sequence""",
+                            (session_id, floor))
+    finally:
+        conn.rollback()
+
+    return {
+        "session_id": session_id,
+        "since": since,
+        "next_since": next_since,
+        "session": sessions[0] if sessions else None,
+        "students": students,
+        "tasks": tasks,
+    }
@@ -0,0 +1,160 @@
+"""
+Pooled SQLite connection layer.
+
+Connections are opened once, configured for WAL and concurrent readers, and
+handed out one per request through the `get_db` dependency in main.py.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DB_PATH = os.getenv('DB_PATH', 'training.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+
+# Applied to every new connection. journal_mode is persistent in the file,
+# the rest are per-connection.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",       # ~16MB page cache
+    "PRAGMA mmap_size = 134217728",     # 128MB memory-mapped reads
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the pool timeout"""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of pre-configured SQLite connections"""
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._timeouts = 0
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """Take a connection, opening a new one if the pool is not yet full"""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+
+        create = False
+        with self._lock:
+            if self._idle.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+
+        if create:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                started = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s")
+                with self._lock:
+                    self._waits += 1
+                    self._wait_seconds += time.perf_counter() - started
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        return conn
+
+    def release(self, conn):
+        """Return a connection, rolling back anything left uncommitted"""
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection - drop it so a fresh one is opened next time
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def open(self):
+        self._closed = False
+
+    def close(self):
+        """Close all idle connections; in-use ones are closed on release"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._created - self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "utilisation": round(self._in_use / self.size, 3) if self.size else 0,
+                "acquired_total": self._acquired,
+                "waits_total": self._waits,
+                "wait_seconds_total": round(self._wait_seconds, 4),
+                "timeouts_total": self._timeouts,
+            }
+
+
+pool = ConnectionPool()
@@ -0,0 +1,229 @@
+"""
+Live session events over server-sent events.
+
+Write endpoints publish small events (session id, change_seq, what changed)
+to per-company channels. Subscribers are asyncio queues served by the SSE
+endpoint. Every event is also appended to a shared SQLite log (events.db).
+Each worker process tails that log and delivers events published by other
+workers, so several uvicorn workers behave like one broker. The log ids are
+the SSE event ids, so a reconnecting client resumes with Last-Event-ID.
+
+Events say what changed, not the new state; clients follow up with
+GET /sessions/{id}/changes?since=<change_seq>.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+EVENT_LOG_PATH = os.getenv('EVENT_LOG_PATH', 'events.db')
+EVENT_POLL_INTERVAL = float(os.getenv('EVENT_POLL_INTERVAL', '0.25'))
+EVENT_RETENTION_SECONDS = int(os.getenv('EVENT_RETENTION_SECONDS', '900'))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '256'))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv('EVENT_HEARTBEAT_SECONDS', '15'))
+
+LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    company_id INTEGER NOT NULL,
+    event_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    origin_pid INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# Trim the shared log every N polls
+_TRIM_EVERY = 240
+
+
+class Subscription:
+    """One SSE client: a bounded queue of (event_id, event_type, payload JSON)"""
+
+    def __init__(self, company_id, session_id=None):
+        self.company_id = company_id
+        self.session_id = session_id
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.lagged = False
+
+    def wants(self, payload):
+        return self.session_id is None or payload.get('session_id') == self.session_id
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client will be told to resync rather than silently miss events
+            self.lagged = True
+
+
+class EventBus:
+    """Per-company pub/sub, fanned out across workers through events.db"""
+
+    def __init__(self, path=EVENT_LOG_PATH, poll_interval=EVENT_POLL_INTERVAL,
+                 retention=EVENT_RETENTION_SECONDS):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._channels = {}
+        self._log = None
+        self._log_lock = threading.Lock()
+        self._loop = None
+        self._tail_task = None
+        self._last_seen = 0
+        self._published = 0
+        self._delivered = 0
+        self._remote = 0
+        self._dropped = 0
+
+    # ------------------------------------------------------------------
+    # Shared log
+    # ------------------------------------------------------------------
+
+    def _open_log(self):
+        if self._log is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript(LOG_SCHEMA)
+            self._log = conn
+        return self._log
+
+    def replay(self, company_id, after_id):
+        """Logged events for a company after an event id (for Last-Event-ID)"""
+        with self._log_lock:
+            return self._open_log().execute(
+                """SELECT event_id, event_type, payload FROM events
+                   WHERE event_id > ? AND company_id = ?
+                   ORDER BY event_id""", (after_id, company_id)).fetchall()
+
+    # ------------------------------------------------------------------
+    # Publish / subscribe
+    # ------------------------------------------------------------------
+
+    def publish(self, company_id, event_type, **payload):
+        """Log an event and deliver it to this worker's subscribers.
+
+        Called after the write has committed; a failure here is logged and
+        never fails the request (clients still catch up via the change feed).
+        """
+        data = json.dumps(payload, separators=(',', ':'), default=str)
+        try:
+            with self._log_lock:
+                log = self._open_log()
+                event_id = log.execute("""INSERT INTO events
+                                          (company_id, event_type, payload, origin_pid,
+                                           created_at)
+                                          VALUES (?, ?, ?, ?, ?)""",
+                                       (company_id, event_type, data, os.getpid(),
+                                        time.time())).lastrowid
+                log.commit()
+        except Exception as e:
+            print(f"❌ Event publish failed ({event_type}): {e}")
+            return None
+        self._published += 1
+        self._dispatch(company_id, (event_id, event_type, data), payload)
+        return event_id
+
+    def _dispatch(self, company_id, event, payload):
+        subscribers = [s for s in self._channels.get(company_id, ()) if s.wants(payload)]
+        if not subscribers:
+            return
+        self._delivered += len(subscribers)
+        loop = self._loop
+        for subscription in subscribers:
+            if loop is not None and loop.is_running():
+                loop.call_soon_threadsafe(subscription.offer, event)
+            else:
+                subscription.offer(event)
+
+    def subscribe(self, company_id, session_id=None):
+        subscription = Subscription(company_id, session_id)
+        self._channels.setdefault(company_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        channel = self._channels.get(subscription.company_id)
+        if channel is not None:
+            channel.discard(subscription)
+            if subscription.lagged:
+                self._dropped += 1
+            if not channel:
+                del self._channels[subscription.company_id]
+
+    # ------------------------------------------------------------------
+    # Cross-worker tail
+    # ------------------------------------------------------------------
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        with self._log_lock:
+            row = self._open_log().execute("SELECT MAX(event_id) FROM events").fetchone()
+        self._last_seen = row[0] or 0
+        if self._tail_task is None:
+            self._tail_task = asyncio.create_task(self._tail())
+
+    async def stop(self):
+        if self._tail_task is not None:
+            self._tail_task.cancel()
+            try:
+                await self._tail_task
+            except asyncio.CancelledError:
+                pass
+            self._tail_task = None
+
+    def _poll(self, polls):
+        with self._log_lock:
+            log = self._open_log()
+            rows = log.execute("""SELECT event_id, company_id, event_type, payload, origin_pid
+                                  FROM events WHERE event_id > ? ORDER BY event_id""",
+                               (self._last_seen,)).fetchall()
+            if polls % _TRIM_EVERY == 0:
+                log.execute("DELETE FROM events WHERE created_at < ?",
+                            (time.time() - self.retention,))
+                log.commit()
+        return rows
+
+    async def _tail(self):
+        data_version = None
+        polls = 0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            polls += 1
+            try:
+                with self._log_lock:
+                    current = self._open_log().execute("PRAGMA data_version").fetchone()[0]
+                # data_version only moves when another connection commits
+                if current == data_version and polls % _TRIM_EVERY:
+                    continue
+                data_version = current
+                for row in self._poll(polls):
+                    self._last_seen = row['event_id']
+                    if row['origin_pid'] == os.getpid() or row['company_id'] not in self._channels:
+                        continue
+                    self._remote += 1
+                    self._dispatch(row['company_id'],
+                                   (row['event_id'], row['event_type'], row['payload']),
+                                   json.loads(row['payload']))
+            except Exception as e:
+                print(f"❌ Event log tail error: {e}")
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "subscribers": sum(len(c) for c in self._channels.values()),
+            "published_total": self._published,
+            "delivered_total": self._delivered,
+            "remote_total": self._remote,
+            "lagged_disconnects_total": self._dropped,
+        }
+
+
+def format_sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+event_bus = EventBus()
@@ -0,0 +1,300 @@
+"""
+1:N face search across every verified student.
+
+Student encodings are kept in one contiguous float32 matrix on disk
+(face_index/encodings.f32), memory-mapped for reads. Row N of the matrix is
+row_id N in the face_index_entries table, which holds the driver number,
+session and company. Writers claim a row_id from SQLite, write their row at
+that offset and only then commit, so several API processes can append to
+the same index and no reader ever sees an unwritten row.
+
+Search is a batched, vectorized L2 scan restricted to one company. Once
+partitions are trained (k-means centroids), only the nearest few
+partitions are scanned.
+"""
+import os
+import threading
+
+import numpy as np
+
+from db import pool
+
+FACE_INDEX_DIR = os.getenv('FACE_INDEX_DIR', 'face_index')
+FACE_INDEX_NPROBE = int(os.getenv('FACE_INDEX_NPROBE', '8'))
+# Below this many rows a full scan is fast enough and partitions are ignored
+FACE_INDEX_PARTITION_MIN_ROWS = int(os.getenv('FACE_INDEX_PARTITION_MIN_ROWS', '20000'))
+
+DIM = 128
+ROW_BYTES = DIM * 4
+SCAN_CHUNK_ROWS = 65536
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS face_index_entries (
+    row_id INTEGER PRIMARY KEY,
+    driver_number TEXT NOT NULL,
+    session_id INTEGER,
+    company_id INTEGER,
+    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_face_index_driver ON face_index_entries(driver_number);
+"""
+
+COMPANY_INDEX = """CREATE INDEX IF NOT EXISTS idx_face_index_company_driver
+       ON face_index_entries(company_id, driver_number, row_id)"""
+
+
+def _squared_distances(matrix, sq_norms, query):
+    # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, one matrix-vector product per chunk
+    return np.maximum(sq_norms - 2.0 * (matrix @ query) + float(query @ query), 0.0)
+
+
+class FaceIndex:
+    """Append-only, memory-mapped encoding matrix with top-k search"""
+
+    def __init__(self, directory=FACE_INDEX_DIR):
+        self.directory = directory
+        self.matrix_path = os.path.join(directory, 'encodings.f32')
+        self.centroids_path = os.path.join(directory, 'centroids.npy')
+        self._lock = threading.RLock()
+        self._rows = 0
+        self._matrix = None
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._driver_ids = np.empty(0, dtype=np.int32)
+        self._company_ids = np.empty(0, dtype=np.int32)
+        self._driver_lookup = {}
+        self._drivers = []
+        self._centroids = None
+        self._assign = np.empty(0, dtype=np.int32)
+        self._lists = None
+        self._searches = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.matrix_path):
+            open(self.matrix_path, 'wb').close()
+        with pool.connection() as conn:
+            conn.executescript(SCHEMA)
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(face_index_entries)")]
+            if 'company_id' not in columns:
+                # Entries from before searches were scoped to a company
+                conn.execute("ALTER TABLE face_index_entries ADD COLUMN company_id INTEGER")
+                conn.execute("""UPDATE face_index_entries SET company_id =
+                                (SELECT company_id FROM training_sessions ts
+                                 WHERE ts.session_id = face_index_entries.session_id)""")
+            conn.execute(COMPANY_INDEX)
+            conn.commit()
+        if os.path.exists(self.centroids_path):
+            self._centroids = np.load(self.centroids_path).astype(np.float32)
+        self.refresh()
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def append(self, encoding, driver_number, session_id):
+        """Add one student encoding under its session's company.
+
+        Only sessions still in progress accept new faces. Returns the row_id,
+        or None if the session is unknown or closed.
+        """
+        vector = np.asarray(encoding, dtype=np.float32).reshape(DIM)
+        with pool.connection() as conn:
+            cur = conn.execute("""INSERT INTO face_index_entries
+                                  (driver_number, session_id, company_id)
+                                  SELECT ?, session_id, company_id FROM training_sessions
+                                  WHERE session_id = ? AND status = 'IN_PROGRESS'""",
+                               (driver_number, session_id))
+            if cur.rowcount == 0:
+                conn.rollback()
+                return None
+            row_id = cur.lastrowid
+            # The vector is on disk before the row becomes visible; if this
+            # fails the rollback frees the row_id for the next writer
+            try:
+                # row_ids start at 1; row 0 of the file is row_id 1
+                with open(self.matrix_path, 'r+b') as f:
+                    f.seek((row_id - 1) * ROW_BYTES)
+                    f.write(vector.tobytes())
+                    f.flush()
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+        return row_id
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def refresh(self):
+        """Pick up rows appended since the last refresh (by any process)"""
+        with self._lock:
+            file_rows = os.path.getsize(self.matrix_path) // ROW_BYTES
+            with pool.connection() as conn:
+                new_entries = conn.execute(
+                    """SELECT row_id, driver_number, company_id FROM face_index_entries
+                       WHERE row_id > ? AND row_id <= ? ORDER BY row_id""",
+                    (self._rows, file_rows)).fetchall()
+            if not new_entries:
+                return
+
+            rows = new_entries[-1]['row_id']
+            matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r',
+                               shape=(rows, DIM))
+
+            # Rows with no metadata (a writer died mid-append) keep driver id -1
+            new_ids = np.full(rows - self._rows, -1, dtype=np.int32)
+            new_companies = np.full(rows - self._rows, -1, dtype=np.int32)
+            for entry in new_entries:
+                driver = entry['driver_number']
+                driver_id = self._driver_lookup.get(driver)
+                if driver_id is None:
+                    driver_id = len(self._drivers)
+                    self._driver_lookup[driver] = driver_id
+                    self._drivers.append(driver)
+                new_ids[entry['row_id'] - 1 - self._rows] = driver_id
+                if entry['company_id'] is not None:
+                    new_companies[entry['row_id'] - 1 - self._rows] = entry['company_id']
+
+            added = np.asarray(matrix[self._rows:rows])
+            added_norms = np.einsum('ij,ij->i', added, added)
+            # All-zero rows were never written (older indexes committed the
+            # metadata first); they are never search results
+            new_ids[added_norms == 0] = -1
+            self._sq_norms = np.concatenate([self._sq_norms, added_norms])
+            self._driver_ids = np.concatenate([self._driver_ids, new_ids])
+            self._company_ids = np.concatenate([self._company_ids, new_companies])
+            if self._centroids is not None:
+                self._assign = np.concatenate([self._assign, self._nearest_centroid(added)])
+                self._lists = None
+            self._matrix = matrix
+            self._rows = rows
+
+    def latest_encoding(self, driver_number, company_id):
+        """Most recent encoding a company indexed for a driver number, or None"""
+        with pool.connection() as conn:
+            row = conn.execute("""SELECT MAX(row_id) AS row_id FROM face_index_entries
+                                  WHERE company_id = ? AND driver_number = ?""",
+                               (company_id, driver_number)).fetchone()
+        if row is None or row['row_id'] is None:
+            return None
+        self.refresh()
+        with self._lock:
+            if row['row_id'] > self._rows:
+                return None
+            return np.array(self._matrix[row['row_id'] - 1])
+
+    def search(self, query, company_id, k=10, exclude_driver=None, max_distance=None):
+        """Top-k nearest rows of one company to query as [(row_id, distance)], closest first"""
+        self.refresh()
+        query = np.asarray(query, dtype=np.float32).reshape(DIM)
+        with self._lock:
+            self._searches += 1
+            if self._rows == 0:
+                return []
+            candidates = self._candidate_rows(query)
+            exclude_id = self._driver_lookup.get(exclude_driver, -2)
+
+            best_rows = []
+            best_dists = []
+            for start in range(0, len(candidates) if candidates is not None else self._rows,
+                               SCAN_CHUNK_ROWS):
+                if candidates is None:
+                    rows = np.arange(start, min(start + SCAN_CHUNK_ROWS, self._rows))
+                    block = self._matrix[start:start + SCAN_CHUNK_ROWS]
+                else:
+                    rows = candidates[start:start + SCAN_CHUNK_ROWS]
+                    block = self._matrix[rows]
+                dists = _squared_distances(block, self._sq_norms[rows], query)
+                dists[self._driver_ids[rows] == exclude_id] = np.inf
+                dists[self._driver_ids[rows] == -1] = np.inf
+                dists[self._company_ids[rows] != company_id] = np.inf
+
+                take = min(k, len(dists))
+                top = np.argpartition(dists, take - 1)[:take]
+                best_rows.append(rows[top])
+                best_dists.append(dists[top])
+
+        if not best_rows:
+            return []
+        rows = np.concatenate(best_rows)
+        dists = np.sqrt(np.concatenate(best_dists))
+        order = np.argsort(dists)[:k]
+        results = []
+        for i in order:
+            if not np.isfinite(dists[i]):
+                break
+            if max_distance is not None and dists[i] > max_distance:
+                break
+            results.append((int(rows[i]) + 1, float(dists[i])))
+        return results
+
+    # ------------------------------------------------------------------
+    # Coarse partitions
+    # ------------------------------------------------------------------
+
+    def _nearest_centroid(self, vectors):
+        c_norms = np.einsum('ij,ij->i', self._centroids, self._centroids)
+        return np.argmin(c_norms - 2.0 * (vectors @ self._centroids.T),
+                         axis=1).astype(np.int32)
+
+    def _candidate_rows(self, query):
+        """Rows in the nprobe nearest partitions, or None for a full scan"""
+        if self._centroids is None or self._rows < FACE_INDEX_PARTITION_MIN_ROWS:
+            return None
+        if self._lists is None:
+            order = np.argsort(self._assign, kind='stable')
+            bounds = np.searchsorted(self._assign[order],
+                                     np.arange(len(self._centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        probe = np.argsort(_squared_distances(
+            self._centroids, np.einsum('ij,ij->i', self._centroids, self._centroids),
+            query))[:FACE_INDEX_NPROBE]
+        return np.sort(np.concatenate([self._lists[p] for p in probe]))
+
+    def train_partitions(self, partitions=None, iterations=10, sample_size=20000):
+        """Fit k-means centroids over the current rows and persist them.
+
+        partitions defaults to sqrt(rows) and is capped at the sample size.
+        """
+        if partitions is not None and partitions < 1:
+            raise ValueError("partitions must be at least 1")
+        self.refresh()
+        with self._lock:
+            if self._rows == 0:
+                return 0
+            rng = np.random.default_rng(0)
+            sample_rows = np.sort(rng.choice(self._rows, min(sample_size, self._rows),
+                                             replace=False))
+            sample = np.asarray(self._matrix[sample_rows])
+            partitions = min(partitions or max(1, int(np.sqrt(self._rows))), len(sample))
+
+            centroids = sample[rng.choice(len(sample), partitions, replace=False)].copy()
+            for _ in range(iterations):
+                self._centroids = centroids
+                labels = self._nearest_centroid(sample)
+                for p in range(partitions):
+                    members = sample[labels == p]
+                    if len(members):
+                        centroids[p] = members.mean(axis=0)
+
+            self._centroids = centroids
+            np.save(self.centroids_path, centroids)
+            self._assign = np.concatenate([
+                self._nearest_centroid(np.asarray(self._matrix[s:s + SCAN_CHUNK_ROWS]))
+                for s in range(0, self._rows, SCAN_CHUNK_ROWS)])
+            self._lists = None
+            return partitions
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rows": self._rows,
+                "drivers": len(self._drivers),
+                "partitions": 0 if self._centroids is None else len(self._centroids),
+                "searches_total": self._searches,
+            }
+
+
+face_index = FaceIndex()
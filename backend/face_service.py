@@ -0,0 +1,300 @@
+"""
+Face verification worker pool.
+
+face_recognition (dlib) calls are CPU bound and take seconds on full size
+photos, so they run in a process pool instead of on the API event loop.
+Each worker loads the dlib models once at start-up. Faces are detected on a
+downscaled copy and only the padded face crop is encoded.
+"""
+import asyncio
+import functools
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import Image
+
+FACE_WORKERS = int(os.getenv('FACE_WORKERS', str(os.cpu_count() or 1)))
+FACE_QUEUE_LIMIT = int(os.getenv('FACE_QUEUE_LIMIT', str(FACE_WORKERS * 2)))
+FACE_JOB_TIMEOUT = float(os.getenv('FACE_JOB_TIMEOUT', '30'))
+
+# Detection runs on a copy whose longest side is at most FACE_DETECT_MAX_SIDE.
+# JPEGs are decoded at the smallest draft scale still covering
+# FACE_DECODE_MAX_SIDE, and the face is cropped from that. 0 = full resolution.
+FACE_DETECT_MAX_SIDE = int(os.getenv('FACE_DETECT_MAX_SIDE', '800'))
+FACE_DECODE_MAX_SIDE = int(os.getenv('FACE_DECODE_MAX_SIDE', '2000'))
+FACE_DETECT_MODEL = os.getenv('FACE_DETECT_MODEL', 'hog')  # 'hog' or 'cnn'
+FACE_DETECT_UPSAMPLE = int(os.getenv('FACE_DETECT_UPSAMPLE', '1'))
+
+
+class FaceVerificationError(Exception):
+    """Photo could not be verified (no face found, could not encode...)"""
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class ExecutorSaturated(Exception):
+    """Too many verifications queued; caller should retry later"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Face verification busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobTimeout(Exception):
+    """A verification job did not finish within FACE_JOB_TIMEOUT"""
+
+
+# ============================================================================
+# WORKER SIDE
+# ============================================================================
+
+def _init_worker():
+    """Load the dlib models once per worker process"""
+    import face_recognition
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_locations(blank)
+    face_recognition.face_encodings(blank, known_face_locations=[(0, 64, 64, 0)])
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, where the OS reports it"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def load_for_detection(image_source, detect_max_side=FACE_DETECT_MAX_SIDE,
+                       decode_max_side=FACE_DECODE_MAX_SIDE):
+    """Decode a photo (file path or bytes) and build a downscaled copy for detection.
+
+    JPEGs are decoded with draft mode so a 12MP photo is never expanded to
+    full size when decode_max_side is set. Returns (image, detect_np, scale)
+    where scale maps detection coordinates back onto image.
+    """
+    if isinstance(image_source, (bytes, bytearray)):
+        image_source = io.BytesIO(image_source)
+    image = Image.open(image_source)
+    if decode_max_side:
+        image.draft('RGB', (decode_max_side, decode_max_side))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    detect_image = image
+    longest = max(image.size)
+    if detect_max_side and longest > detect_max_side:
+        factor = -(-longest // detect_max_side)  # ceil
+        detect_image = image.reduce(factor)
+
+    scale_x = image.width / detect_image.width
+    scale_y = image.height / detect_image.height
+    return image, np.asarray(detect_image), (scale_x, scale_y)
+
+
+def map_face_box(face_location, scale, image_size, padding=0.2):
+    """Scale a detection box to the decoded image and add padding.
+
+    Returns the padded crop box (left, top, right, bottom) and the face
+    location relative to that crop.
+    """
+    img_width, img_height = image_size
+    top, right, bottom, left = face_location
+    scale_x, scale_y = scale
+    top, bottom = max(0, int(top * scale_y)), min(img_height, int(bottom * scale_y))
+    left, right = max(0, int(left * scale_x)), min(img_width, int(right * scale_x))
+
+    pad_h = int((bottom - top) * padding)
+    pad_w = int((right - left) * padding)
+
+    # Calculate padded bounds (ensure within image)
+    top_padded = max(0, top - pad_h)
+    bottom_padded = min(img_height, bottom + pad_h)
+    left_padded = max(0, left - pad_w)
+    right_padded = min(img_width, right + pad_w)
+
+    crop_box = (left_padded, top_padded, right_padded, bottom_padded)
+    face_in_crop = (top - top_padded, right - left_padded,
+                    bottom - top_padded, left - left_padded)
+    return crop_box, face_in_crop
+
+
+def encode_face(image_source, label, detect_max_side=FACE_DETECT_MAX_SIDE,
+                model=FACE_DETECT_MODEL, decode_max_side=FACE_DECODE_MAX_SIDE):
+    """Detect on a downscaled copy, then encode only the padded face crop"""
+    import face_recognition
+
+    image, detect_np, scale = load_for_detection(image_source, detect_max_side,
+                                                 decode_max_side)
+    face_locations = face_recognition.face_locations(
+        detect_np, number_of_times_to_upsample=FACE_DETECT_UPSAMPLE, model=model)
+    if len(face_locations) == 0:
+        raise FaceVerificationError(f"No face detected in {label} photo")
+
+    crop_box, face_in_crop = map_face_box(face_locations[0], scale, image.size)
+    face_np = np.asarray(image.crop(crop_box))
+
+    # The box is already known, so dlib only runs the landmark and encoding
+    # models on the crop instead of detecting again
+    encodings = face_recognition.face_encodings(face_np,
+                                                known_face_locations=[face_in_crop])
+    if len(encodings) == 0:
+        raise FaceVerificationError(f"Could not encode {label} face")
+    return encodings[0]
+
+
+def compare_faces(student_photo, license_photo, detect_max_side=FACE_DETECT_MAX_SIDE,
+                  model=FACE_DETECT_MODEL, license_encoding=None):
+    """Encode both photos (file paths or bytes) and return their face distance.
+
+    Pass license_encoding to reuse a cached licence encoding; the licence
+    photo is then not decoded at all.
+    """
+    import face_recognition
+
+    student_encoding = encode_face(student_photo, "student", detect_max_side, model)
+    if license_encoding is None:
+        license_encoding = encode_face(license_photo, "license", detect_max_side, model)
+
+    # Calculate face distance (lower is better match)
+    face_distance = float(face_recognition.face_distance(
+        [license_encoding], student_encoding)[0])
+
+    return {
+        "face_distance": face_distance,
+        "student_encoding": student_encoding,
+        "license_encoding": license_encoding,
+        "worker_peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# ============================================================================
+# API SIDE
+# ============================================================================
+
+class FaceExecutor:
+    """Process pool with a bounded admission queue and per-job timeouts"""
+
+    def __init__(self, workers=FACE_WORKERS, queue_limit=FACE_QUEUE_LIMIT,
+                 job_timeout=FACE_JOB_TIMEOUT):
+        self.workers = max(1, workers)
+        self.queue_limit = max(self.workers, queue_limit)
+        self.job_timeout = job_timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._restarts = 0
+        self._avg_seconds = 0.0
+        self._worker_peak_rss_mb = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_init_worker)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self, broken):
+        """Replace a pool that lost a worker; a broken pool rejects every job"""
+        with self._lock:
+            if self._executor is not broken:
+                return  # another request already replaced it
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_init_worker)
+            self._restarts += 1
+        print("❌ Face verification worker died, process pool restarted")
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _retry_after(self):
+        # Rough time for the current backlog to drain, in whole seconds
+        per_job = self._avg_seconds or 2.0
+        return max(1, int(per_job * self._in_flight / self.workers + 0.5))
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn in a worker, or raise ExecutorSaturated / JobTimeout"""
+        self.start()
+        with self._lock:
+            if self._in_flight >= self.queue_limit:
+                self._rejected += 1
+                raise ExecutorSaturated(self._retry_after())
+            self._in_flight += 1
+
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            # A worker that dies (OOM kill, dlib crash) breaks the whole pool;
+            # rebuild it and give the job one more go
+            for attempt in range(2):
+                executor = self._executor
+                try:
+                    future = loop.run_in_executor(executor,
+                                                  functools.partial(fn, *args, **kwargs))
+                    # A timed out job keeps its worker busy until dlib returns; it
+                    # still counts against the queue until then.
+                    result = await asyncio.wait_for(asyncio.shield(future), self.job_timeout)
+                    break
+                except BrokenProcessPool:
+                    self._restart(executor)
+                    if attempt:
+                        raise
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            future.add_done_callback(self._release)
+            raise JobTimeout(f"Face verification exceeded {self.job_timeout}s")
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            self._release()
+            raise
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._completed += 1
+            # Exponential moving average of job latency
+            self._avg_seconds = (elapsed if not self._avg_seconds
+                                 else 0.8 * self._avg_seconds + 0.2 * elapsed)
+            if isinstance(result, dict) and result.get('worker_peak_rss_mb') is not None:
+                self._worker_peak_rss_mb = max(self._worker_peak_rss_mb or 0,
+                                               result['worker_peak_rss_mb'])
+        self._release()
+        return result
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._in_flight,
+                "completed_total": self._completed,
+                "failed_total": self._failed,
+                "rejected_total": self._rejected,
+                "timed_out_total": self._timed_out,
+                "restarts_total": self._restarts,
+                "avg_job_seconds": round(self._avg_seconds, 3),
+                "worker_peak_rss_mb": self._worker_peak_rss_mb,
+            }
+
+
+face_executor = FaceExecutor()
@@ -0,0 +1,144 @@
+"""
+Persistent cache of licence face encodings.
+
+Encodings are stored in SQLite as float32 blobs keyed by driver number and
+the SHA-256 of the licence photo, with an in-process LRU in front. A repeat
+verification against the same licence photo skips detection and encoding
+for the licence side.
+
+Reads never write: hits only mark the key as used, and the marks are
+applied to last_used_at in the next put's transaction, just before the
+trim that reads them. The methods block on the connection pool, so async
+endpoints call them through the threadpool.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from db import pool
+
+FACE_CACHE_SIZE = int(os.getenv('FACE_CACHE_SIZE', '1024'))
+FACE_STORE_MAX_ROWS = int(os.getenv('FACE_STORE_MAX_ROWS', '50000'))
+
+# Trim the table back to FACE_STORE_MAX_ROWS every N inserts
+_TRIM_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS face_encodings (
+    driver_number TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    encoding BLOB NOT NULL,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    last_used_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (driver_number, content_hash)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_face_encodings_last_used ON face_encodings(last_used_at);
+"""
+
+
+def pack_encoding(encoding):
+    return np.asarray(encoding, dtype=np.float32).tobytes()
+
+
+def unpack_encoding(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class FaceEncodingStore:
+    """SQLite-backed encoding store with a bounded LRU in front"""
+
+    def __init__(self, capacity=FACE_CACHE_SIZE, max_rows=FACE_STORE_MAX_ROWS):
+        self.capacity = capacity
+        self.max_rows = max_rows
+        self._lru = OrderedDict()
+        self._touched = set()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._memory_hits = 0
+        self._db_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def ensure_schema(self):
+        with pool.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _remember(self, key, encoding):
+        with self._lock:
+            self._lru[key] = encoding
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.capacity:
+                self._lru.popitem(last=False)
+                self._evictions += 1
+
+    def get(self, driver_number, image_hash):
+        """Return the cached encoding, or None"""
+        key = (driver_number, image_hash)
+        with self._lock:
+            encoding = self._lru.get(key)
+            if encoding is not None:
+                self._lru.move_to_end(key)
+                self._touched.add(key)
+                self._memory_hits += 1
+                return encoding
+
+        with pool.connection() as conn:
+            row = conn.execute("""SELECT encoding FROM face_encodings
+                                  WHERE driver_number = ? AND content_hash = ?""",
+                               key).fetchone()
+
+        if row is None:
+            with self._lock:
+                self._misses += 1
+            return None
+
+        encoding = unpack_encoding(row['encoding'])
+        with self._lock:
+            self._touched.add(key)
+            self._db_hits += 1
+        self._remember(key, encoding)
+        return encoding
+
+    def put(self, driver_number, image_hash, encoding):
+        key = (driver_number, image_hash)
+        blob = pack_encoding(encoding)
+        with pool.connection() as conn:
+            conn.execute("""INSERT OR REPLACE INTO face_encodings
+                            (driver_number, content_hash, encoding)
+                            VALUES (?, ?, ?)""", (driver_number, image_hash, blob))
+            with self._lock:
+                self._puts += 1
+                trim = self._puts % _TRIM_EVERY == 0
+                touched, self._touched = self._touched, set()
+            touched.discard(key)
+            if touched:
+                conn.executemany("""UPDATE face_encodings SET last_used_at = datetime('now')
+                                    WHERE driver_number = ? AND content_hash = ?""",
+                                 list(touched))
+            if trim:
+                conn.execute("""DELETE FROM face_encodings
+                                WHERE (driver_number, content_hash) IN (
+                                    SELECT driver_number, content_hash FROM face_encodings
+                                    ORDER BY last_used_at
+                                    LIMIT max(0, (SELECT COUNT(*) FROM face_encodings) - ?))""",
+                             (self.max_rows,))
+            conn.commit()
+        self._remember(key, unpack_encoding(blob))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "cached": len(self._lru),
+                "pending_touches": len(self._touched),
+                "memory_hits_total": self._memory_hits,
+                "db_hits_total": self._db_hits,
+                "misses_total": self._misses,
+                "evictions_total": self._evictions,
+            }
+
+
+face_store = FaceEncodingStore()
@@ -0,0 +1,186 @@
+"""
+Password hashing off the event loop, with login admission control.
+
+bcrypt releases the GIL, so verification runs on a small thread pool instead
+of blocking the event loop. The pool has a bounded admission queue. Each
+login attempt is also checked against two token buckets before any hashing:
+
+- one per client IP, spent on every attempt;
+- one per email address, spent only on failed attempts.
+
+Credential-stuffing bursts therefore get 429s cheaply instead of queueing
+behind (and starving) real sign-ins.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv('PASSWORD_QUEUE_LIMIT', str(PASSWORD_WORKERS * 8)))
+
+# Burst size and refill period (seconds) for each bucket
+LOGIN_IP_BURST = int(os.getenv('LOGIN_IP_BURST', '30'))
+LOGIN_IP_PERIOD = float(os.getenv('LOGIN_IP_PERIOD', '60'))
+LOGIN_EMAIL_BURST = int(os.getenv('LOGIN_EMAIL_BURST', '5'))
+LOGIN_EMAIL_PERIOD = float(os.getenv('LOGIN_EMAIL_PERIOD', '300'))
+
+# Buckets tracked per process; the least recently seen are dropped first
+_MAX_TRACKED_KEYS = 10000
+
+
+class LoginThrottled(Exception):
+    """Too many attempts from this IP or against this account"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many login attempts, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class HasherSaturated(Exception):
+    """The password pool's admission queue is full"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Login service busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Buckets:
+    """Token buckets keyed by string, refilled continuously"""
+
+    def __init__(self, burst, period):
+        self.burst = burst
+        self.rate = burst / period
+        self._buckets = OrderedDict()
+
+    def _level(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > _MAX_TRACKED_KEYS:
+            self._buckets.popitem(last=False)
+        return tokens
+
+    def wait_time(self, key, now):
+        """Seconds until one token is available (0 if available now)"""
+        tokens = self._level(key, now)
+        return 0 if tokens >= 1 else max(1, int((1 - tokens) / self.rate + 0.999))
+
+    def spend(self, key, now):
+        tokens = self._level(key, now)
+        self._buckets[key] = (max(0.0, tokens - 1), now)
+
+    def refill(self, key):
+        self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoginThrottle:
+    """Per-IP and per-email admission control for /auth/login"""
+
+    def __init__(self, ip_burst=LOGIN_IP_BURST, ip_period=LOGIN_IP_PERIOD,
+                 email_burst=LOGIN_EMAIL_BURST, email_period=LOGIN_EMAIL_PERIOD):
+        self._ips = _Buckets(ip_burst, ip_period)
+        self._emails = _Buckets(email_burst, email_period)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._throttled = 0
+
+    def admit(self, ip, email):
+        """Spend an IP token, or raise LoginThrottled"""
+        email = email.lower()
+        now = time.monotonic()
+        with self._lock:
+            wait = max(self._ips.wait_time(ip, now), self._emails.wait_time(email, now))
+            if wait:
+                self._throttled += 1
+                raise LoginThrottled(wait)
+            self._ips.spend(ip, now)
+            self._admitted += 1
+
+    def record_failure(self, email):
+        with self._lock:
+            self._emails.spend(email.lower(), time.monotonic())
+
+    def record_success(self, email):
+        with self._lock:
+            self._emails.refill(email.lower())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "admitted_total": self._admitted,
+                "throttled_total": self._throttled,
+                "tracked_ips": len(self._ips),
+                "tracked_emails": len(self._emails),
+            }
+
+
+class PasswordHasher:
+    """Bounded thread pool for bcrypt work"""
+
+    def __init__(self, workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT):
+        self.workers = max(1, workers)
+        self.queue_limit = max(self.workers, queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._avg_seconds = 0.0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="bcrypt")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _retry_after(self):
+        per_job = self._avg_seconds or 0.25
+        return max(1, int(per_job * self._in_flight / self.workers + 0.5))
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn on the pool, or raise HasherSaturated"""
+        self.start()
+        with self._lock:
+            if self._in_flight >= self.queue_limit:
+                self._rejected += 1
+                raise HasherSaturated(self._retry_after())
+            self._in_flight += 1
+
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+                self._avg_seconds = (elapsed if not self._avg_seconds
+                                     else 0.8 * self._avg_seconds + 0.2 * elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._in_flight,
+                "completed_total": self._completed,
+                "rejected_total": self._rejected,
+                "avg_job_ms": round(self._avg_seconds * 1000, 1),
+            }
+
+
+login_throttle = LoginThrottle()
+password_hasher = PasswordHasher()
@@ -1,27 +1,48 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, status
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi import Form, BackgroundTasks
+from fastapi import Form
 from pydantic import BaseModel, EmailStr
 from typing import List, Optional
-import face_recognition
-import numpy as np
-from PIL import Image
-import io
 import sqlite3
 from datetime import datetime, timedelta
 import json
+import time
+import asyncio
+import base64
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 import secrets
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-import qrcode
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 import os
+from db import pool, PoolTimeout
+from face_service import (face_executor, compare_faces, FaceVerificationError,
+                          ExecutorSaturated, JobTimeout, peak_rss_mb)
+from face_store import face_store
+from photo_store import store_upload, PhotoTooLarge
+from write_behind import write_queue
+from template_cache import task_templates
+from cert_allocator import (AVAILABLE_INDEX, begin_immediate, next_available,
+                            issue_to_passing_students, create_batches, RangeOverlap)
+from face_index import face_index
+import stats_rollup
+import change_feed
+from event_bus import event_bus, format_sse, EVENT_HEARTBEAT_SECONDS
+from serialization import (FastJSONResponse, fetch_dicts, stream_json, select_columns)
+from principal_cache import principals
+from cert_render import render_pool, render_job
+from cert_mailer import mailer, email_batch_job, EMAIL_BATCH_SIZE
+import cert_jobs
+from cert_jobs import job_runner
+from audit import audit, AuditContextMiddleware, changed_values
+from cert_verify import (verifications, normalise_code, backfill_verification_codes,
+                         VERIFY_INDEX, VERIFY_CACHE_TTL, VERIFY_NEGATIVE_TTL)
+from login_guard import (login_throttle, password_hasher, LoginThrottled,
+                         HasherSaturated)
 
 load_dotenv
 
@@ -31,8 +52,11 @@ app = FastAPI(title="Motorcycle Training Backend")
 SECRET_KEY = os.getenv('SECRET_KEY', secrets.token_urlsafe(32))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes at any other cost are upgraded on the next successful login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=BCRYPT_ROUNDS)
 security = HTTPBearer()
 
 # Enable CORS
@@ -45,15 +69,123 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Client address for audit entries recorded while handling the request
+app.add_middleware(AuditContextMiddleware)
+
 # ============================================================================
 # DATABASE HELPERS
 # ============================================================================
 
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect('training.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Yield a pooled database connection for the duration of a request.
+
+    FastAPI caches dependencies per request, so the auth dependencies and the
+    endpoint share the same connection.
+    """
+    try:
+        conn = pool.acquire()
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@app.on_event("startup")
+def open_db_pool():
+    pool.open()
+
+@app.on_event("shutdown")
+def close_db_pool():
+    # The certificate job workers, the audit flusher and the write-behind
+    # queue draw from the pool; stop them first
+    job_runner.stop()
+    mailer.close()
+    audit.stop()
+    write_queue.stop()
+    pool.close()
+
+# Idempotent DDL applied at start-up; this, not Schema.sql, is where these
+# live, so fresh and existing databases get the same definitions
+SCHEMA_UPGRADES = [
+    """CREATE INDEX IF NOT EXISTS idx_student_tasks_student_task_completed
+       ON student_tasks(student_id, task_id, completed)""",
+    """CREATE TABLE IF NOT EXISTS config_versions (
+           name TEXT PRIMARY KEY,
+           version INTEGER NOT NULL DEFAULT 0
+       )""",
+    "INSERT OR IGNORE INTO config_versions (name, version) VALUES ('task_configuration', 0)",
+    AVAILABLE_INDEX,
+    # Batch counters are maintained by cert_allocator in one statement per batch
+    "DROP TRIGGER IF EXISTS decrement_certificate_count",
+    # Keyset pagination for the admin listings, newest first
+    """CREATE INDEX IF NOT EXISTS idx_sessions_company_created
+       ON training_sessions(company_id, created_at, session_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_sessions_company_status_created
+       ON training_sessions(company_id, status, created_at, session_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_sessions_instructor_created
+       ON training_sessions(instructor_id, created_at, session_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_users_company_created
+       ON users(company_id, created_at, user_id)""",
+    # Public QR verification lookups
+    VERIFY_INDEX,
+]
+
+@app.on_event("startup")
+def apply_schema_upgrades():
+    with pool.connection() as conn:
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(statement)
+        conn.commit()
+        stats_rollup.ensure_schema(conn)
+        change_feed.ensure_schema(conn)
+        cert_jobs.ensure_schema(conn)
+        backfill_verification_codes(conn)
+
+@app.on_event("startup")
+def start_face_executor():
+    face_executor.start()
+    face_store.ensure_schema()
+    face_index.open()
+
+@app.on_event("shutdown")
+def stop_face_executor():
+    face_executor.shutdown()
+
+@app.on_event("startup")
+def start_render_pool():
+    render_pool.start()
+
+@app.on_event("shutdown")
+def stop_render_pool():
+    render_pool.shutdown()
+
+job_runner.register('render', render_job)
+job_runner.register('email', email_batch_job, batch_size=EMAIL_BATCH_SIZE)
+
+@app.on_event("startup")
+def start_job_runner():
+    job_runner.start()
+
+@app.on_event("startup")
+def start_audit_flusher():
+    audit.start()
+
+@app.on_event("startup")
+async def start_event_bus():
+    event_bus.start()
+
+@app.on_event("shutdown")
+async def stop_event_bus():
+    await event_bus.stop()
+
+@app.on_event("startup")
+def start_password_hasher():
+    password_hasher.start()
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    password_hasher.shutdown()
 
 # ============================================================================
 # AUTHENTICATION MODELS
@@ -86,6 +218,11 @@ class CertificateBatch(BaseModel):
     start_certificate_number: int
     batch_size: int = 25
 
+class CertificateBatchImport(BaseModel):
+    batches: List[CertificateBatch]
+
+MAX_IMPORT_CERTIFICATES = 10000
+
 # ============================================================================
 # SESSION MODELS
 # ============================================================================
@@ -121,11 +258,23 @@ class StudentCreate(BaseModel):
     calculated_age: Optional[int] = None
     license_valid: Optional[bool] = None
 
+class StudentBatchCreate(BaseModel):
+    students: List[StudentCreate]
+
+MAX_ENROLMENT_BATCH = 50
+
 class TaskComplete(BaseModel):
     task_id: str
     completed: bool
     notes: Optional[str] = None
 
+class SessionTasksComplete(BaseModel):
+    # Either a single task_id or a list of task_ids (or both)
+    task_id: Optional[str] = None
+    task_ids: List[str] = []
+    completed: bool
+    notes: Optional[str] = None
+
 # ============================================================================
 # AUTH HELPERS
 # ============================================================================
@@ -142,6 +291,14 @@ def get_password_hash(password):
         password = password[:72]
     return pwd_context.hash(password)
 
+def check_password(plain_password, hashed_password):
+    """(valid, replacement hash or None); runs on the password pool"""
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if pwd_context.needs_update(hashed_password):
+        return True, get_password_hash(plain_password)
+    return True, None
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -149,7 +306,8 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security),
+                     conn: sqlite3.Connection = Depends(get_db)):
     try:
         token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -157,16 +315,20 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication")
         
-        conn = get_db()
+        user = principals.get(user_id)
+        if user is not None:
+            return user
+        
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         user = c.fetchone()
-        conn.close()
         
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         
-        return dict(user)
+        return principals.put(user)
+    except HTTPException:
+        raise
     except jwt.ExpiredSignatureError as e:
         print(f"=== TOKEN EXPIRED: {e} ===")
         raise HTTPException(status_code=401, detail="Token expired")
@@ -200,25 +362,45 @@ async def root():
     }
 
 @app.get("/health")
-async def health():
+def health():
     try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT 1")
-        conn.close()
-        return {"status": "healthy", "database": "connected"}
+        with pool.connection() as conn:
+            conn.execute("SELECT 1")
+        return {"status": "healthy", "database": "connected", "db_pool": pool.stats()}
     except Exception as e:
-        return {"status": "unhealthy", "error": str(e)}
+        return {"status": "unhealthy", "error": str(e), "db_pool": pool.stats()}
+
+@app.get("/metrics")
+def metrics():
+    """Runtime utilisation metrics for the backend subsystems"""
+    return {
+        "api_peak_rss_mb": peak_rss_mb(),
+        "db_pool": pool.stats(),
+        "face_executor": face_executor.stats(),
+        "face_store": face_store.stats(),
+        "face_index": face_index.stats(),
+        "write_queue": write_queue.stats(),
+        "task_templates": task_templates.stats(),
+        "principal_cache": principals.stats(),
+        "password_hasher": password_hasher.stats(),
+        "login_throttle": login_throttle.stats(),
+        "event_bus": event_bus.stats(),
+        "cert_render": render_pool.stats(),
+        "certificate_jobs": job_runner.stats(),
+        "mailer": mailer.stats(),
+        "verify_cache": verifications.stats(),
+        "audit": audit.stats()
+    }
 
 # ============================================================================
 # AUTHENTICATION ENDPOINTS
 # ============================================================================
 
 @app.post("/auth/register", response_model=Token)
-async def register(user: UserRegister, current_admin: dict = Depends(require_admin)):
+async def register(user: UserRegister, current_admin: dict = Depends(require_admin),
+                   conn: sqlite3.Connection = Depends(get_db)):
     """Register a new user (admin or instructor). Requires admin access."""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         # Check if email already exists
@@ -252,7 +434,6 @@ async def register(user: UserRegister, current_admin: dict = Depends(require_adm
         # Get created user
         c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         new_user = dict(c.fetchone())
-        conn.close()
         
         # Create token
         access_token = create_access_token({"sub": str(user_id)})
@@ -271,30 +452,51 @@ async def register(user: UserRegister, current_admin: dict = Depends(require_adm
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Registration error: {str(e)}")
 
+def _active_user_by_email(email):
+    with pool.connection() as conn:
+        return conn.execute("SELECT * FROM users WHERE email = ? AND status = 'ACTIVE'",
+                            (email,)).fetchone()
+
+def _record_login(user_id, new_hash):
+    """Update last login, upgrading the hash if the configured cost changed"""
+    with pool.connection() as conn:
+        if new_hash:
+            conn.execute("UPDATE users SET last_login = ?, password_hash = ? WHERE user_id = ?",
+                         (datetime.now().isoformat(), new_hash, user_id))
+        else:
+            conn.execute("UPDATE users SET last_login = ? WHERE user_id = ?",
+                         (datetime.now().isoformat(), user_id))
+        conn.commit()
+
 @app.post("/auth/login", response_model=Token)
-async def login(credentials: UserLogin):
-    """Login with email and password"""
-    # In the login function, add these lines:
+async def login(credentials: UserLogin, request: Request):
+    """Login with email and password.
+
+    No pooled connection is held while bcrypt runs: the user row is read on
+    one short-lived connection and last_login written on another.
+    """
     try:
-        conn = get_db()
-        c = conn.cursor()
+        client_ip = request.client.host if request.client else "unknown"
+        login_throttle.admit(client_ip, credentials.email)
         
         # Get user by email
-        c.execute("SELECT * FROM users WHERE email = ? AND status = 'ACTIVE'", 
-                  (credentials.email,))
-        user = c.fetchone()
-        
-        if not user or not verify_password(credentials.password, user['password_hash']):
+        user = await run_in_threadpool(_active_user_by_email, credentials.email)
+        
+        # bcrypt runs on the password pool, not the event loop
+        valid, new_hash = False, None
+        if user:
+            valid, new_hash = await password_hasher.run(check_password, credentials.password,
+                                                        user['password_hash'])
+        if not valid:
+            login_throttle.record_failure(credentials.email)
             raise HTTPException(
                 status_code=401,
                 detail="Incorrect email or password"
             )
+        login_throttle.record_success(credentials.email)
         
-        # Update last login
-        c.execute("UPDATE users SET last_login = ? WHERE user_id = ?",
-                  (datetime.now().isoformat(), user['user_id']))
-        conn.commit()
-        conn.close()
+        await run_in_threadpool(_record_login, user['user_id'], new_hash)
+        principals.invalidate(user['user_id'])
         
         # Create token
         access_token = create_access_token({"sub": str(user['user_id'])})
@@ -309,6 +511,11 @@ async def login(credentials: UserLogin):
             "user": user_dict
         }
         
+    except (LoginThrottled, HasherSaturated) as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
     except HTTPException:
         raise
     except Exception as e:
@@ -326,15 +533,14 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 # ============================================================================
 
 @app.get("/company")
-async def get_company(current_user: dict = Depends(get_current_user)):
+async def get_company(current_user: dict = Depends(get_current_user),
+                      conn: sqlite3.Connection = Depends(get_db)):
     """Get company information"""
     try:
-        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM training_company WHERE company_id = ?", 
                   (current_user['company_id'],))
         company = c.fetchone()
-        conn.close()
         
         if not company:
             raise HTTPException(status_code=404, detail="Company not found")
@@ -344,10 +550,10 @@ async def get_company(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/company")
-async def update_company(company_data: dict, current_admin: dict = Depends(require_admin)):
+async def update_company(company_data: dict, current_admin: dict = Depends(require_admin),
+                         conn: sqlite3.Connection = Depends(get_db)):
     """Update company information (admin only)"""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         # Build update query dynamically
@@ -356,22 +562,32 @@ async def update_company(company_data: dict, current_admin: dict = Depends(requi
         
         updates = []
         values = []
+        new_values = {}
         for field in allowed_fields:
             if field in company_data:
                 updates.append(f"{field} = ?")
                 values.append(company_data[field])
+                new_values[field] = company_data[field]
+        
+        c.execute("SELECT * FROM training_company WHERE company_id = ?",
+                  (current_admin['company_id'],))
+        before = c.fetchone()
         
         if updates:
             values.append(current_admin['company_id'])
             query = f"UPDATE training_company SET {', '.join(updates)} WHERE company_id = ?"
             c.execute(query, values)
             conn.commit()
+            
+            old, new = changed_values(before, new_values)
+            if new:
+                audit.record('UPDATE', 'training_company', current_admin['company_id'],
+                             old, new, user_id=current_admin['user_id'])
         
         # Get updated company
         c.execute("SELECT * FROM training_company WHERE company_id = ?", 
                   (current_admin['company_id'],))
         company = dict(c.fetchone())
-        conn.close()
         
         return company
     except Exception as e:
@@ -383,88 +599,80 @@ async def update_company(company_data: dict, current_admin: dict = Depends(requi
 
 @app.post("/certificates/batch")
 async def create_certificate_batch(batch: CertificateBatch, 
-                                   current_admin: dict = Depends(require_admin)):
+                                   current_admin: dict = Depends(require_admin),
+                                   conn: sqlite3.Connection = Depends(get_db)):
     """Create a new certificate batch (admin only)"""
+    created = import_certificate_batches(conn, current_admin, [batch])[0]
+    return {
+        "batch_id": created['batch_id'],
+        "start_number": created['start_number'],
+        "end_number": created['end_number'],
+        "total_certificates": created['total_certificates'],
+        "status": "success"
+    }
+
+@app.post("/certificates/batches/import")
+async def import_certificate_batch_list(payload: CertificateBatchImport,
+                                        current_admin: dict = Depends(require_admin),
+                                        conn: sqlite3.Connection = Depends(get_db)):
+    """Create several certificate batches in one transaction (admin only)"""
+    created = import_certificate_batches(conn, current_admin, payload.batches)
+    return {
+        "status": "success",
+        "batches": created,
+        "total_certificates": sum(b['total_certificates'] for b in created)
+    }
+
+def import_certificate_batches(conn, admin, batches):
+    """Validate and create batches; all or nothing"""
+    if not batches:
+        raise HTTPException(status_code=400, detail="No batches supplied")
+    if any(b.batch_size < 1 or b.start_certificate_number < 1 for b in batches):
+        raise HTTPException(status_code=400,
+                            detail="Certificate numbers and batch sizes must be positive")
+    if sum(b.batch_size for b in batches) > MAX_IMPORT_CERTIFICATES:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {MAX_IMPORT_CERTIFICATES} certificates per request")
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        end_number = batch.start_certificate_number + batch.batch_size - 1
-        
-        # Insert batch
-        c.execute("""INSERT INTO certificate_batches 
-                     (company_id, session_type, start_certificate_number, end_certificate_number,
-                      batch_size, current_certificate_number, certificates_remaining, status,
-                      received_by, received_date)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, 'ACTIVE', ?, ?)""",
-                  (current_admin['company_id'], batch.session_type,
-                   batch.start_certificate_number, end_number, batch.batch_size,
-                   batch.start_certificate_number, batch.batch_size,
-                   current_admin['user_id'], datetime.now().isoformat()))
-        
-        batch_id = c.lastrowid
-        
-        # Create individual certificates
-        for cert_num in range(batch.start_certificate_number, end_number + 1):
-            c.execute("""INSERT INTO certificates 
-                         (batch_id, certificate_number, session_type, status)
-                         VALUES (?, ?, ?, 'AVAILABLE')""",
-                      (batch_id, cert_num, batch.session_type))
-        
+        begin_immediate(conn)
+        created = create_batches(conn, admin['company_id'],
+                                 [(b.session_type, b.start_certificate_number, b.batch_size)
+                                  for b in batches],
+                                 admin['user_id'])
         conn.commit()
-        conn.close()
-        
-        return {
-            "batch_id": batch_id,
-            "start_number": batch.start_certificate_number,
-            "end_number": end_number,
-            "total_certificates": batch.batch_size,
-            "status": "success"
-        }
+        return created
+    except RangeOverlap as e:
+        conn.rollback()
+        raise HTTPException(status_code=409,
+                            detail={"message": str(e), "conflicts": e.conflicts})
     except Exception as e:
+        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/certificates/inventory")
-async def get_certificate_inventory(current_user: dict = Depends(get_current_user)):
+async def get_certificate_inventory(current_user: dict = Depends(get_current_user),
+                                    conn: sqlite3.Connection = Depends(get_db)):
     """Get certificate inventory status"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute("""SELECT cb.*, st.description as session_type_description
-                     FROM certificate_batches cb
-                     JOIN session_types st ON cb.session_type = st.session_type
-                     WHERE cb.company_id = ? AND cb.status = 'ACTIVE'
-                     ORDER BY cb.session_type, cb.start_certificate_number""",
-                  (current_user['company_id'],))
-        
-        batches = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return {"batches": batches}
+        batches = fetch_dicts(conn, """SELECT cb.*, st.description as session_type_description
+                                       FROM certificate_batches cb
+                                       JOIN session_types st ON cb.session_type = st.session_type
+                                       WHERE cb.company_id = ? AND cb.status = 'ACTIVE'
+                                       ORDER BY cb.session_type, cb.start_certificate_number""",
+                              (current_user['company_id'],))
+        
+        return FastJSONResponse({"batches": batches})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/certificates/next/{session_type}")
 async def get_next_certificate(session_type: str, 
-                               current_instructor: dict = Depends(require_instructor)):
+                               current_instructor: dict = Depends(require_instructor),
+                               conn: sqlite3.Connection = Depends(get_db)):
     """Get next available certificate for a session type"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
         # Get next available certificate
-        c.execute("""SELECT c.*, cb.certificates_remaining
-                     FROM certificates c
-                     JOIN certificate_batches cb ON c.batch_id = cb.batch_id
-                     WHERE c.session_type = ? AND c.status = 'AVAILABLE'
-                     AND cb.company_id = ? AND cb.status = 'ACTIVE'
-                     ORDER BY c.certificate_number
-                     LIMIT 1""",
-                  (session_type, current_instructor['company_id']))
-        
-        cert = c.fetchone()
-        conn.close()
+        cert = next_available(conn, current_instructor['company_id'], session_type)
         
         if not cert:
             raise HTTPException(status_code=404, 
@@ -480,24 +688,32 @@ async def get_next_certificate(session_type: str,
 # SESSION MANAGEMENT
 # ============================================================================
 
+# Projection shared by the session listings and detail view
+SESSION_COLUMNS = ', '.join('s.' + column for column in (
+    'session_id', 'instructor_id', 'company_id', 'session_type', 'session_date',
+    'location', 'site_code', 'notes', 'status', 'created_at', 'completed_at', 'change_seq'))
+
 @app.post("/sessions")
 async def create_session(session: SessionCreate,
-                        current_instructor: dict = Depends(require_instructor)):
+                        current_instructor: dict = Depends(require_instructor),
+                         conn: sqlite3.Connection = Depends(get_db)):
     """Create a new training session"""
     try:
-        conn = get_db()
         c = conn.cursor()
+        change_seq = change_feed.next_seq(conn)
         
         c.execute("""INSERT INTO training_sessions
                      (instructor_id, company_id, session_type, session_date,
-                      location, site_code, notes, status)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, 'IN_PROGRESS')""",
+                      location, site_code, notes, status, change_seq)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, 'IN_PROGRESS', ?)""",
                   (current_instructor['user_id'], current_instructor['company_id'],
                    session.session_type, datetime.now().date().isoformat(),
-                   session.location, session.site_code, session.notes))
+                   session.location, session.site_code, session.notes, change_seq))
         
         session_id = c.lastrowid
         conn.commit()
+        event_bus.publish(current_instructor['company_id'], 'session_created',
+                          session_id=session_id, change_seq=change_seq)
         
         # Get created session
         c.execute("""SELECT s.*, u.name as instructor_name
@@ -506,78 +722,238 @@ async def create_session(session: SessionCreate,
                      WHERE s.session_id = ?""", (session_id,))
         
         new_session = dict(c.fetchone())
-        conn.close()
         
         return new_session
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/sessions/active")
-async def get_active_sessions(current_instructor: dict = Depends(require_instructor)):
+async def get_active_sessions(current_instructor: dict = Depends(require_instructor),
+                              conn: sqlite3.Connection = Depends(get_db)):
     """Get instructor's active sessions"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute("""SELECT s.*, u.name as instructor_name,
-                     COUNT(DISTINCT st.student_id) as student_count
-                     FROM training_sessions s
-                     JOIN users u ON s.instructor_id = u.user_id
-                     LEFT JOIN students st ON s.session_id = st.session_id
-                     WHERE s.instructor_id = ? AND s.status = 'IN_PROGRESS'
-                     GROUP BY s.session_id
-                     ORDER BY s.created_at DESC""",
-                  (current_instructor['user_id'],))
-        
-        sessions = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return {"sessions": sessions}
+        return stream_json(conn, f"""SELECT {SESSION_COLUMNS}, u.name as instructor_name,
+                                     (SELECT COUNT(*) FROM students st
+                                      WHERE st.session_id = s.session_id) as student_count
+                                     FROM training_sessions s
+                                     JOIN users u ON s.instructor_id = u.user_id
+                                     WHERE s.instructor_id = ? AND s.status = 'IN_PROGRESS'
+                                     ORDER BY s.created_at DESC""",
+                           (current_instructor['user_id'],), "sessions")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/sessions/{session_id}")
-async def get_session(session_id: int, current_user: dict = Depends(get_current_user)):
-    """Get session details"""
+async def get_session(session_id: int, fields: Optional[str] = None,
+                      current_user: dict = Depends(get_current_user),
+                      conn: sqlite3.Connection = Depends(get_db)):
+    """Get session details.
+
+    Students are streamed; ?fields= (comma-separated) limits their columns.
+    """
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute("""SELECT s.*, u.name as instructor_name
-                     FROM training_sessions s
-                     JOIN users u ON s.instructor_id = u.user_id
-                     WHERE s.session_id = ?""", (session_id,))
-        
-        session = c.fetchone()
-        if not session:
+        sessions = fetch_dicts(conn, f"""SELECT {SESSION_COLUMNS}, u.name as instructor_name
+                                         FROM training_sessions s
+                                         JOIN users u ON s.instructor_id = u.user_id
+                                         WHERE s.session_id = ?""", (session_id,))
+        if not sessions:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        session_dict = dict(session)
+        try:
+            columns = select_columns(fields, student_columns(conn), ['student_id'])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Get students in session
-        c.execute("""SELECT * FROM students WHERE session_id = ?
-                     ORDER BY created_at""", (session_id,))
-        students = [dict(row) for row in c.fetchall()]
-        
-        session_dict['students'] = students
-        conn.close()
+        return stream_json(conn, f"""SELECT {', '.join(columns)} FROM students
+                                     WHERE session_id = ?
+                                     ORDER BY created_at""",
+                           (session_id,), "students", head=sessions[0])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/sessions/{session_id}/changes")
+async def get_session_changes(session_id: int, since: int = Query(0, ge=0),
+                              fields: Optional[str] = None,
+                              task_fields: Optional[str] = None,
+                              current_user: dict = Depends(get_current_user),
+                              conn: sqlite3.Connection = Depends(get_db)):
+    """Rows of a session changed since a change_seq.
+
+    Pass the returned next_since as ?since= on the next poll; since=0 returns
+    the full session. fields / task_fields limit the student and task columns
+    returned (comma-separated).
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM training_sessions WHERE session_id = ? AND company_id = ?",
+                  (session_id, current_user['company_id']))
+        if not c.fetchone():
+            raise HTTPException(status_code=404, detail="Session not found")
         
-        return session_dict
+        return FastJSONResponse(change_feed.changes_since(conn, session_id, since,
+                                                          fields, task_fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/events/stream")
+async def stream_events(request: Request, session_id: Optional[int] = None,
+                        credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Server-sent events for the caller's company (or one session).
+
+    Authenticates on a briefly borrowed connection, so an open stream does
+    not hold a pool slot. Resumes from the Last-Event-ID header; sends a
+    `resync` event and closes if the client falls too far behind.
+    """
+    def authenticate():
+        with pool.connection() as conn:
+            return get_current_user(credentials, conn)
+    
+    try:
+        current_user = await run_in_threadpool(authenticate)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, please retry")
+    
+    company_id = current_user['company_id']
+    last_event_id = request.headers.get('last-event-id', '')
+    subscription = event_bus.subscribe(company_id, session_id)
+    
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            last_sent = 0
+            if last_event_id.isdigit():
+                for row in event_bus.replay(company_id, int(last_event_id)):
+                    if subscription.wants(json.loads(row['payload'])):
+                        last_sent = row['event_id']
+                        yield format_sse(row['event_id'], row['event_type'], row['payload'])
+            
+            while not subscription.lagged:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(),
+                                                   EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                # Already sent during replay
+                if event[0] <= last_sent:
+                    continue
+                last_sent = event[0]
+                yield format_sse(*event)
+            yield "event: resync\ndata: {}\n\n"
+        finally:
+            event_bus.unsubscribe(subscription)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache",
+                                      "X-Accel-Buffering": "no"})
+
 # ============================================================================
 # STUDENT MANAGEMENT
 # ============================================================================
 
+_student_columns = None
+
+def student_columns(conn):
+    """Column names of the students table (read once per process)"""
+    global _student_columns
+    if _student_columns is None:
+        _student_columns = [d[0] for d in conn.execute("SELECT * FROM students LIMIT 0").description]
+    return _student_columns
+
+def enroll_students(conn: sqlite3.Connection, session, students: List[StudentCreate]) -> List[dict]:
+    """Insert students and their task checklists in one transaction.
+
+    The created rows are built from the inserted values rather than read
+    back, so the caller gets the same shape as SELECT * without extra queries.
+    """
+    c = conn.cursor()
+    session_type = session['session_type']
+    
+    # Task template for this session type, from the in-process cache
+    template = task_templates.get(conn, session_type)
+    
+    # Same format as the datetime('now') column default
+    created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    columns = student_columns(conn)
+    change_seq = change_feed.next_seq(conn)
+    
+    created = []
+    for student in students:
+        values = {
+            "session_id": session['session_id'],
+            "name": student.name,
+            "license_number": student.license_number,
+            "email": student.email,
+            "phone": student.phone,
+            "date_of_birth": student.date_of_birth,
+            "bike_type": student.bike_type,
+            "student_photo_path": student.student_photo_path,
+            "license_photo_path": student.license_photo_path,
+            "created_at": created_at,
+            "change_seq": change_seq
+        }
+        c.execute(f"""INSERT INTO students ({', '.join(values)})
+                      VALUES ({', '.join('?' * len(values))})""", list(values.values()))
+        row = dict.fromkeys(columns)
+        row.update(values)
+        row['student_id'] = c.lastrowid
+        row['verified'] = 0
+        row['tasks'] = []
+        created.append(row)
+    
+    # All task rows in multi-row INSERTs; RETURNING gives back the new ids
+    task_rows = [(row['student_id'], session_type, task['task_id'],
+                  task['task_description'], task['sequence'], change_seq)
+                 for row in created for task in template]
+    task_ids = {}
+    for start in range(0, len(task_rows), 500):
+        chunk = task_rows[start:start + 500]
+        c.execute(f"""INSERT INTO student_tasks
+                      (student_id, session_type, task_id, task_description, sequence,
+                       change_seq, completed)
+                      VALUES {', '.join(['(?, ?, ?, ?, ?, ?, 0)'] * len(chunk))}
+                      RETURNING student_task_id, student_id, task_id""",
+                  [value for task_row in chunk for value in task_row])
+        for returned in c.fetchall():
+            task_ids[(returned['student_id'], returned['task_id'])] = returned['student_task_id']
+    
+    conn.commit()
+    event_bus.publish(session['company_id'], 'students_added',
+                      session_id=session['session_id'],
+                      student_ids=[row['student_id'] for row in created],
+                      change_seq=change_seq)
+    
+    for row in created:
+        row['tasks'] = [{
+            "student_task_id": task_ids[(row['student_id'], task['task_id'])],
+            "student_id": row['student_id'],
+            "session_type": session_type,
+            "task_id": task['task_id'],
+            "task_description": task['task_description'],
+            "sequence": task['sequence'],
+            "completed": 0,
+            "completed_at": None,
+            "notes": None,
+            "override_reason": None,
+            "change_seq": change_seq
+        } for task in template]
+    return created
+
 @app.post("/sessions/{session_id}/students")
 async def add_student_to_session(session_id: int, student: StudentCreate,
-                                 current_instructor: dict = Depends(require_instructor)):
+                                 current_instructor: dict = Depends(require_instructor),
+                                 conn: sqlite3.Connection = Depends(get_db)):
     """Add a student to a session"""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         # Verify session exists and belongs to instructor
@@ -587,42 +963,39 @@ async def add_student_to_session(session_id: int, student: StudentCreate,
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Insert student
-        c.execute("""INSERT INTO students
-                     (session_id, name, license_number, email, phone, date_of_birth, bike_type)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                  (session_id, student.name, student.license_number, student.email,
-                   student.phone, student.date_of_birth, student.bike_type))
-        
-        student_id = c.lastrowid
-        
-        # Get task configuration for this session type
-        session_type = session['session_type']
-        c.execute("""SELECT * FROM task_configuration
-                     WHERE session_type = ? ORDER BY sequence""", (session_type,))
-        tasks = c.fetchall()
-        
-        # Create student tasks
-        for task in tasks:
-            c.execute("""INSERT INTO student_tasks
-                         (student_id, session_type, task_id, task_description, sequence, completed)
-                         VALUES (?, ?, ?, ?, ?, 0)""",
-                      (student_id, session_type, task['task_id'],
-                       task['task_description'], task['sequence']))
-        
-        conn.commit()
-        
-        # Get created student with tasks
-        c.execute("SELECT * FROM students WHERE student_id = ?", (student_id,))
-        new_student = dict(c.fetchone())
+        return enroll_students(conn, session, [student])[0]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/sessions/{session_id}/students/batch")
+async def add_students_to_session(session_id: int, batch: StudentBatchCreate,
+                                  current_instructor: dict = Depends(require_instructor),
+                                  conn: sqlite3.Connection = Depends(get_db)):
+    """Enrol several students into a session in one transaction"""
+    try:
+        if not batch.students:
+            raise HTTPException(status_code=400, detail="No students given")
+        if len(batch.students) > MAX_ENROLMENT_BATCH:
+            raise HTTPException(status_code=400,
+                                detail=f"At most {MAX_ENROLMENT_BATCH} students per batch")
         
-        c.execute("SELECT * FROM student_tasks WHERE student_id = ? ORDER BY sequence",
-                  (student_id,))
-        new_student['tasks'] = [dict(row) for row in c.fetchall()]
+        c = conn.cursor()
+        c.execute("SELECT * FROM training_sessions WHERE session_id = ? AND instructor_id = ?",
+                  (session_id, current_instructor['user_id']))
+        session = c.fetchone()
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
         
-        conn.close()
+        students = enroll_students(conn, session, batch.students)
         
-        return new_student
+        return {
+            "status": "success",
+            "session_id": session_id,
+            "students_added": len(students),
+            "students": students
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -632,18 +1005,20 @@ async def add_student_to_session(session_id: int, student: StudentCreate,
 # TASK CONFIGURATION (ADMIN ONLY)
 # ============================================================================
 @app.get("/admin/tasks")
-async def get_all_tasks(current_admin: dict = Depends(require_admin)):
+async def get_all_tasks(request: Request, response: Response,
+                        current_admin: dict = Depends(require_admin),
+                        conn: sqlite3.Connection = Depends(get_db)):
     """Get all task configurations (admin only)"""
     try:
-        conn = get_db()
-        c = conn.cursor()
+        version, tasks = task_templates.all(conn)
         
-        c.execute("""SELECT * FROM task_configuration 
-                     ORDER BY session_type, sequence""")
-        
-        tasks = [dict(row) for row in c.fetchall()]
-        conn.close()
+        # The template version doubles as the ETag
+        etag = f'"tasks-v{version}"'
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers={"ETag": etag})
         
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
         return {"tasks": tasks}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -653,18 +1028,27 @@ async def get_all_tasks(current_admin: dict = Depends(require_admin)):
 
 @app.post("/admin/tasks/{session_type}")
 async def update_tasks(session_type: str, data: dict, 
-                      current_admin: dict = Depends(require_admin)):
+                      current_admin: dict = Depends(require_admin),
+                       conn: sqlite3.Connection = Depends(get_db)):
     """Update task configuration for a session type (admin only)"""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         tasks = data.get('tasks', [])
         
+        c.execute("""SELECT sequence, task_id, task_description, mandatory
+                     FROM task_configuration WHERE session_type = ?
+                     ORDER BY sequence""", (session_type,))
+        old_tasks = [dict(row) for row in c.fetchall()]
+        
         # Delete existing tasks for this session type
         c.execute("DELETE FROM task_configuration WHERE session_type = ?", 
                   (session_type,))
         
+        # Bumped in the same transaction, so every worker sees the new version
+        # exactly when it sees the new tasks
+        task_templates.bump_version(conn)
+        
         # Insert updated tasks
         for task in tasks:
             c.execute("""INSERT INTO task_configuration 
@@ -677,7 +1061,15 @@ async def update_tasks(session_type: str, data: dict,
                        task['mandatory']))
         
         conn.commit()
-        conn.close()
+        task_templates.invalidate()
+        
+        audit.record('REPLACE', 'task_configuration', None,
+                     {"session_type": session_type, "tasks": old_tasks},
+                     {"session_type": session_type,
+                      "tasks": [{k: task[k] for k in ('sequence', 'task_id',
+                                                       'task_description', 'mandatory')}
+                                for task in tasks]},
+                     user_id=current_admin['user_id'])
         
         return {"status": "success", "message": f"Tasks updated for {session_type}"}
         
@@ -690,7 +1082,6 @@ async def update_tasks(session_type: str, data: dict,
 
 @app.post("/verify-face")
 async def verify_face(
-    background_tasks: BackgroundTasks,
     student_photo: UploadFile = File(...),
     license_photo: UploadFile = File(...),
     session_id: int = Form(...),
@@ -701,70 +1092,31 @@ async def verify_face(
     address: str = Form(...),
     postcode: str = Form(...)
 ):
-    """Verify face match and save photos asynchronously"""
+    """Verify face match and queue the photos for saving"""
     try:
-        # Read photo data
-        student_img_data = await student_photo.read()
-        license_img_data = await license_photo.read()
-        
-        student_image = Image.open(io.BytesIO(student_img_data))
-        license_image = Image.open(io.BytesIO(license_img_data))
-        
-        if student_image.mode != 'RGB':
-            student_image = student_image.convert('RGB')
-        if license_image.mode != 'RGB':
-            license_image = license_image.convert('RGB')
-        
-        student_np = np.array(student_image)
-        license_np = np.array(license_image)
-        
-        # Detect face locations first
-        student_face_locations = face_recognition.face_locations(student_np)
-        license_face_locations = face_recognition.face_locations(license_np)
-        
-        if len(student_face_locations) == 0:
-            raise HTTPException(status_code=400, detail="No face detected in student photo")
-        if len(license_face_locations) == 0:
-            raise HTTPException(status_code=400, detail="No face detected in license photo")
-        
-        # Crop to face area with 20% padding for context
-        def crop_face_with_padding(image_np, face_location, padding=0.2):
-            top, right, bottom, left = face_location
-            height = bottom - top
-            width = right - left
-            
-            # Add padding
-            pad_h = int(height * padding)
-            pad_w = int(width * padding)
-            
-            # Calculate padded bounds (ensure within image)
-            img_height, img_width = image_np.shape[:2]
-            top_padded = max(0, top - pad_h)
-            bottom_padded = min(img_height, bottom + pad_h)
-            left_padded = max(0, left - pad_w)
-            right_padded = min(img_width, right + pad_w)
-            
-            return image_np[top_padded:bottom_padded, left_padded:right_padded]
+        # Stream both uploads to the photo store; only paths are kept from here on
+        stored_student = await store_upload(student_photo)
+        stored_license = await store_upload(license_photo)
         
-        # Crop both images to just the face area
-        student_face = crop_face_with_padding(student_np, student_face_locations[0])
-        license_face = crop_face_with_padding(license_np, license_face_locations[0])
+        # Reuse the licence encoding if this licence photo was seen before
+        cached_encoding = await run_in_threadpool(face_store.get, driver_number,
+                                                  stored_license.sha256)
         
-        # Get encodings from cropped faces
-        student_encodings = face_recognition.face_encodings(student_face)
-        license_encodings = face_recognition.face_encodings(license_face)
+        # Detection and encoding run in the face worker pool so the event
+        # loop stays free for other requests
+        result = await face_executor.run(compare_faces, stored_student.path, stored_license.path,
+                                         license_encoding=cached_encoding)
+        face_distance = result['face_distance']
         
-        if len(student_encodings) == 0:
-            raise HTTPException(status_code=400, detail="Could not encode student face")
-        if len(license_encodings) == 0:
-            raise HTTPException(status_code=400, detail="Could not encode license face")
+        if cached_encoding is None:
+            await run_in_threadpool(face_store.put, driver_number, stored_license.sha256,
+                                    result['license_encoding'])
         
-        student_encoding = student_encodings[0]
-        license_encoding = license_encodings[0]
+        # Index the student's face for duplicate identity searches (only
+        # while the session is in progress; the endpoint is unauthenticated)
+        await run_in_threadpool(face_index.append, result['student_encoding'],
+                                driver_number, session_id)
         
-        # Calculate face distance (lower is better match)
-        face_distance = float(face_recognition.face_distance([license_encoding], student_encoding)[0])  # ← Convert to float
-
         # Convert to percentage match
         match_score = max(0, min(100, (1 - face_distance) * 100))
 
@@ -772,46 +1124,132 @@ async def verify_face(
         tolerance = 0.6
         is_match = bool(face_distance < tolerance)  # ← Convert to bool
 
-        background_tasks.add_task(
-            save_student_photos,
-            session_id=session_id,
-            driver_number=driver_number,
-            student_photo_data=student_img_data,
-            license_photo_data=license_img_data,
-            ocr_data={
-                "surname": surname,
-                "forename": forename,
-                "date_of_birth": date_of_birth,
-                "address": address,
-                "postcode": postcode
-            },
-            match_score=match_score,
-            face_distance=face_distance
-        )
+        # Photos and OCR data are persisted by the write-behind queue
+        write_queue.enqueue('student_photo', {
+            "session_id": session_id,
+            "driver_number": driver_number,
+            "student_photo_path": stored_student.path,
+            "license_photo_path": stored_license.path,
+            "surname": surname,
+            "forename": forename,
+            "date_of_birth": date_of_birth,
+            "address": address,
+            "postcode": postcode,
+            "match_score": match_score,
+            "face_distance": face_distance,
+            "capture_timestamp": datetime.now().isoformat()
+        })
     
         return {
             "match_score": round(float(match_score), 2),  # ← Ensure float
             "face_distance": round(float(face_distance), 3),  # ← Ensure float
             "is_match": is_match,
             "confidence": "high" if face_distance < 0.4 else "medium" if face_distance < 0.6 else "low",
+            "license_encoding_cached": cached_encoding is not None,
+            "student_photo_path": stored_student.path,
+            "license_photo_path": stored_license.path,
             "status": "success",
             "Photo saved": "queued"
         }
     
     except HTTPException:
         raise
+    except FaceVerificationError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    except PhotoTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ExecutorSaturated as e:
+        raise HTTPException(status_code=429, detail="Face verification busy, please retry",
+                            headers={"Retry-After": str(e.retry_after)})
+    except JobTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Face verification error: {str(e)}")
 # ============================================================================
+# DUPLICATE IDENTITY SEARCH (ADMIN ONLY)
+# ============================================================================
+
+@app.get("/admin/identity/duplicates/{driver_number}")
+def find_duplicate_identities(driver_number: str, k: int = 10,
+                              max_distance: float = 0.6,
+                              current_admin: dict = Depends(require_admin),
+                              conn: sqlite3.Connection = Depends(get_db)):
+    """Find students of the admin's company under other licence numbers whose
+    face matches this driver (runs in the threadpool; the scan is CPU-bound)"""
+    try:
+        company_id = current_admin['company_id']
+        encoding = face_index.latest_encoding(driver_number, company_id)
+        if encoding is None:
+            raise HTTPException(status_code=404,
+                                detail=f"No indexed face for driver {driver_number}")
+        
+        started = time.perf_counter()
+        matches = face_index.search(encoding, company_id, k=max(1, min(k, 100)),
+                                    exclude_driver=driver_number,
+                                    max_distance=max_distance)
+        search_ms = (time.perf_counter() - started) * 1000
+        
+        entries = {}
+        if matches:
+            c = conn.cursor()
+            placeholders = ','.join('?' * len(matches))
+            c.execute(f"""SELECT row_id, driver_number, session_id, created_at
+                          FROM face_index_entries
+                          WHERE company_id = ? AND row_id IN ({placeholders})""",
+                      [company_id] + [row_id for row_id, _ in matches])
+            entries = {row['row_id']: dict(row) for row in c.fetchall()}
+        
+        results = []
+        for row_id, distance in matches:
+            entry = entries.get(row_id)
+            if entry is None:
+                continue
+            entry['face_distance'] = round(distance, 3)
+            entry['match_score'] = round(max(0, min(100, (1 - distance) * 100)), 2)
+            results.append(entry)
+        
+        return {
+            "driver_number": driver_number,
+            "matches": results,
+            "indexed_faces": face_index.stats()['rows'],
+            "search_ms": round(search_ms, 2)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/identity/index/train")
+async def train_identity_index(partitions: Optional[int] = None,
+                               current_admin: dict = Depends(require_admin)):
+    """Rebuild the coarse partitions used to keep duplicate search sub-linear.
+
+    k-means runs in the threadpool so the event loop keeps serving requests.
+    """
+    try:
+        started = time.perf_counter()
+        trained = await run_in_threadpool(face_index.train_partitions, partitions)
+        return {
+            "status": "success",
+            "partitions": trained,
+            "rows": face_index.stats()['rows'],
+            "train_ms": round((time.perf_counter() - started) * 1000, 2)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ============================================================================
 # TASK COMPLETION
 # ============================================================================
 
 @app.put("/sessions/{session_id}/tasks/complete")
-async def complete_task_for_all(session_id: int, task_data: TaskComplete,
-                               current_instructor: dict = Depends(require_instructor)):
-    """Complete a task for all students in the session"""
+async def complete_task_for_all(session_id: int, task_data: SessionTasksComplete,
+                               current_instructor: dict = Depends(require_instructor),
+                               conn: sqlite3.Connection = Depends(get_db)):
+    """Complete (or un-complete) one or more tasks for all students in the session"""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         # Verify session
@@ -820,28 +1258,53 @@ async def complete_task_for_all(session_id: int, task_data: TaskComplete,
         if not c.fetchone():
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get all students in session
-        c.execute("SELECT student_id FROM students WHERE session_id = ?", (session_id,))
-        students = c.fetchall()
+        task_ids = list(task_data.task_ids)
+        if task_data.task_id:
+            task_ids.insert(0, task_data.task_id)
+        task_ids = list(dict.fromkeys(task_ids))  # de-duplicate, keep order
+        if not task_ids:
+            raise HTTPException(status_code=400, detail="No task_id or task_ids given")
         
         timestamp = datetime.now().isoformat() if task_data.completed else None
-        
-        # Update task for all students
-        for student in students:
-            c.execute("""UPDATE student_tasks
-                         SET completed = ?, completed_at = ?, notes = ?
-                         WHERE student_id = ? AND task_id = ?""",
-                      (task_data.completed, timestamp, task_data.notes,
-                       student['student_id'], task_data.task_id))
-        
+        change_seq = change_feed.next_seq(conn)
+        
+        # One set-based update for every student and task in the session
+        placeholders = ','.join('?' * len(task_ids))
+        c.execute(f"""UPDATE student_tasks
+                      SET completed = ?, completed_at = ?, notes = ?, change_seq = ?
+                      FROM students s
+                      WHERE s.student_id = student_tasks.student_id
+                      AND s.session_id = ?
+                      AND student_tasks.task_id IN ({placeholders})
+                      RETURNING student_tasks.student_id, student_tasks.task_id,
+                                student_tasks.completed, student_tasks.completed_at""",
+                  [task_data.completed, timestamp, task_data.notes, change_seq,
+                   session_id, *task_ids])
+        updated = c.fetchall()
         conn.commit()
-        conn.close()
+        event_bus.publish(current_instructor['company_id'], 'tasks_updated',
+                          session_id=session_id, task_ids=task_ids,
+                          completed=task_data.completed, change_seq=change_seq)
+        
+        students = {}
+        for row in updated:
+            students.setdefault(row['student_id'], []).append({
+                "task_id": row['task_id'],
+                "completed": bool(row['completed']),
+                "completed_at": row['completed_at']
+            })
+        updated_task_ids = {row['task_id'] for row in updated}
         
         return {
             "status": "success",
             "students_updated": len(students),
-            "task_id": task_data.task_id,
-            "completed": task_data.completed
+            "tasks_updated": len(updated),
+            "task_id": task_ids[0] if len(task_ids) == 1 else None,
+            "task_ids": task_ids,
+            "unknown_task_ids": [t for t in task_ids if t not in updated_task_ids],
+            "completed": task_data.completed,
+            "students": [{"student_id": student_id, "tasks": tasks}
+                         for student_id, tasks in sorted(students.items())]
         }
     except HTTPException:
         raise
@@ -850,30 +1313,55 @@ async def complete_task_for_all(session_id: int, task_data: TaskComplete,
 
 @app.put("/students/{student_id}/tasks/{task_id}")
 async def update_student_task(student_id: int, task_id: str, task_data: TaskComplete,
-                             current_instructor: dict = Depends(require_instructor)):
+                             current_instructor: dict = Depends(require_instructor),
+                              conn: sqlite3.Connection = Depends(get_db)):
     """Update a specific student's task (override)"""
     try:
-        conn = get_db()
         c = conn.cursor()
         
         timestamp = datetime.now().isoformat() if task_data.completed else None
         
+        c.execute("""SELECT student_task_id, completed, completed_at, notes, override_reason
+                     FROM student_tasks WHERE student_id = ? AND task_id = ?""",
+                  (student_id, task_id))
+        before = c.fetchone()
+        change_seq = change_feed.next_seq(conn)
+        
         c.execute("""UPDATE student_tasks
-                     SET completed = ?, completed_at = ?, notes = ?, override_reason = ?
+                     SET completed = ?, completed_at = ?, notes = ?, override_reason = ?,
+                         change_seq = ?
                      WHERE student_id = ? AND task_id = ?""",
                   (task_data.completed, timestamp, task_data.notes, task_data.notes,
-                   student_id, task_id))
+                   change_seq, student_id, task_id))
         
         if c.rowcount == 0:
             raise HTTPException(status_code=404, detail="Task not found")
         
         conn.commit()
         
+        old, new = changed_values(before, {"completed": int(task_data.completed),
+                                           "completed_at": timestamp,
+                                           "notes": task_data.notes,
+                                           "override_reason": task_data.notes})
+        audit.record('OVERRIDE', 'student_tasks', before['student_task_id'],
+                     {"student_id": student_id, "task_id": task_id, **old},
+                     {"student_id": student_id, "task_id": task_id, **new},
+                     user_id=current_instructor['user_id'])
+        
+        c.execute("""SELECT s.session_id, ts.company_id FROM students s
+                     JOIN training_sessions ts ON s.session_id = ts.session_id
+                     WHERE s.student_id = ?""", (student_id,))
+        owner = c.fetchone()
+        if owner:
+            event_bus.publish(owner['company_id'], 'task_updated',
+                              session_id=owner['session_id'], student_id=student_id,
+                              task_id=task_id, completed=task_data.completed,
+                              change_seq=change_seq)
+        
         # Get updated task
         c.execute("SELECT * FROM student_tasks WHERE student_id = ? AND task_id = ?",
                   (student_id, task_id))
         updated_task = dict(c.fetchone())
-        conn.close()
         
         return updated_task
     except HTTPException:
@@ -887,11 +1375,30 @@ async def update_student_task(student_id: int, task_id: str, task_data: TaskComp
 
 @app.post("/sessions/{session_id}/complete")
 async def complete_session(session_id: int,
-                          current_instructor: dict = Depends(require_instructor)):
-    """Complete a session and generate certificates for passing students"""
+                          current_instructor: dict = Depends(require_instructor),
+                           conn: sqlite3.Connection = Depends(get_db)):
+    """Complete a session and generate certificates for passing students.
+
+    Runs as a fixed set of statements whatever the group size: outcomes from
+    one aggregate UPDATE, certificates from one windowed UPDATE, render and
+    email jobs from one INSERT per kind, all in one transaction. The PDFs
+    and emails are produced by the certificate job workers; follow progress
+    with GET /jobs/{job_id}. Per-step timings are returned in timings_ms.
+    """
     try:
-        conn = get_db()
         c = conn.cursor()
+        timings = {}
+        step_started = time.perf_counter()
+        
+        def step(name):
+            nonlocal step_started
+            now = time.perf_counter()
+            timings[name] = round((now - step_started) * 1000, 3)
+            step_started = now
+        
+        # Hold the write lock from the start so concurrent closes can't
+        # reserve the same certificate numbers
+        begin_immediate(conn)
         
         # Verify session
         c.execute("""SELECT * FROM training_sessions
@@ -900,226 +1407,424 @@ async def complete_session(session_id: int,
         session = c.fetchone()
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
-        
-        # Get all students and their task completion
-        c.execute("""SELECT s.*, 
-                     COUNT(st.student_task_id) as total_tasks,
-                     SUM(CASE WHEN st.completed = 1 THEN 1 ELSE 0 END) as completed_tasks
-                     FROM students s
-                     LEFT JOIN student_tasks st ON s.student_id = st.student_id
-                     WHERE s.session_id = ?
-                     GROUP BY s.student_id""", (session_id,))
-        
-        students = c.fetchall()
-        certificates_issued = 0
-        
-        for student in students:
-            # Check if all tasks completed
-            if student['total_tasks'] == student['completed_tasks'] and student['total_tasks'] > 0:
-                # Get next certificate
-                c.execute("""SELECT c.*, cb.certificates_remaining
-                             FROM certificates c
-                             JOIN certificate_batches cb ON c.batch_id = cb.batch_id
-                             WHERE c.session_type = ? AND c.status = 'AVAILABLE'
-                             AND cb.company_id = ? AND cb.status = 'ACTIVE'
-                             ORDER BY c.certificate_number
-                             LIMIT 1""",
-                          (session['session_type'], current_instructor['company_id']))
-                
-                cert = c.fetchone()
-                if cert:
-                    # Issue certificate
-                    c.execute("""UPDATE certificates
-                                 SET student_id = ?, session_id = ?, instructor_id = ?,
-                                 issue_date = ?, status = 'ISSUED'
-                                 WHERE certificate_id = ?""",
-                              (student['student_id'], session_id,
-                               current_instructor['user_id'],
-                               datetime.now().isoformat(), cert['certificate_id']))
-                    
-                    # Update student outcome
-                    c.execute("UPDATE students SET training_outcome = 'PASS' WHERE student_id = ?",
-                              (student['student_id'],))
-                    
-                    certificates_issued += 1
-                else:
-                    # No certificates available
-                    c.execute("UPDATE students SET training_outcome = 'INCOMPLETE' WHERE student_id = ?",
-                              (student['student_id'],))
-            else:
-                # Not all tasks completed
-                c.execute("UPDATE students SET training_outcome = 'INCOMPLETE' WHERE student_id = ?",
-                          (student['student_id'],))
+        # Checked under the write lock, so only one of two concurrent closes
+        # gets past here
+        if session['status'] == 'COMPLETED':
+            raise HTTPException(status_code=409, detail="Session is already completed")
+        step("verify_session")
+        
+        change_seq = change_feed.next_seq(conn)
+        
+        # PASS if every task is complete, otherwise INCOMPLETE
+        c.execute("""UPDATE students
+                     SET training_outcome = CASE WHEN agg.total_tasks > 0
+                                                 AND agg.total_tasks = agg.completed_tasks
+                                            THEN 'PASS' ELSE 'INCOMPLETE' END,
+                         change_seq = ?
+                     FROM (SELECT s.student_id,
+                                  COUNT(st.student_task_id) AS total_tasks,
+                                  COALESCE(SUM(st.completed = 1), 0) AS completed_tasks
+                           FROM students s
+                           LEFT JOIN student_tasks st ON s.student_id = st.student_id
+                           WHERE s.session_id = ?
+                           GROUP BY s.student_id) AS agg
+                     WHERE students.student_id = agg.student_id
+                     RETURNING students.training_outcome""", (change_seq, session_id))
+        outcomes = [row['training_outcome'] for row in c.fetchall()]
+        passing = outcomes.count('PASS')
+        step("compute_outcomes")
+        
+        issued = issue_to_passing_students(conn, current_instructor['company_id'],
+                                           session['session_type'], session_id,
+                                           current_instructor['user_id'])
+        step("issue_certificates")
+        
+        # Passed but the certificate stock ran out
+        if len(issued) < passing:
+            c.execute("""UPDATE students SET training_outcome = 'INCOMPLETE'
+                         WHERE session_id = ? AND training_outcome = 'PASS'
+                         AND student_id NOT IN (SELECT student_id FROM certificates
+                                                WHERE session_id = ? AND status = 'ISSUED')""",
+                      (session_id, session_id))
+        step("reconcile_outcomes")
         
         # Mark session as completed
         c.execute("""UPDATE training_sessions
-                     SET status = 'COMPLETED', completed_at = ?
+                     SET status = 'COMPLETED', completed_at = ?, change_seq = ?
                      WHERE session_id = ?""",
-                  (datetime.now().isoformat(), session_id))
+                  (datetime.now().isoformat(), change_seq, session_id))
+        
+        job_id, jobs_queued = cert_jobs.enqueue_session(conn, current_instructor['company_id'],
+                                                        session_id)
+        step("enqueue_jobs")
         
         conn.commit()
-        conn.close()
+        step("commit")
+        job_runner.wake()
+        
+        audit.record('COMPLETE', 'training_sessions', session_id,
+                     {"status": session['status']},
+                     {"status": "COMPLETED", "total_students": len(outcomes),
+                      "passed": passing,
+                      "certificates": [cert['certificate_number'] for cert in issued]},
+                     user_id=current_instructor['user_id'])
+        
+        event_bus.publish(current_instructor['company_id'], 'session_completed',
+                          session_id=session_id, certificates_issued=len(issued),
+                          change_seq=change_seq)
         
         return {
             "status": "success",
             "session_id": session_id,
-            "total_students": len(students),
-            "certificates_issued": certificates_issued
+            "total_students": len(outcomes),
+            "certificates_issued": len(issued),
+            "job_id": job_id,
+            "jobs_queued": jobs_queued,
+            "timings_ms": timings
         }
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/sessions/{session_id}/certificates/render", status_code=202)
+async def render_certificates(session_id: int,
+                              current_user: dict = Depends(require_instructor),
+                              conn: sqlite3.Connection = Depends(get_db)):
+    """Queue a fresh render of the certificate PDFs of a completed session"""
+    session = conn.execute("""SELECT status FROM training_sessions
+                              WHERE session_id = ? AND company_id = ?""",
+                           (session_id, current_user['company_id'])).fetchone()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if session['status'] != 'COMPLETED':
+        raise HTTPException(status_code=409, detail="Session is not completed")
+    
+    job_id, jobs_queued = cert_jobs.enqueue_session(conn, current_user['company_id'],
+                                                    session_id, kinds=('render',))
+    conn.commit()
+    job_runner.wake()
+    
+    return {"session_id": session_id, "job_id": job_id, "jobs_queued": jobs_queued}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: int,
+                  current_user: dict = Depends(get_current_user),
+                  conn: sqlite3.Connection = Depends(get_db)):
+    """Status of a certificate job; session jobs include their children's progress"""
+    job = cert_jobs.job_status(conn, job_id, current_user['company_id'])
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# ============================================================================
+# PUBLIC CERTIFICATE VERIFICATION
+# ============================================================================
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+@app.get("/verify/{code}")
+async def verify_certificate(code: str, request: Request):
+    """Public lookup for the code on a certificate's QR code (no authentication).
+
+    Served from the in-process verification cache; repeat scans with
+    If-None-Match get a 304. Only a cache miss leaves the event loop, to
+    read the certificate on a pooled connection in the threadpool.
+    """
+    normalised = normalise_code(code)
+    if normalised is None:
+        return FastJSONResponse({"valid": False, "detail": "Malformed verification code"},
+                                status_code=404,
+                                headers={"Cache-Control": "public, max-age=86400"})
+    try:
+        found, body, etag = (verifications.get(normalised) or
+                             await run_in_threadpool(verifications.load, normalised))
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Server busy, retry shortly",
+                            headers={"Retry-After": "1"})
+    
+    max_age = int(VERIFY_CACHE_TTL if found else VERIFY_NEGATIVE_TTL)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if _etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, status_code=200 if found else 404,
+                    media_type="application/json", headers=headers)
+
 # ============================================================================
 # STATISTICS & REPORTS
 # ============================================================================
 
 @app.get("/stats")
-async def get_statistics(current_user: dict = Depends(get_current_user)):
-    """Get training statistics"""
+async def get_statistics(date_from: Optional[str] = Query(None, alias="from"),
+                         date_to: Optional[str] = Query(None, alias="to"),
+                         current_user: dict = Depends(get_current_user),
+                         conn: sqlite3.Connection = Depends(get_db)):
+    """Get training statistics for the caller's company.
+
+    Served from the trigger-maintained rollups in stats_rollup. With ?from=
+    and/or ?to= (YYYY-MM-DD) the per-day rollups for that range are added.
+    """
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Total students
-        c.execute('SELECT COUNT(*) as count FROM students')
-        total_students = c.fetchone()['count']
-        
-        # Verified students
-        c.execute('SELECT COUNT(*) as count FROM students WHERE verified = 1')
-        verified_students = c.fetchone()['count']
-        
-        # Students today
+        company_id = current_user['company_id']
         today = datetime.now().strftime('%Y-%m-%d')
-        c.execute('SELECT COUNT(*) as count FROM students WHERE created_at LIKE ?', (f'{today}%',))
-        students_today = c.fetchone()['count']
-        
-        # Average match score
-        c.execute('SELECT AVG(match_score) as avg FROM students WHERE match_score IS NOT NULL')
-        avg_result = c.fetchone()
-        avg_match = avg_result['avg'] if avg_result['avg'] is not None else 0
-        
-        # Certificates issued
-        c.execute('SELECT COUNT(*) as count FROM certificates WHERE status = "ISSUED"')
-        certs_issued = c.fetchone()['count']
-        
-        # Active sessions
-        c.execute('SELECT COUNT(*) as count FROM training_sessions WHERE status = "IN_PROGRESS"')
-        active_sessions = c.fetchone()['count']
-        
-        conn.close()
-        
-        return {
-            "total_students": total_students,
-            "verified_students": verified_students,
-            "students_today": students_today,
-            "average_match_score": round(avg_match, 2),
-            "certificates_issued": certs_issued,
-            "active_sessions": active_sessions
-        }
+        totals = stats_rollup.company_totals(conn, company_id, today)
+        
+        if totals is None:
+            result = {
+                "total_students": 0,
+                "verified_students": 0,
+                "students_today": 0,
+                "average_match_score": 0,
+                "certificates_issued": 0,
+                "active_sessions": 0
+            }
+        else:
+            avg_match = (totals['match_score_sum'] / totals['match_score_count']
+                         if totals['match_score_count'] else 0)
+            result = {
+                "total_students": totals['total_students'],
+                "verified_students": totals['verified_students'],
+                "students_today": totals['students_today'],
+                "average_match_score": round(avg_match, 2),
+                "certificates_issued": totals['certificates_issued'],
+                "active_sessions": totals['active_sessions']
+            }
+        
+        if date_from or date_to:
+            try:
+                for value in (date_from, date_to):
+                    if value:
+                        datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD")
+            
+            days = [dict(row) for row in stats_rollup.company_range(
+                conn, company_id, date_from or '0000-01-01', date_to or '9999-12-31')]
+            score_sum = sum(d['match_score_sum'] for d in days)
+            score_count = sum(d['match_score_count'] for d in days)
+            for d in days:
+                d.pop('company_id')
+            result["range"] = {
+                "from": date_from,
+                "to": date_to,
+                "students_created": sum(d['students_created'] for d in days),
+                "students_verified": sum(d['students_verified'] for d in days),
+                "average_match_score": round(score_sum / score_count, 2) if score_count else 0,
+                "certificates_issued": sum(d['certificates_issued'] for d in days),
+                "sessions_started": sum(d['sessions_started'] for d in days),
+                "sessions_completed": sum(d['sessions_completed'] for d in days),
+                "days": days
+            }
+        
+        return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Statistics error: {str(e)}")
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(created_at, row_id):
+    """Opaque keyset cursor for the (created_at, id) position of a row"""
+    raw = json.dumps([created_at, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return str(created_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filters(id_column, cursor, date_from, date_to):
+    """WHERE fragments and params for the cursor and a created_at date range"""
+    clauses, params = [], []
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        clauses.append(f"(created_at, {id_column}) < (?, ?)")
+        params += [created_at, row_id]
+    try:
+        if date_from:
+            clauses.append("created_at >= ?")
+            params.append(datetime.strptime(date_from, '%Y-%m-%d').strftime('%Y-%m-%d'))
+        if date_to:
+            clauses.append("created_at < ?")
+            params.append((datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1))
+                          .strftime('%Y-%m-%d'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD")
+    return clauses, params
+
+def page_response(key, rows, limit, id_column):
+    """One page of row dicts (fetched with limit + 1) plus its next_cursor"""
+    items = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last['created_at'], last[id_column])
+    return FastJSONResponse({key: items, "next_cursor": next_cursor})
+
 @app.get("/admin/users")
-async def get_all_users(current_admin: dict = Depends(require_admin)):
-    """Get all users (admin only)"""
+async def get_all_users(status: Optional[str] = None,
+                        role: Optional[str] = Query(None, pattern="^(admin|instructor)$"),
+                        date_from: Optional[str] = Query(None, alias="from"),
+                        date_to: Optional[str] = Query(None, alias="to"),
+                        cursor: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        current_admin: dict = Depends(require_admin),
+                        conn: sqlite3.Connection = Depends(get_db)):
+    """Get users, newest first, one keyset page at a time (admin only)"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute("""SELECT user_id, name, email, is_admin, is_instructor, 
-                     instructor_certificate_number, phone, status, created_at, last_login
-                     FROM users WHERE company_id = ?
-                     ORDER BY created_at DESC""",
-                  (current_admin['company_id'],))
-        
-        users = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return {"users": users}
+        clauses, params = keyset_filters('user_id', cursor, date_from, date_to)
+        clauses.insert(0, "company_id = ?")
+        params.insert(0, current_admin['company_id'])
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if role == 'admin':
+            clauses.append("is_admin = 1")
+        elif role == 'instructor':
+            clauses.append("is_instructor = 1")
+        
+        rows = fetch_dicts(conn, f"""SELECT user_id, name, email, is_admin, is_instructor, 
+                                     instructor_certificate_number, phone, status, created_at,
+                                     last_login
+                                     FROM users WHERE {' AND '.join(clauses)}
+                                     ORDER BY created_at DESC, user_id DESC
+                                     LIMIT ?""",
+                           params + [limit + 1])
+        
+        return page_response("users", rows, limit, 'user_id')
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/admin/sessions/all")
-async def get_all_sessions(current_admin: dict = Depends(require_admin)):
-    """Get all sessions across all instructors (admin only)"""
+async def get_all_sessions(status: Optional[str] = None,
+                           instructor_id: Optional[int] = None,
+                           session_type: Optional[str] = None,
+                           date_from: Optional[str] = Query(None, alias="from"),
+                           date_to: Optional[str] = Query(None, alias="to"),
+                           cursor: Optional[str] = None,
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                           current_admin: dict = Depends(require_admin),
+                           conn: sqlite3.Connection = Depends(get_db)):
+    """Get sessions across all instructors, newest first, one keyset page at a time (admin only)"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        c.execute("""SELECT s.*, u.name as instructor_name,
-                     COUNT(DISTINCT st.student_id) as student_count
-                     FROM training_sessions s
-                     JOIN users u ON s.instructor_id = u.user_id
-                     LEFT JOIN students st ON s.session_id = st.session_id
-                     WHERE s.company_id = ?
-                     GROUP BY s.session_id
-                     ORDER BY s.created_at DESC""",
-                  (current_admin['company_id'],))
-        
-        sessions = [dict(row) for row in c.fetchall()]
-        conn.close()
-        
-        return {"sessions": sessions}
+        clauses, params = keyset_filters('session_id', cursor, date_from, date_to)
+        clauses.insert(0, "company_id = ?")
+        params.insert(0, current_admin['company_id'])
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if instructor_id is not None:
+            clauses.append("instructor_id = ?")
+            params.append(instructor_id)
+        if session_type:
+            clauses.append("session_type = ?")
+            params.append(session_type)
+        
+        # Page first, then name and count only the rows on the page; the count
+        # is answered from idx_students_session without touching students
+        rows = fetch_dicts(conn, f"""SELECT {SESSION_COLUMNS}, u.name as instructor_name,
+                                     (SELECT COUNT(*) FROM students st
+                                      WHERE st.session_id = s.session_id) as student_count
+                                     FROM (SELECT * FROM training_sessions
+                                           WHERE {' AND '.join(clauses)}
+                                           ORDER BY created_at DESC, session_id DESC
+                                           LIMIT ?) s
+                                     JOIN users u ON s.instructor_id = u.user_id
+                                     ORDER BY s.created_at DESC, s.session_id DESC""",
+                           params + [limit + 1])
+        
+        return page_response("sessions", rows, limit, 'session_id')
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def save_student_photos(
-    session_id: int,
-    driver_number: str,
-    student_photo_data: bytes,
-    license_photo_data: bytes,
-    ocr_data: dict,
-    match_score: float,
-    face_distance: float
-):
-    """Background task to save photos and OCR data to database"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Insert into student_photos table
-        cursor.execute("""
-            INSERT INTO student_photos (
-                session_id,
-                driver_number,
-                student_photo,
-                license_photo,
-                surname,
-                forename,
-                date_of_birth,
-                address,
-                postcode,
-                match_score,
-                face_distance,
-                capture_timestamp
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            session_id,
-            driver_number,
-            student_photo_data,  # Store as BYTEA
-            license_photo_data,  # Store as BYTEA
-            ocr_data['surname'],
-            ocr_data['forename'],
-            ocr_data['date_of_birth'],
-            ocr_data['address'],
-            ocr_data['postcode'],
-            match_score,
-            face_distance,
-            datetime.now()
-        ))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        print(f"✅ Photos saved for driver {driver_number} in session {session_id}")
-        
-    except Exception as e:
-        print(f"❌ Error saving photos: {e}")
-        # Don't raise - this is background task, shouldn't break main flow
+# ============================================================================
+# STUDENT PHOTO PERSISTENCE (write-behind)
+# ============================================================================
+
+STUDENT_PHOTOS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS student_photos (
+    photo_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER NOT NULL REFERENCES training_sessions(session_id),
+    driver_number TEXT NOT NULL,
+    student_photo_path TEXT NOT NULL,
+    license_photo_path TEXT NOT NULL,
+    surname TEXT,
+    forename TEXT,
+    date_of_birth TEXT,
+    address TEXT,
+    postcode TEXT,
+    match_score REAL,
+    face_distance REAL,
+    capture_timestamp TEXT NOT NULL DEFAULT (datetime('now')),
+    CONSTRAINT unique_driver_session_photo UNIQUE (driver_number, session_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_student_photos_session ON student_photos(session_id);
+CREATE INDEX IF NOT EXISTS idx_student_photos_driver ON student_photos(driver_number);
+"""
+
+def ensure_student_photos_schema():
+    """Replace the old Postgres-style student_photos table (SERIAL/BYTEA)"""
+    with pool.connection() as conn:
+        columns = [row['name'] for row in conn.execute("PRAGMA table_info(student_photos)")]
+        if columns and 'student_photo_path' not in columns:
+            # Every insert into the old table failed, so it holds nothing worth keeping
+            count = conn.execute("SELECT COUNT(*) FROM student_photos").fetchone()[0]
+            if count:
+                conn.execute("ALTER TABLE student_photos RENAME TO student_photos_legacy")
+                conn.execute("DROP INDEX IF EXISTS idx_student_photos_session")
+                conn.execute("DROP INDEX IF EXISTS idx_student_photos_driver")
+            else:
+                conn.execute("DROP TABLE student_photos")
+            conn.commit()
+        conn.executescript(STUDENT_PHOTOS_SCHEMA)
+
+def save_student_photos(conn: sqlite3.Connection, records: List[dict]):
+    """Write-behind handler: persist a batch of verification results.
+
+    A retake in the same session replaces the earlier photos for that driver.
+    """
+    conn.executemany("""
+        INSERT INTO student_photos (
+            session_id, driver_number, student_photo_path, license_photo_path,
+            surname, forename, date_of_birth, address, postcode,
+            match_score, face_distance, capture_timestamp
+        ) VALUES (:session_id, :driver_number, :student_photo_path, :license_photo_path,
+                  :surname, :forename, :date_of_birth, :address, :postcode,
+                  :match_score, :face_distance, :capture_timestamp)
+        ON CONFLICT(driver_number, session_id) DO UPDATE SET
+            student_photo_path = excluded.student_photo_path,
+            license_photo_path = excluded.license_photo_path,
+            surname = excluded.surname,
+            forename = excluded.forename,
+            date_of_birth = excluded.date_of_birth,
+            address = excluded.address,
+            postcode = excluded.postcode,
+            match_score = excluded.match_score,
+            face_distance = excluded.face_distance,
+            capture_timestamp = excluded.capture_timestamp
+    """, records)
+
+write_queue.register('student_photo', save_student_photos)
+
+@app.on_event("startup")
+def start_write_queue():
+    ensure_student_photos_schema()
+    write_queue.start()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,77 @@
+"""
+Content-addressed photo storage.
+
+Uploads are streamed to disk in chunks while they are hashed, then moved to
+photos/<aa>/<bb>/<sha256><ext>. Only the path is kept in the database and
+passed to the face workers, so a verification never holds whole photos in
+the API process.
+"""
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+
+PHOTO_STORE_DIR = os.getenv('PHOTO_STORE_DIR', 'photos')
+PHOTO_MAX_BYTES = int(os.getenv('PHOTO_MAX_BYTES', str(25 * 1024 * 1024)))
+CHUNK_BYTES = 256 * 1024
+
+_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/heic': '.heic',
+}
+
+
+class PhotoTooLarge(Exception):
+    """Upload exceeded PHOTO_MAX_BYTES"""
+
+
+@dataclass
+class StoredPhoto:
+    path: str
+    sha256: str
+    size: int
+
+
+def _extension(upload):
+    ext = _EXTENSIONS.get((upload.content_type or '').lower())
+    if ext is None:
+        ext = os.path.splitext(upload.filename or '')[1].lower() or '.jpg'
+    return ext
+
+
+async def store_upload(upload):
+    """Stream an UploadFile to its content-addressed path"""
+    tmp_dir = os.path.join(PHOTO_STORE_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = await upload.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > PHOTO_MAX_BYTES:
+                    raise PhotoTooLarge(
+                        f"{upload.filename or 'Photo'} exceeds {PHOTO_MAX_BYTES // (1024 * 1024)}MB")
+                digest.update(chunk)
+                f.write(chunk)
+
+        sha256 = digest.hexdigest()
+        directory = os.path.join(PHOTO_STORE_DIR, sha256[:2], sha256[2:4])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, sha256 + _extension(upload))
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return StoredPhoto(path=path, sha256=sha256, size=size)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
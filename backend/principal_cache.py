@@ -0,0 +1,87 @@
+"""
+Short-lived cache of authenticated users.
+
+get_current_user looks the token's user_id up here before touching the
+users table. Entries are slim copies of the user row (no password hash),
+bounded by a per-process LRU and a TTL. Write paths that change a user row
+call invalidate(); the TTL bounds staleness in other worker processes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '30'))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '1024'))
+
+# Never cached, never handed to request handlers
+_PRIVATE_FIELDS = ('password_hash',)
+
+
+class PrincipalCache:
+    """TTL + LRU map of user_id -> slim user record"""
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, capacity=AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, user_id):
+        """Cached user record, or None on a miss or an expired entry"""
+        key = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, user = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return dict(user)
+                del self._entries[key]
+                self._expired += 1
+            self._misses += 1
+            return None
+
+    def put(self, user_row):
+        """Cache a users row; returns the slim record"""
+        user = {k: v for k, v in dict(user_row).items() if k not in _PRIVATE_FIELDS}
+        key = int(user['user_id'])
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return dict(user)
+
+    def invalidate(self, user_id=None):
+        """Drop one user (or everyone) after their row changes"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ttl_seconds": self.ttl,
+                "capacity": self.capacity,
+                "cached": len(self._entries),
+                "hits_total": self._hits,
+                "misses_total": self._misses,
+                "expired_total": self._expired,
+                "evictions_total": self._evictions,
+                "invalidations_total": self._invalidations,
+            }
+
+
+principals = PrincipalCache()
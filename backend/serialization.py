@@ -0,0 +1,107 @@
+"""
+Fast JSON responses built straight from SQLite rows.
+
+Listing endpoints read rows as plain tuples (no sqlite3.Row), zip them with
+an explicit column projection and encode with orjson. The result is returned
+as a FastJSONResponse, which skips FastAPI's generic jsonable_encoder pass.
+Unbounded listings are streamed as a chunked JSON array, a batch of rows at
+a time, instead of being materialised in full.
+"""
+import base64
+import json
+
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback, same output
+    orjson = None
+
+STREAM_BATCH_ROWS = 200
+
+
+def _default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content):
+    """Encode to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=_default, separators=(',', ':'),
+                      ensure_ascii=False).encode()
+
+
+class FastJSONResponse(Response):
+    """JSON response encoded with orjson; return it directly from an endpoint"""
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+
+def select_columns(requested, available, required=(), default=None):
+    """Columns for a comma-separated ?fields= projection.
+
+    Falls back to `default` (or every available column) when nothing is
+    requested; `required` columns are always included. Raises ValueError
+    for unknown names, so they can never reach the SQL text.
+    """
+    if not requested:
+        return list(default or available)
+    fields = [f.strip() for f in requested.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    return list(dict.fromkeys(list(required) + fields))
+
+
+def table_columns(conn, table):
+    return [d[0] for d in conn.execute(f"SELECT * FROM {table} LIMIT 0").description]
+
+
+def tuple_cursor(conn, sql, params=()):
+    """Execute with plain tuple rows; returns (cursor, column names)"""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    return cursor, [d[0] for d in cursor.description]
+
+
+def fetch_dicts(conn, sql, params=()):
+    """All rows as dicts, built from tuples"""
+    cursor, columns = tuple_cursor(conn, sql, params)
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def json_chunks(conn, sql, params, key, head=None):
+    """Run the query now; return a generator of JSON bytes for {**head, key: [rows...]}"""
+    cursor, columns = tuple_cursor(conn, sql, params)
+
+    def body():
+        prefix = dumps(head)[:-1] + b',' if head else b'{'
+        yield prefix + dumps(key) + b':['
+        first = True
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH_ROWS)
+            if not rows:
+                break
+            chunk = dumps([dict(zip(columns, row)) for row in rows])[1:-1]
+            yield chunk if first else b',' + chunk
+            first = False
+        yield b']}'
+
+    return body()
+
+
+def stream_json(conn, sql, params, key, head=None):
+    """Stream {**head, key: [rows...]} while the rows are still being read"""
+    return StreamingResponse(json_chunks(conn, sql, params, key, head),
+                             media_type="application/json")
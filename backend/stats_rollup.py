@@ -0,0 +1,265 @@
+"""
+Materialized dashboard counters.
+
+company_stats holds running totals per company and company_daily_stats holds
+per-day rollups. Both are kept current by triggers on students, certificates
+and training_sessions, so every write path updates them in its own
+transaction. /stats reads them by primary key instead of aggregating the
+base tables.
+
+Student counters (including verification and match scores) are attributed to
+the day the student was created; certificates to their issue date; sessions
+to the day they started or completed.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS company_stats (
+    company_id INTEGER PRIMARY KEY,
+    total_students INTEGER NOT NULL DEFAULT 0,
+    verified_students INTEGER NOT NULL DEFAULT 0,
+    match_score_sum REAL NOT NULL DEFAULT 0,
+    match_score_count INTEGER NOT NULL DEFAULT 0,
+    certificates_issued INTEGER NOT NULL DEFAULT 0,
+    active_sessions INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS company_daily_stats (
+    company_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    students_created INTEGER NOT NULL DEFAULT 0,
+    students_verified INTEGER NOT NULL DEFAULT 0,
+    match_score_sum REAL NOT NULL DEFAULT 0,
+    match_score_count INTEGER NOT NULL DEFAULT 0,
+    certificates_issued INTEGER NOT NULL DEFAULT 0,
+    sessions_started INTEGER NOT NULL DEFAULT 0,
+    sessions_completed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (company_id, day)
+) WITHOUT ROWID;
+
+-- Students ------------------------------------------------------------------
+
+CREATE TRIGGER IF NOT EXISTS stats_student_insert
+AFTER INSERT ON students
+BEGIN
+    INSERT INTO company_stats (company_id, total_students, verified_students,
+                               match_score_sum, match_score_count)
+    VALUES ((SELECT company_id FROM training_sessions WHERE session_id = NEW.session_id),
+            1, COALESCE(NEW.verified, 0) = 1,
+            COALESCE(NEW.match_score, 0), NEW.match_score IS NOT NULL)
+    ON CONFLICT(company_id) DO UPDATE SET
+        total_students = total_students + 1,
+        verified_students = verified_students + excluded.verified_students,
+        match_score_sum = match_score_sum + excluded.match_score_sum,
+        match_score_count = match_score_count + excluded.match_score_count;
+
+    INSERT INTO company_daily_stats (company_id, day, students_created, students_verified,
+                                     match_score_sum, match_score_count)
+    VALUES ((SELECT company_id FROM training_sessions WHERE session_id = NEW.session_id),
+            date(NEW.created_at), 1, COALESCE(NEW.verified, 0) = 1,
+            COALESCE(NEW.match_score, 0), NEW.match_score IS NOT NULL)
+    ON CONFLICT(company_id, day) DO UPDATE SET
+        students_created = students_created + 1,
+        students_verified = students_verified + excluded.students_verified,
+        match_score_sum = match_score_sum + excluded.match_score_sum,
+        match_score_count = match_score_count + excluded.match_score_count;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_student_update
+AFTER UPDATE OF verified, match_score ON students
+BEGIN
+    UPDATE company_stats SET
+        verified_students = verified_students
+            + (COALESCE(NEW.verified, 0) = 1) - (COALESCE(OLD.verified, 0) = 1),
+        match_score_sum = match_score_sum
+            + COALESCE(NEW.match_score, 0) - COALESCE(OLD.match_score, 0),
+        match_score_count = match_score_count
+            + (NEW.match_score IS NOT NULL) - (OLD.match_score IS NOT NULL)
+    WHERE company_id = (SELECT company_id FROM training_sessions
+                        WHERE session_id = NEW.session_id);
+
+    UPDATE company_daily_stats SET
+        students_verified = students_verified
+            + (COALESCE(NEW.verified, 0) = 1) - (COALESCE(OLD.verified, 0) = 1),
+        match_score_sum = match_score_sum
+            + COALESCE(NEW.match_score, 0) - COALESCE(OLD.match_score, 0),
+        match_score_count = match_score_count
+            + (NEW.match_score IS NOT NULL) - (OLD.match_score IS NOT NULL)
+    WHERE company_id = (SELECT company_id FROM training_sessions
+                        WHERE session_id = NEW.session_id)
+    AND day = date(NEW.created_at);
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_student_delete
+AFTER DELETE ON students
+BEGIN
+    UPDATE company_stats SET
+        total_students = total_students - 1,
+        verified_students = verified_students - (COALESCE(OLD.verified, 0) = 1),
+        match_score_sum = match_score_sum - COALESCE(OLD.match_score, 0),
+        match_score_count = match_score_count - (OLD.match_score IS NOT NULL)
+    WHERE company_id = (SELECT company_id FROM training_sessions
+                        WHERE session_id = OLD.session_id);
+
+    UPDATE company_daily_stats SET
+        students_created = students_created - 1,
+        students_verified = students_verified - (COALESCE(OLD.verified, 0) = 1),
+        match_score_sum = match_score_sum - COALESCE(OLD.match_score, 0),
+        match_score_count = match_score_count - (OLD.match_score IS NOT NULL)
+    WHERE company_id = (SELECT company_id FROM training_sessions
+                        WHERE session_id = OLD.session_id)
+    AND day = date(OLD.created_at);
+END;
+
+-- Certificates --------------------------------------------------------------
+
+CREATE TRIGGER IF NOT EXISTS stats_certificate_issued
+AFTER UPDATE OF status ON certificates
+WHEN NEW.status = 'ISSUED' AND OLD.status != 'ISSUED'
+BEGIN
+    INSERT INTO company_stats (company_id, certificates_issued)
+    VALUES ((SELECT company_id FROM certificate_batches WHERE batch_id = NEW.batch_id), 1)
+    ON CONFLICT(company_id) DO UPDATE SET certificates_issued = certificates_issued + 1;
+
+    INSERT INTO company_daily_stats (company_id, day, certificates_issued)
+    VALUES ((SELECT company_id FROM certificate_batches WHERE batch_id = NEW.batch_id),
+            COALESCE(date(NEW.issue_date), date('now')), 1)
+    ON CONFLICT(company_id, day) DO UPDATE SET certificates_issued = certificates_issued + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_certificate_unissued
+AFTER UPDATE OF status ON certificates
+WHEN OLD.status = 'ISSUED' AND NEW.status != 'ISSUED'
+BEGIN
+    UPDATE company_stats SET certificates_issued = certificates_issued - 1
+    WHERE company_id = (SELECT company_id FROM certificate_batches WHERE batch_id = OLD.batch_id);
+
+    UPDATE company_daily_stats SET certificates_issued = certificates_issued - 1
+    WHERE company_id = (SELECT company_id FROM certificate_batches WHERE batch_id = OLD.batch_id)
+    AND day = COALESCE(date(OLD.issue_date), date('now'));
+END;
+
+-- Sessions ------------------------------------------------------------------
+
+CREATE TRIGGER IF NOT EXISTS stats_session_insert
+AFTER INSERT ON training_sessions
+BEGIN
+    INSERT INTO company_stats (company_id, active_sessions)
+    VALUES (NEW.company_id, NEW.status = 'IN_PROGRESS')
+    ON CONFLICT(company_id) DO UPDATE SET
+        active_sessions = active_sessions + excluded.active_sessions;
+
+    INSERT INTO company_daily_stats (company_id, day, sessions_started)
+    VALUES (NEW.company_id, date(NEW.created_at), 1)
+    ON CONFLICT(company_id, day) DO UPDATE SET sessions_started = sessions_started + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_session_status
+AFTER UPDATE OF status ON training_sessions
+WHEN NEW.status != OLD.status
+BEGIN
+    UPDATE company_stats SET
+        active_sessions = active_sessions
+            + (NEW.status = 'IN_PROGRESS') - (OLD.status = 'IN_PROGRESS')
+    WHERE company_id = NEW.company_id;
+
+    INSERT INTO company_daily_stats (company_id, day, sessions_completed)
+    SELECT NEW.company_id, COALESCE(date(NEW.completed_at), date('now')), 1
+    WHERE NEW.status = 'COMPLETED'
+    ON CONFLICT(company_id, day) DO UPDATE SET sessions_completed = sessions_completed + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_session_delete
+AFTER DELETE ON training_sessions
+WHEN OLD.status = 'IN_PROGRESS'
+BEGIN
+    UPDATE company_stats SET active_sessions = active_sessions - 1
+    WHERE company_id = OLD.company_id;
+END;
+"""
+
+
+def ensure_schema(conn):
+    """Create the rollup tables and triggers, backfilling on first creation"""
+    existed = conn.execute("""SELECT 1 FROM sqlite_master
+                              WHERE type = 'table' AND name = 'company_stats'""").fetchone()
+    conn.executescript(SCHEMA)
+    if not existed:
+        rebuild(conn)
+
+
+def rebuild(conn):
+    """Recompute every counter from the base tables (one transaction)"""
+    conn.execute("DELETE FROM company_stats")
+    conn.execute("DELETE FROM company_daily_stats")
+    conn.execute("""INSERT INTO company_stats (company_id)
+                    SELECT company_id FROM training_company""")
+    conn.execute("""UPDATE company_stats SET
+                        total_students = agg.total, verified_students = agg.verified,
+                        match_score_sum = agg.score_sum, match_score_count = agg.score_count
+                    FROM (SELECT ts.company_id, COUNT(*) AS total,
+                                 SUM(COALESCE(s.verified, 0) = 1) AS verified,
+                                 COALESCE(SUM(s.match_score), 0) AS score_sum,
+                                 COUNT(s.match_score) AS score_count
+                          FROM students s
+                          JOIN training_sessions ts ON s.session_id = ts.session_id
+                          GROUP BY ts.company_id) AS agg
+                    WHERE company_stats.company_id = agg.company_id""")
+    conn.execute("""UPDATE company_stats SET certificates_issued = agg.issued
+                    FROM (SELECT cb.company_id, COUNT(*) AS issued
+                          FROM certificates c
+                          JOIN certificate_batches cb ON c.batch_id = cb.batch_id
+                          WHERE c.status = 'ISSUED'
+                          GROUP BY cb.company_id) AS agg
+                    WHERE company_stats.company_id = agg.company_id""")
+    conn.execute("""UPDATE company_stats SET active_sessions = agg.active
+                    FROM (SELECT company_id, COUNT(*) AS active FROM training_sessions
+                          WHERE status = 'IN_PROGRESS' GROUP BY company_id) AS agg
+                    WHERE company_stats.company_id = agg.company_id""")
+
+    conn.execute("""INSERT INTO company_daily_stats (company_id, day, students_created,
+                                                     students_verified, match_score_sum,
+                                                     match_score_count)
+                    SELECT ts.company_id, date(s.created_at), COUNT(*),
+                           SUM(COALESCE(s.verified, 0) = 1),
+                           COALESCE(SUM(s.match_score), 0), COUNT(s.match_score)
+                    FROM students s
+                    JOIN training_sessions ts ON s.session_id = ts.session_id
+                    GROUP BY ts.company_id, date(s.created_at)""")
+    conn.execute("""INSERT INTO company_daily_stats (company_id, day, certificates_issued)
+                    SELECT cb.company_id, COALESCE(date(c.issue_date), date('now')), COUNT(*)
+                    FROM certificates c
+                    JOIN certificate_batches cb ON c.batch_id = cb.batch_id
+                    WHERE c.status = 'ISSUED'
+                    GROUP BY 1, 2
+                    ON CONFLICT(company_id, day) DO UPDATE SET
+                        certificates_issued = excluded.certificates_issued""")
+    conn.execute("""INSERT INTO company_daily_stats (company_id, day, sessions_started)
+                    SELECT company_id, date(created_at), COUNT(*)
+                    FROM training_sessions
+                    GROUP BY 1, 2
+                    ON CONFLICT(company_id, day) DO UPDATE SET
+                        sessions_started = excluded.sessions_started""")
+    conn.execute("""INSERT INTO company_daily_stats (company_id, day, sessions_completed)
+                    SELECT company_id, COALESCE(date(completed_at), date('now')), COUNT(*)
+                    FROM training_sessions
+                    WHERE status = 'COMPLETED'
+                    GROUP BY 1, 2
+                    ON CONFLICT(company_id, day) DO UPDATE SET
+                        sessions_completed = excluded.sessions_completed""")
+    conn.commit()
+
+
+def company_totals(conn, company_id, today):
+    """Running totals plus today's rollup, as one primary-key read"""
+    return conn.execute("""SELECT cs.*, COALESCE(d.students_created, 0) AS students_today
+                           FROM company_stats cs
+                           LEFT JOIN company_daily_stats d
+                                ON d.company_id = cs.company_id AND d.day = ?
+                           WHERE cs.company_id = ?""", (today, company_id)).fetchone()
+
+
+def company_range(conn, company_id, date_from, date_to):
+    """Per-day rollups for [date_from, date_to] (a primary-key range scan)"""
+    return conn.execute("""SELECT * FROM company_daily_stats
+                           WHERE company_id = ? AND day BETWEEN ? AND ?
+                           ORDER BY day""", (company_id, date_from, date_to)).fetchall()
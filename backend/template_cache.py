@@ -0,0 +1,89 @@
+"""
+In-process cache of task_configuration templates.
+
+The whole table is cached per process and tagged with the version number in
+config_versions. update_tasks bumps that version in the same transaction as
+its changes. Each connection's PRAGMA data_version tells us cheaply whether
+anyone else has committed since we last looked. Only then is the version row
+re-read, and the templates reloaded if it moved.
+"""
+import threading
+
+CONFIG_NAME = 'task_configuration'
+
+
+class TaskTemplateCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._rows = []
+        self._by_type = {}
+        self._seen_data_version = {}
+        self._hits = 0
+        self._reloads = 0
+
+    def _refresh(self, conn):
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        key = id(conn)
+        with self._lock:
+            if self._version is not None and self._seen_data_version.get(key) == data_version:
+                self._hits += 1
+                return
+
+        row = conn.execute("SELECT version FROM config_versions WHERE name = ?",
+                           (CONFIG_NAME,)).fetchone()
+        version = row[0] if row else 0
+
+        with self._lock:
+            current = self._version
+        if version != current:
+            rows = [dict(r) for r in conn.execute(
+                "SELECT * FROM task_configuration ORDER BY session_type, sequence")]
+            by_type = {}
+            for r in rows:
+                by_type.setdefault(r['session_type'], []).append(r)
+            with self._lock:
+                self._rows = rows
+                self._by_type = by_type
+                self._version = version
+                self._reloads += 1
+        else:
+            with self._lock:
+                self._hits += 1
+        with self._lock:
+            self._seen_data_version[key] = data_version
+
+    def get(self, conn, session_type):
+        """Task template rows for one session type, in sequence order"""
+        self._refresh(conn)
+        with self._lock:
+            return self._by_type.get(session_type, [])
+
+    def all(self, conn):
+        """(version, all template rows ordered by session type and sequence)"""
+        self._refresh(conn)
+        with self._lock:
+            return self._version, self._rows
+
+    def bump_version(self, conn):
+        """Increment the template version inside the caller's transaction"""
+        conn.execute("INSERT OR IGNORE INTO config_versions (name, version) VALUES (?, 0)",
+                     (CONFIG_NAME,))
+        conn.execute("UPDATE config_versions SET version = version + 1 WHERE name = ?",
+                     (CONFIG_NAME,))
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self._version,
+                "session_types": len(self._by_type),
+                "hits_total": self._hits,
+                "reloads_total": self._reloads,
+            }
+
+
+task_templates = TaskTemplateCache()
@@ -0,0 +1,114 @@
+"""
+Regression test: closing a session twice must not re-issue certificates.
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+PASSWORD = 'secret'
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # main.py and its modules keep their files relative to the working
+    # directory, so run the app inside a throwaway one
+    work_dir = tmp_path_factory.mktemp('app')
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    conn = sqlite3.connect('training.db')
+    with open(os.path.join(BACKEND_DIR, 'Schema.sql')) as f:
+        conn.executescript(f.read())
+    from passlib.context import CryptContext
+    conn.execute(
+        "UPDATE users SET password_hash = ?, is_instructor = 1 WHERE email = 'admin@example.com'",
+        (CryptContext(schemes=["bcrypt"]).hash(PASSWORD),)
+    )
+    conn.commit()
+    conn.close()
+
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as c:
+        yield c
+    os.chdir(old_cwd)
+
+
+@pytest.fixture(scope='module')
+def headers(client):
+    r = client.post("/auth/login", json={"email": "admin@example.com", "password": PASSWORD})
+    assert r.status_code == 200
+    return {"Authorization": "Bearer " + r.json()["access_token"]}
+
+
+def _counts():
+    conn = sqlite3.connect('training.db')
+    try:
+        certs = conn.execute("SELECT COUNT(*) FROM certificates WHERE status = 'ISSUED'").fetchone()[0]
+        jobs = conn.execute("SELECT COUNT(*) FROM certificate_jobs").fetchone()[0]
+        return certs, jobs
+    finally:
+        conn.close()
+
+
+def test_complete_session_twice(client, headers):
+    r = client.post("/certificates/batch",
+                    json={"session_type": "CBT", "start_certificate_number": 7000, "batch_size": 5},
+                    headers=headers)
+    assert r.status_code == 200
+
+    sid = client.post("/sessions", json={"session_type": "CBT"}, headers=headers).json()["session_id"]
+    for name, licence in (("A", "L1"), ("B", "L2")):
+        r = client.post(f"/sessions/{sid}/students", json={"name": name, "license_number": licence}, headers=headers)
+        assert r.status_code == 200
+
+    task_ids = [t["task_id"] for t in client.get("/admin/tasks", headers=headers).json()["tasks"]]
+    r = client.put(f"/sessions/{sid}/tasks/complete", json={"task_ids": task_ids, "completed": True}, headers=headers)
+    assert r.status_code == 200
+
+    r = client.post(f"/sessions/{sid}/complete", headers=headers)
+    assert r.status_code == 200
+    assert _counts()[0] == 2
+    after_first = _counts()
+
+    r = client.post(f"/sessions/{sid}/complete", headers=headers)
+    assert r.status_code == 409
+    assert _counts() == after_first
+
+
+def test_issue_skips_students_already_certified(client, headers):
+    import cert_allocator
+    from db import pool
+
+    r = client.post("/certificates/batch",
+                    json={"session_type": "CBT", "start_certificate_number": 8000, "batch_size": 5},
+                    headers=headers)
+    assert r.status_code == 200
+
+    sid = client.post("/sessions", json={"session_type": "CBT"}, headers=headers).json()["session_id"]
+    client.post(f"/sessions/{sid}/students", json={"name": "C", "license_number": "L3"}, headers=headers)
+    task_ids = [t["task_id"] for t in client.get("/admin/tasks", headers=headers).json()["tasks"]]
+    client.put(f"/sessions/{sid}/tasks/complete", json={"task_ids": task_ids, "completed": True}, headers=headers)
+    assert client.post(f"/sessions/{sid}/complete", headers=headers).status_code == 200
+    before = _counts()
+
+    # Calling the allocator again directly, as a racing close would, issues nothing
+    with pool.connection() as conn:
+        session = conn.execute(
+            "SELECT company_id, session_type, instructor_id FROM training_sessions WHERE session_id = ?",
+            (sid,)
+        ).fetchone()
+        cert_allocator.begin_immediate(conn)
+        issued = cert_allocator.issue_to_passing_students(
+            conn, session['company_id'], session['session_type'], sid, session['instructor_id']
+        )
+        conn.commit()
+    assert not issued
+    assert _counts() == before
@@ -0,0 +1,124 @@
+# Certificate email throughput in messages per second: a new SMTP connection
+# per message against CertificateMailer's persistent per-thread connections.
+# Runs an in-process sink server unless --host/--port point at a real one
+# (e.g. `python -m aiosmtpd -n -l localhost:1025`).
+#
+# Usage (from backend/):
+#   python utils/bench_email.py
+#   python utils/bench_email.py --messages 500 --threads 4
+#   python utils/bench_email.py --host localhost --port 1025
+import argparse
+import os
+import smtplib
+import socket
+import sys
+import threading
+import time
+import warnings
+from email.message import EmailMessage
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from cert_mailer import CertificateMailer
+
+
+def start_sink():
+    """A local SMTP server that accepts and discards mail; returns (host, port, stop)"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    try:
+        from aiosmtpd.controller import Controller
+
+        class Sink:
+            async def handle_DATA(self, server, session, envelope):
+                return '250 OK'
+
+        controller = Controller(Sink(), hostname='127.0.0.1', port=port)
+        controller.start()
+        return '127.0.0.1', port, controller.stop
+    except ImportError:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            import asyncore
+            import smtpd
+
+        class Sink(smtpd.SMTPServer):
+            def process_message(self, *args, **kwargs):
+                return None
+
+        server = Sink(('127.0.0.1', port), None)
+        threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05},
+                         daemon=True).start()
+        return '127.0.0.1', port, server.close
+
+
+def messages(count, attachment_bytes):
+    attachment = os.urandom(attachment_bytes)
+    result = []
+    for i in range(count):
+        message = EmailMessage()
+        message['From'] = 'office@example.com'
+        message['To'] = f"student{i}@example.com"
+        message['Subject'] = f"Your CBT certificate ({100000 + i})"
+        message.set_content("Your certificate of completion is attached.\n")
+        message.add_attachment(attachment, maintype='application', subtype='pdf',
+                               filename=f"certificate_{100000 + i}.pdf")
+        result.append(message)
+    return result
+
+
+def connection_per_message(host, port, batch):
+    for message in batch:
+        with smtplib.SMTP(host, port) as smtp:
+            smtp.send_message(message)
+
+
+def run_threads(target, batches):
+    threads = [threading.Thread(target=target, args=(batch,)) for batch in batches]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--attachment-kb', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=0, help="mailer rate limit (0 = off)")
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+
+    if args.host:
+        host, port, stop = args.host, args.port, lambda: None
+    else:
+        host, port, stop = start_sink()
+
+    batch = messages(args.messages, args.attachment_kb * 1024)
+    split = [batch[i::args.threads] for i in range(args.threads)]
+    print(f"{args.messages} messages, {args.attachment_kb}KB attachment, {host}:{port}")
+    print(f"{'path':>32} {'msgs/s':>9} {'connects':>9}")
+    try:
+        elapsed = run_threads(lambda b: connection_per_message(host, port, b), [batch])
+        print(f"{'connection per message, 1 thread':>32} {len(batch) / elapsed:>9.0f} "
+              f"{len(batch):>9}")
+
+        for threads, batches in ((1, [batch]), (args.threads, split)):
+            mailer = CertificateMailer(host=host, port=port, rate=args.rate)
+            elapsed = run_threads(mailer.send_messages, batches)
+            stats = mailer.stats()
+            mailer.close()
+            assert stats['sent_total'] == len(batch), stats
+            print(f"{f'persistent, {threads} thread(s)':>32} {len(batch) / elapsed:>9.0f} "
+                  f"{stats['connects_total']:>9}")
+    finally:
+        stop()
+
+
+if __name__ == "__main__":
+    main()
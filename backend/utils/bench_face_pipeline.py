@@ -0,0 +1,84 @@
+# Compare the downscale-before-detect face pipeline against the original
+# full resolution path.
+#
+# Usage (from backend/):
+#   python utils/bench_face_pipeline.py student.jpg license.jpg
+#   python utils/bench_face_pipeline.py student.jpg license.jpg --sizes 480 640 800 --model cnn
+import argparse
+import io
+import os
+import sys
+import time
+
+import face_recognition
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from face_service import compare_faces
+
+
+def crop_face_with_padding(image_np, face_location, padding=0.2):
+    top, right, bottom, left = face_location
+    pad_h = int((bottom - top) * padding)
+    pad_w = int((right - left) * padding)
+    img_height, img_width = image_np.shape[:2]
+    return image_np[max(0, top - pad_h):min(img_height, bottom + pad_h),
+                    max(0, left - pad_w):min(img_width, right + pad_w)]
+
+
+def legacy_compare(student_img_data, license_img_data, model):
+    """The original verify_face path: full decode, full-size detection, re-detect in crop"""
+    encodings = []
+    for data in (student_img_data, license_img_data):
+        image = Image.open(io.BytesIO(data))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image_np = np.array(image)
+        locations = face_recognition.face_locations(image_np, model=model)
+        face = crop_face_with_padding(image_np, locations[0])
+        encodings.append(face_recognition.face_encodings(face)[0])
+    return float(face_recognition.face_distance([encodings[1]], encodings[0])[0])
+
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('student_photo')
+    parser.add_argument('license_photo')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[480, 640, 800, 1200])
+    parser.add_argument('--model', default='hog', choices=['hog', 'cnn'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.student_photo, 'rb') as f:
+        student = f.read()
+    with open(args.license_photo, 'rb') as f:
+        license = f.read()
+
+    base_time, base_distance = timed(lambda: legacy_compare(student, license, args.model),
+                                     args.repeat)
+    base_score = max(0, min(100, (1 - base_distance) * 100))
+
+    print(f"{'detect side':>12} {'latency ms':>11} {'speedup':>8} {'match %':>8} {'delta':>7}")
+    print(f"{'full (old)':>12} {base_time * 1000:>11.1f} {1.0:>7.1f}x {base_score:>8.2f} {0.0:>7.2f}")
+    for size in args.sizes:
+        elapsed, result = timed(lambda: compare_faces(student, license, size, args.model),
+                                args.repeat)
+        score = max(0, min(100, (1 - result['face_distance']) * 100))
+        print(f"{size:>12} {elapsed * 1000:>11.1f} {base_time / elapsed:>7.1f}x "
+              f"{score:>8.2f} {score - base_score:>+7.2f}")
+
+
+if __name__ == "__main__":
+    main()
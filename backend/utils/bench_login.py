@@ -0,0 +1,84 @@
+# Concurrent login throughput: bcrypt inline on the event loop (the old
+# /auth/login) against bcrypt on the password pool. A heartbeat task stands in
+# for every other request and records how long the loop stalls.
+#
+# Usage (from backend/):
+#   python utils/bench_login.py
+#   python utils/bench_login.py --logins 64 --rounds 12 --workers 4
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from passlib.context import CryptContext
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from login_guard import PasswordHasher
+
+
+async def heartbeat(stop, lags, interval=0.01):
+    """Sleep in small steps; anything beyond the interval is event-loop stall"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(login, count):
+    stop = asyncio.Event()
+    lags = []
+    beat = asyncio.create_task(heartbeat(stop, lags))
+    await asyncio.sleep(0.05)
+
+    latencies = []
+
+    async def one():
+        started = time.perf_counter()
+        await login()
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await beat
+    latencies.sort()
+    return {
+        "logins_per_s": count / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "max_stall_ms": max(lags, default=0) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.rounds)
+    stored = context.hash("correct horse battery staple")
+
+    async def inline():
+        context.verify("correct horse battery staple", stored)
+
+    hasher = PasswordHasher(workers=args.workers, queue_limit=args.logins)
+
+    async def pooled():
+        await hasher.run(context.verify, "correct horse battery staple", stored)
+
+    print(f"{args.logins} concurrent logins, bcrypt cost {args.rounds}, "
+          f"{args.workers} pool workers")
+    print(f"{'mode':>8} {'logins/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'max stall ms':>13}")
+    for name, login in (("inline", inline), ("pool", pooled)):
+        result = asyncio.run(run(login, args.logins))
+        print(f"{name:>8} {result['logins_per_s']:>9.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['max_stall_ms']:>13.1f}")
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Certificate rendering cost: every PDF laid out from scratch (template cache
+# cleared each time) against the cached company layer (captured stream and
+# public-API fallback), in-process and through the render pool for one
+# closed session, one render per job thread as the job queue does it.
+#
+# Usage (from backend/):
+#   python utils/bench_render.py
+#   python utils/bench_render.py --certificates 12 --workers 4
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+import cert_render
+from cert_render import RenderPool, render_certificate, _init_worker
+
+COMPANY = {
+    'company_id': 1, 'company_name': "Example Motorcycle Training Ltd",
+    'training_body_reference': 'ATB123456', 'address_line_1': '1 High Street',
+    'city': 'Anytown', 'county': 'Anyshire', 'postcode': 'AB1 2CD',
+    'phone': '01234 567890', 'email': 'office@example.com', 'updated_at': '2026-01-01',
+}
+
+
+def certificates(count):
+    return [{
+        'certificate_id': i, 'certificate_number': 100000 + i,
+        'student_name': f"Student {i}", 'date_of_birth': '1999-01-01',
+        'license_number': f"SMITH{i:06d}AB9CD", 'session_type_description': 'CBT',
+        'bike_type': 'Manual', 'issue_date': '2026-01-01T10:00:00', 'site_code': 'S01',
+        'instructor_name': 'Instructor', 'instructor_certificate_number': 'IC1',
+    } for i in range(count)]
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--certificates', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=cert_render.CERT_RENDER_WORKERS)
+    args = parser.parse_args()
+
+    certs = certificates(args.certificates)
+    output_dir = tempfile.mkdtemp(prefix='bench_render_')
+    _init_worker()
+    render_certificate(COMPANY, certs[0], output_dir)
+
+    def uncached():
+        for cert in certs:
+            cert_render._templates.clear()
+            render_certificate(COMPANY, cert, output_dir)
+
+    def cached():
+        for cert in certs:
+            render_certificate(COMPANY, cert, output_dir)
+
+    def public_api():
+        # What rendering falls back to if the stream cannot be captured
+        key = (COMPANY['company_id'], COMPANY['updated_at'])
+        for cert in certs:
+            drawing, _, _, stamp = cert_render._company_template(COMPANY)
+            cert_render._templates[key] = (drawing, None, None, stamp)
+            render_certificate(COMPANY, cert, output_dir)
+        cert_render._templates.clear()
+
+    print(f"{args.certificates} certificates -> {output_dir}")
+    print(f"{'path':>24} {'total ms':>9} {'ms/cert':>8}")
+    for name, fn in (("template rebuilt", uncached), ("template cached", cached),
+                     ("cached, public API", public_api)):
+        elapsed = timed(fn)
+        print(f"{name:>24} {elapsed:>9.1f} {elapsed / len(certs):>8.2f}")
+
+    pool = RenderPool(workers=args.workers, output_dir=output_dir)
+    threads = ThreadPoolExecutor(max_workers=pool.workers)
+
+    def through_pool():
+        list(threads.map(lambda cert: pool.render(COMPANY, cert), certs))
+
+    try:
+        cold = timed(through_pool)
+        warm = timed(through_pool)
+    finally:
+        threads.shutdown()
+        pool.shutdown()
+    print(f"{'pool, cold (' + str(pool.workers) + ' workers)':>24} {cold:>9.1f} {cold / len(certs):>8.2f}")
+    print(f"{'pool, warm':>24} {warm:>9.1f} {warm / len(certs):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Per-row cost of turning a students listing into a JSON body: the old path
+# (sqlite3.Row -> dict -> jsonable_encoder -> json.dumps, as FastAPI does for
+# a returned dict) against tuple rows + orjson, materialised and streamed.
+#
+# Usage (from backend/):
+#   python utils/bench_serialization.py
+#   python utils/bench_serialization.py --rows 5000 --fields name,training_outcome
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from serialization import dumps, fetch_dicts, json_chunks
+
+
+def build_db(rows):
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    with open(os.path.join(BACKEND_DIR, 'Schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.execute("""INSERT INTO training_sessions
+                    (instructor_id, company_id, session_type, session_date)
+                    VALUES (1, 1, 'CBT', '2026-01-01')""")
+    conn.executemany("""INSERT INTO students
+                        (session_id, name, license_number, email, phone, date_of_birth,
+                         address, postcode, match_score, verified, bike_type,
+                         student_photo_path, license_photo_path)
+                        VALUES (1, ?, ?, ?, '07700 900000', '1990-01-01',
+                                '1 High Street, Anytown', 'AB1 2CD', 0.87, 1, 'Manual',
+                                'photos/ab/cd/abcd.jpg', 'photos/ef/01/ef01.jpg')""",
+                     [(f"Student {i}", f"SMITH{i:06d}AB9CD", f"s{i}@example.com")
+                      for i in range(rows)])
+    conn.commit()
+    return conn
+
+
+def old_path(conn, sql):
+    rows = [dict(row) for row in conn.execute(sql).fetchall()]
+    content = jsonable_encoder({"students": rows})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode()
+
+
+def tuple_path(conn, sql):
+    return dumps({"students": fetch_dicts(conn, sql)})
+
+
+def streamed_path(conn, sql):
+    return b''.join(json_chunks(conn, sql, (), "students"))
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--fields', help="comma-separated projection for the new paths")
+    args = parser.parse_args()
+
+    conn = build_db(args.rows)
+    projection = args.fields.replace(' ', '') if args.fields else '*'
+    if projection != '*':
+        projection = 'student_id,' + projection
+    full_sql = "SELECT * FROM students ORDER BY created_at"
+    sql = f"SELECT {projection} FROM students ORDER BY created_at"
+
+    base_time, base_body = timed(lambda: old_path(conn, full_sql), args.repeat)
+    print(f"{args.rows} rows, projection: {projection}")
+    print(f"{'path':>22} {'us/row':>8} {'speedup':>8} {'bytes':>9}")
+    print(f"{'Row+jsonable (old)':>22} {base_time / args.rows * 1e6:>8.2f} {1.0:>7.1f}x "
+          f"{len(base_body):>9}")
+    for name, fn in (("tuples+orjson", tuple_path), ("streamed", streamed_path)):
+        elapsed, body = timed(lambda: fn(conn, sql), args.repeat)
+        if projection == '*':
+            assert json.loads(body) == json.loads(base_body)
+        print(f"{name:>22} {elapsed / args.rows * 1e6:>8.2f} {base_time / elapsed:>7.1f}x "
+              f"{len(body):>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Durable write-behind queue.
+
+Request handlers append records to a local SQLite journal (write_queue.db)
+and return straight away. A single writer thread drains the journal into
+training.db in batched transactions, retrying with backoff, so bursts of
+verifications do not contend with request-path writes.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from db import pool
+
+WRITE_QUEUE_PATH = os.getenv('WRITE_QUEUE_PATH', 'write_queue.db')
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.5'))
+WRITE_MAX_ATTEMPTS = int(os.getenv('WRITE_MAX_ATTEMPTS', '5'))
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS write_queue (
+    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'PENDING' CHECK(status IN ('PENDING', 'DEAD')),
+    last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_write_queue_pending
+    ON write_queue(status, next_attempt_at, entry_id);
+"""
+
+
+class WriteBehindQueue:
+    """SQLite-journalled queue drained by one writer thread"""
+
+    def __init__(self, path=WRITE_QUEUE_PATH, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL, max_attempts=WRITE_MAX_ATTEMPTS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._handlers = {}
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._written = 0
+        self._batches = 0
+        self._failures = 0
+        self._last_batch_size = 0
+
+    def register(self, kind, handler):
+        """handler(conn, payloads) writes a list of payloads inside the caller's transaction"""
+        self._handlers[kind] = handler
+
+    # ------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------
+
+    def _open_journal(self):
+        if self._journal is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = FULL")
+            conn.executescript(JOURNAL_SCHEMA)
+            self._journal = conn
+        return self._journal
+
+    def enqueue(self, kind, payload):
+        """Durably record one write; returns once it is in the journal"""
+        if kind not in self._handlers:
+            raise ValueError(f"No write handler registered for {kind}")
+        with self._journal_lock:
+            journal = self._open_journal()
+            journal.execute("""INSERT INTO write_queue (kind, payload, enqueued_at)
+                               VALUES (?, ?, ?)""",
+                            (kind, json.dumps(payload, separators=(',', ':')), time.time()))
+            journal.commit()
+        self._wake.set()
+
+    # ------------------------------------------------------------------
+    # Writer thread
+    # ------------------------------------------------------------------
+
+    def start(self):
+        with self._journal_lock:
+            self._open_journal()
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="write-behind",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                # Keep draining while full batches are coming back
+                while self.drain() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"❌ Write-behind drain error: {e}")
+            if self._stopping.is_set():
+                break
+
+    def _claim(self):
+        with self._journal_lock:
+            rows = self._open_journal().execute(
+                """SELECT entry_id, kind, payload, attempts FROM write_queue
+                   WHERE status = 'PENDING' AND next_attempt_at <= ?
+                   ORDER BY entry_id LIMIT ?""",
+                (time.time(), self.batch_size)).fetchall()
+        return rows
+
+    def _write(self, entries):
+        by_kind = {}
+        for entry in entries:
+            by_kind.setdefault(entry['kind'], []).append(json.loads(entry['payload']))
+        with pool.connection() as conn:
+            try:
+                for kind, payloads in by_kind.items():
+                    self._handlers[kind](conn, payloads)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def drain(self):
+        """Write one batch; returns the number of journal entries processed"""
+        entries = self._claim()
+        if not entries:
+            return 0
+
+        done = []
+        failed = []
+        try:
+            self._write(entries)
+            done = entries
+        except Exception:
+            # Retry one at a time so a single bad record can't block the batch
+            for entry in entries:
+                try:
+                    self._write([entry])
+                    done.append(entry)
+                except Exception as e:
+                    failed.append((entry, str(e)))
+
+        now = time.time()
+        with self._journal_lock:
+            journal = self._open_journal()
+            journal.executemany("DELETE FROM write_queue WHERE entry_id = ?",
+                                [(entry['entry_id'],) for entry in done])
+            for entry, error in failed:
+                attempts = entry['attempts'] + 1
+                status = 'DEAD' if attempts >= self.max_attempts else 'PENDING'
+                journal.execute("""UPDATE write_queue
+                                   SET attempts = ?, next_attempt_at = ?, status = ?,
+                                       last_error = ?
+                                   WHERE entry_id = ?""",
+                                (attempts, now + min(60, 2 ** attempts), status, error,
+                                 entry['entry_id']))
+                print(f"❌ Write-behind {entry['kind']} #{entry['entry_id']} "
+                      f"failed (attempt {attempts}): {error}")
+            journal.commit()
+
+        self._written += len(done)
+        self._failures += len(failed)
+        self._batches += 1
+        self._last_batch_size = len(entries)
+        return len(entries)
+
+    def stats(self):
+        with self._journal_lock:
+            row = self._open_journal().execute(
+                """SELECT SUM(status = 'PENDING') AS depth,
+                          SUM(status = 'DEAD') AS dead,
+                          MIN(CASE WHEN status = 'PENDING' THEN enqueued_at END) AS oldest
+                   FROM write_queue""").fetchone()
+        return {
+            "depth": row['depth'] or 0,
+            "dead": row['dead'] or 0,
+            "lag_seconds": round(time.time() - row['oldest'], 3) if row['oldest'] else 0.0,
+            "written_total": self._written,
+            "failures_total": self._failures,
+            "batches_total": self._batches,
+            "last_batch_size": self._last_batch_size,
+        }
+
+
+write_queue = WriteBehindQueue()